@@ -0,0 +1,58 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import database
+
+# Every worker thread keeps its own read connection (see db_pool), so the
+# executor size is also the number of concurrent readers per process.
+MAX_WORKERS = int(os.environ.get("NEXO_DB_WORKERS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="nexo-db")
+
+def _after_fork():
+    # The parent's worker threads do not exist in a forked child, an
+    # executor that still counts them would never run anything
+    global _executor
+    _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="nexo-db")
+
+os.register_at_fork(after_in_child=_after_fork)
+
+async def run(func, *args, **kwargs):
+    """
+    Runs a blocking function on the database executor and awaits the result.
+
+    Args:
+        func (callable): The function to run.
+        *args: Positional arguments for the function.
+        **kwargs: Keyword arguments for the function.
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def _wrap(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+def _mirror(namespace):
+    attrs = {}
+    for name, value in vars(namespace).items():
+        if name.startswith("__"):
+            continue
+        if isinstance(value, type):
+            attrs[name] = _mirror(value)
+        elif callable(value):
+            attrs[name] = _wrap(value)
+    return type(namespace.__name__, (), attrs)
+
+# Awaitable versions of the namespaces in lib/database.py, e.g.
+# await async_database.User.Core.get_user(username)
+User = _mirror(database.User)
+Topics = _mirror(database.Topics)
+PublicPosts = _mirror(database.PublicPosts)
+PublicPostReplies = _mirror(database.PublicPostReplies)
+DirectMessages = _mirror(database.DirectMessages)
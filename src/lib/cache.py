@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+
+from . import invalidation
+
+_MISSING = object()
+
+class LRUCache:
+    """
+    A thread safe least recently used cache with an optional time to live.
+
+    Args:
+        maxsize (int): The maximum number of entries kept.
+        ttl (float): Seconds an entry stays valid, None to keep it until
+            it is evicted.
+        shared (str): A name for the cache to pass pop() and clear() on to
+            the same cache in every other worker process, None for a cache
+            that is never invalidated.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, shared=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if shared:
+            invalidation.channel.register(shared, self._pop, self._clear)
+
+    def get(self, key, default=None):
+        if self.shared:
+            invalidation.channel.poll()
+        with self.lock:
+            entry = self.data.get(key, _MISSING)
+            if entry is _MISSING or (self.ttl is not None and entry[1] <= time.monotonic()):
+                if entry is not _MISSING:
+                    del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        if self.shared:
+            invalidation.channel.publish(self.shared, key)
+        return self._pop(key)
+
+    def _pop(self, key):
+        with self.lock:
+            entry = self.data.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        if self.shared:
+            invalidation.channel.publish(self.shared)
+        self._clear()
+
+    def _clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
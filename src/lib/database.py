@@ -1,95 +1,123 @@
 
-import sqlite3
 import os
 
 from . import xss
 from . import logger
+from . import db_pool
+from . import migrations
+from . import cache
+from . import search
+from . import page_cache
+from . import timefmt
+from . import write_queue
+from . import stats
+from . import metrics
 
-conn = sqlite3.connect("data/nexo.db")
-conn.row_factory = sqlite3.Row
-c = conn.cursor()
+ADMIN_ROLES = ["admin", "superadmin", "administrator", "mod", "moderator", "owner", "staff", "team"]
+
+# Role and ban status per username, read on nearly every page. Entries are
+# dropped in every worker process when one of them changes them.
+user_meta_cache = cache.LRUCache(
+    maxsize=int(os.environ.get("NEXO_USER_CACHE_SIZE", "4096")),
+    ttl=float(os.environ.get("NEXO_USER_CACHE_TTL", "30")),
+    shared="user_meta"
+)
+
+# Unread mail count per username, shown in the account links on every page
+unread_mail_cache = cache.LRUCache(
+    maxsize=int(os.environ.get("NEXO_USER_CACHE_SIZE", "4096")),
+    ttl=float(os.environ.get("NEXO_USER_CACHE_TTL", "30")),
+    shared="unread_mail"
+)
 
 def generate_databases():
     logger.debug("Database", "Generating databases")
-    c.execute("CREATE TABLE IF NOT EXISTS Users (Username TEXT, Password TEXT, Role TEXT, Banned TEXT, BanReason TEXT, AboutMe TEXT, AccountSettings TEXT)")
-    c.execute("CREATE TABLE IF NOT EXISTS PublicPosts (ID TEXT, Title TEXT, Author TEXT, Timestamp TEXT, Topic TEXT, Body TEXT, Attachments TEXT, Score INTEGER, Deleted TEXT, Archived TEXT, RepliesLocked TEXT, Replies TEXT)")
-    c.execute("CREATE TABLE IF NOT EXISTS PublicPostsReplies (ID TEXT, PostID TEXT, Author TEXT, Timestamp TEXT, Body TEXT)")
-    c.execute("CREATE TABLE IF NOT EXISTS Topics (ID TEXT, Name TEXT, Description TEXT, AdminOnly TEXT, Locked TEXT, Archived TEXT)")
-    c.execute("CREATE TABLE IF NOT EXISTS DirectMessages (ID TEXT, Sender TEXT, Recipient TEXT, Timestamp TEXT, Body TEXT, ReadByRecipient TEXT, Replies TEXT)")
-    conn.commit()
+    migrations.migrate()
+    stats.reconcile()
 
 class User:
     class Core:
         def get_user(username):
-            logger.log("Database.UserDatabase", f"Getting user {username}")
-            c.execute("SELECT * FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return dict(row) if row else None
+            logger.log("Database.UserDatabase", "Getting user %s", username)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM Users WHERE Username = ?", (username,))
+                row = c.fetchone()
+                return dict(row) if row else None
         
         def create_user(username, password, role):
-            logger.log("Database.UserDatabase", f"Creating user {username}")
+            logger.log("Database.UserDatabase", "Creating user %s", username)
             username = xss.sanitize_input_no_html(username)
             password = xss.sanitize_input_no_html(password)
             role = xss.sanitize_input_no_html(role)
-            c.execute("INSERT INTO Users (Username, Password, Role) VALUES (?, ?, ?)", (username, password, role))
-            conn.commit()
+            def write(c):
+                c.execute("INSERT INTO Users (Username, Password, Role) VALUES (?, ?, ?)", (username, password, role))
+                stats.increment(c, "users")
+            write_queue.submit(write)
     
         def update_user(username, password, role, banned, ban_reason, about_me, account_settings):
-            logger.log("Database.UserDatabase", f"Updating user {username}")
+            logger.log("Database.UserDatabase", "Updating user %s", username)
             username = xss.sanitize_input_no_html(username)
             password = xss.sanitize_input_no_html(password)
             role = xss.sanitize_input_no_html(role)
             banned = xss.sanitize_input_no_html(banned)
             ban_reason = xss.sanitize_input_no_html(ban_reason)
-            about_me = xss.sanitize_input_no_html(about_me)
+            about_me = xss.sanitize_markdown_input(about_me)
             account_settings = xss.sanitize_input_no_html(account_settings)
             
-            c.execute("UPDATE Users SET Password = ?, Role = ?, Banned = ?, BanReason = ?, AboutMe = ?, AccountSettings = ? WHERE Username = ?", (password, role, banned, ban_reason, about_me, account_settings, username))
-            conn.commit()
+            write_queue.execute("UPDATE Users SET Password = ?, Role = ?, Banned = ?, BanReason = ?, AboutMe = ?, AccountSettings = ? WHERE Username = ?", (password, role, banned, ban_reason, about_me, account_settings, username))
+            user_meta_cache.pop(username)
+            page_cache.pages.invalidate(f"user:{username}")
         
         def get_all_users():
             logger.log("Database.UserDatabase", "Getting all users")
-            c.execute("SELECT * FROM Users")
-            rows = c.fetchall()
-            return [dict(row) for row in rows]
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM Users")
+                rows = c.fetchall()
+                return [dict(row) for row in rows]
         
         def get_user_by_role(role):
-            logger.log("Database.UserDatabase", f"Getting users with role {role}")
-            c.execute("SELECT * FROM Users WHERE Role = ?", (role,))
-            rows = c.fetchall()
-            return [dict(row) for row in rows]
+            logger.log("Database.UserDatabase", "Getting users with role %s", role)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM Users WHERE Role = ?", (role,))
+                rows = c.fetchall()
+                return [dict(row) for row in rows]
         
         def get_user_by_ban_status(banned):
-            logger.log("Database.UserDatabase", f"Getting users with ban status {banned}")
-            c.execute("SELECT * FROM Users WHERE Banned = ?", (banned,))
-            rows = c.fetchall()
-            return [dict(row) for row in rows]
+            logger.log("Database.UserDatabase", "Getting users with ban status %s", banned)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM Users WHERE Banned = ?", (banned,))
+                rows = c.fetchall()
+                return [dict(row) for row in rows]
     
     class Set:
         def ban_status(username, status, reason):
             status = xss.sanitize_input_no_html(status)
             reason = xss.sanitize_input_no_html(reason)
-            c.execute("UPDATE Users SET Banned = ?, BanReason = ? WHERE Username = ?", (status, reason, username))
-            conn.commit()
+            write_queue.execute("UPDATE Users SET Banned = ?, BanReason = ? WHERE Username = ?", (status, reason, username))
+            user_meta_cache.pop(username)
+            page_cache.pages.invalidate(f"user:{username}")
         
         def user_role(username, role):
-            c.execute("UPDATE Users SET Role = ? WHERE Username = ?", (role, username))
-            conn.commit()
+            write_queue.execute("UPDATE Users SET Role = ? WHERE Username = ?", (role, username))
+            user_meta_cache.pop(username)
+            page_cache.pages.invalidate(f"user:{username}")
         
         def about_me(username, about_me):
-            about_me = xss.sanitize_input_no_html(about_me)
-            c.execute("UPDATE Users SET AboutMe = ? WHERE Username = ?", (about_me, username))
-            conn.commit()
+            about_me = xss.sanitize_markdown_input(about_me)
+            write_queue.execute("UPDATE Users SET AboutMe = ? WHERE Username = ?", (about_me, username))
             
         def account_settings(username, settings):
             settings = xss.sanitize_input_no_html(settings)
-            c.execute("UPDATE Users SET AccountSettings = ? WHERE Username = ?", (settings, username))
-            conn.commit()
+            write_queue.execute("UPDATE Users SET AccountSettings = ? WHERE Username = ?", (settings, username))
         
         def password(username, password):
             password = xss.sanitize_input_no_html(password)
-            c.execute("UPDATE Users SET Password = ? WHERE Username = ?", (password, username))
-            conn.commit()
+            write_queue.execute("UPDATE Users SET Password = ? WHERE Username = ?", (password, username))
+
+        def avatar(username, avatar):
+            write_queue.execute("UPDATE Users SET Avatar = ? WHERE Username = ?", (avatar, username))
+            user_meta_cache.pop(username)
+            page_cache.pages.invalidate(f"user:{username}")
         
         # TODO: User deleting / Need to update entire database to make a ghost user
         
@@ -98,62 +126,105 @@ class User:
         
     class Get:
         def about_me(username):
-            c.execute("SELECT AboutMe FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return row[0] if row else None
+            with db_pool.read() as c:
+                c.execute("SELECT AboutMe FROM Users WHERE Username = ?", (username,))
+                row = c.fetchone()
+                return row[0] if row else None
         
         def account_settings(username):
-            c.execute("SELECT AccountSettings FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return row[0] if row else None
+            with db_pool.read() as c:
+                c.execute("SELECT AccountSettings FROM Users WHERE Username = ?", (username,))
+                row = c.fetchone()
+                return row[0] if row else None
         
         def password(username):
-            c.execute("SELECT Password FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return row[0] if row else None
+            with db_pool.read() as c:
+                c.execute("SELECT Password FROM Users WHERE Username = ?", (username,))
+                row = c.fetchone()
+                return row[0] if row else None
         
+        def meta(username):
+            """
+            Returns the cached Role, Banned and Avatar fields of a user, or
+            None if the user does not exist.
+            """
+
+            meta = user_meta_cache.get(username)
+            if meta is not None:
+                return meta
+            with db_pool.read() as c:
+                c.execute("SELECT Role, Banned, Avatar FROM Users WHERE Username = ?", (username,))
+                row = c.fetchone()
+            if not row:
+                return None
+            meta = {"Role": row["Role"], "Banned": row["Banned"], "Avatar": row["Avatar"]}
+            user_meta_cache.set(username, meta)
+            return meta
+
+        def meta_many(usernames):
+            """
+            Returns {username: meta} for several users, loading every user
+            missing from the cache with a single query.
+            """
+
+            result = {}
+            missing = []
+            for username in set(usernames):
+                meta = user_meta_cache.get(username)
+                if meta is None:
+                    missing.append(username)
+                else:
+                    result[username] = meta
+            if missing:
+                placeholders = ", ".join("?" for _ in missing)
+                with db_pool.read() as c:
+                    c.execute(f"SELECT Username, Role, Banned, Avatar FROM Users WHERE Username IN ({placeholders})", missing)
+                    rows = c.fetchall()
+                for row in rows:
+                    meta = {"Role": row["Role"], "Banned": row["Banned"], "Avatar": row["Avatar"]}
+                    user_meta_cache.set(row["Username"], meta)
+                    result[row["Username"]] = meta
+            return result
+
+        def avatar(username):
+            meta = User.Get.meta(username)
+            return meta["Avatar"] if meta else None
+
         def role(username):
-            c.execute("SELECT Role FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return row[0] if row else None
+            meta = User.Get.meta(username)
+            return meta["Role"] if meta else None
         
         def banned(username):
-            c.execute("SELECT Banned FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return row[0] if row else None
+            meta = User.Get.meta(username)
+            return meta["Banned"] if meta else None
         
         def ban_reason(username):
-            c.execute("SELECT BanReason FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return row[0] if row else None
+            with db_pool.read() as c:
+                c.execute("SELECT BanReason FROM Users WHERE Username = ?", (username,))
+                row = c.fetchone()
+                return row[0] if row else None
         
     class Check:
         def exists(username):
-            c.execute("SELECT * FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return True if row else False
+            return User.Get.meta(username) is not None
         
         def is_banned(username):
-            c.execute("SELECT Banned FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return True if row and row[0] == "True" else False
+            return User.Get.banned(username) == "True"
         
         def is_admin(username):
-            admin_roles = ["admin", "superadmin", "administrator", "mod", "moderator", "owner", "staff", "team"]
-            c.execute("SELECT Role FROM Users WHERE Username = ?", (username,))
-            row = c.fetchone()
-            return True if row and row[0] in admin_roles else False
+            return User.Get.role(username) in ADMIN_ROLES
         
 class Topics:
     class Core:
         def get_topic(id):
-            logger.log("Database.TopicsDatabase", f"Getting topic {id}")
-            c.execute("SELECT * FROM Topics WHERE ID = ?", (id,))
-            row = c.fetchone()
-            return dict(row) if row else None
+            logger.log("Database.TopicsDatabase", "Getting topic %s", id)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM Topics WHERE ID = ?", (id,))
+                row = c.fetchone()
+                return dict(row) if row else None
         
         def create_topic(id, name, description, admin_only, locked, archived):
-            logger.log("Database.TopicsDatabase", f"Creating topic {id}")
+            logger.log("Database.TopicsDatabase", "Creating topic %s", id)
             id = xss.sanitize_input_no_html(id)
             name = xss.sanitize_input_no_html(name)
             description = xss.sanitize_input_no_html(description)
@@ -161,11 +232,14 @@ class Topics:
             locked = xss.sanitize_input_no_html(locked)
             archived = xss.sanitize_input_no_html(archived)
             
-            c.execute("INSERT INTO Topics (ID, Name, Description, AdminOnly, Locked, Archived) VALUES (?, ?, ?, ?, ?, ?)", (id, name, description, admin_only, locked, archived))
-            conn.commit()
+            def write(c):
+                c.execute("INSERT INTO Topics (ID, Name, Description, AdminOnly, Locked, Archived) VALUES (?, ?, ?, ?, ?, ?)", (id, name, description, admin_only, locked, archived))
+                stats.increment(c, "topics")
+            write_queue.submit(write)
+            page_cache.pages.invalidate("topics", f"topic:{id}")
             
         def update_topic(id, name, description, admin_only, locked, archived):
-            logger.log("Database.TopicsDatabase", f"Updating topic {id}")
+            logger.log("Database.TopicsDatabase", "Updating topic %s", id)
             id = xss.sanitize_input_no_html(id)
             name = xss.sanitize_input_no_html(name)
             description = xss.sanitize_input_no_html(description)
@@ -173,32 +247,36 @@ class Topics:
             locked = xss.sanitize_input_no_html(locked)
             archived = xss.sanitize_input_no_html(archived)
             
-            c.execute("UPDATE Topics SET Name = ?, Description = ?, AdminOnly = ?, Locked = ?, Archived = ? WHERE ID = ?", (name, description, admin_only, locked, archived, id))
-            conn.commit()
+            write_queue.execute("UPDATE Topics SET Name = ?, Description = ?, AdminOnly = ?, Locked = ?, Archived = ? WHERE ID = ?", (name, description, admin_only, locked, archived, id))
+            page_cache.pages.invalidate("topics", f"topic:{id}")
         
         def get_all_topics():
             logger.log("Database.TopicsDatabase", "Getting all topics")
-            c.execute("SELECT * FROM Topics")
-            rows = c.fetchall()
-            return [dict(row) for row in rows]
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM Topics")
+                rows = c.fetchall()
+                return [dict(row) for row in rows]
         
         def get_topic_by_admin_only(admin_only):
-            logger.log("Database.TopicsDatabase", f"Getting topics with admin only status {admin_only}")
-            c.execute("SELECT * FROM Topics WHERE AdminOnly = ?", (admin_only,))
-            rows = c.fetchall()
-            return [dict(row) for row in rows]
+            logger.log("Database.TopicsDatabase", "Getting topics with admin only status %s", admin_only)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM Topics WHERE AdminOnly = ?", (admin_only,))
+                rows = c.fetchall()
+                return [dict(row) for row in rows]
         
         def get_topic_by_locked(locked):
-            logger.log("Database.TopicsDatabase", f"Getting topics with locked status {locked}")
-            c.execute("SELECT * FROM Topics WHERE Locked = ?", (locked,))
-            rows = c.fetchall()
-            return [dict(row) for row in rows]
+            logger.log("Database.TopicsDatabase", "Getting topics with locked status %s", locked)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM Topics WHERE Locked = ?", (locked,))
+                rows = c.fetchall()
+                return [dict(row) for row in rows]
         
         def get_topic_by_archived(archived):
-            logger.log("Database.TopicsDatabase", f"Getting topics with archived status {archived}")
-            c.execute("SELECT * FROM Topics WHERE Archived = ?", (archived,))
-            rows = c.fetchall()
-            return [dict(row) for row in rows]
+            logger.log("Database.TopicsDatabase", "Getting topics with archived status %s", archived)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM Topics WHERE Archived = ?", (archived,))
+                rows = c.fetchall()
+                return [dict(row) for row in rows]
 
 class PublicPosts:
     class Core:
@@ -207,71 +285,129 @@ class PublicPosts:
             author = xss.sanitize_input_no_html(author)
             topic = xss.sanitize_input_no_html(topic)
             body = xss.sanitize_markdown_input(body)
-            logger.log("Database.PublicPostsDatabase", f"Adding post {id} -> {title} by {author}")
-            c.execute("""
-                INSERT INTO PublicPosts (ID, Title, Author, Timestamp, Topic, Body, Attachments, Score, Deleted, Archived, RepliesLocked, Replies)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (id, title, author, timestamp, topic, body, attachments, score, deleted, archived, replies_locked, replies)
-            )
-            conn.commit()
+            logger.log("Database.PublicPostsDatabase", "Adding post %s -> %s by %s", id, title, author)
+            def write(c):
+                c.execute("""
+                    INSERT OR IGNORE INTO PublicPosts (ID, Title, Author, Timestamp, Topic, Body, Attachments, Score, Deleted, Archived, RepliesLocked, Replies, CreatedAt)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (id, title, author, timestamp, topic, body, attachments, score, deleted, archived, replies_locked, replies, timefmt.to_epoch(timestamp))
+                )
+                if c.rowcount:
+                    search.index_post(c, id, title, author, timestamp, topic, body)
+                    stats.increment(c, "posts")
+            write_queue.submit(write)
+            # A new post shifts every page of the listings it appears in
+            page_cache.pages.invalidate("posts", f"topic:{topic}")
         
         def delete_post(id):
-            logger.log("Database.PublicPostsDatabase", f"Deleting post {id}")
-            c.execute("DELETE FROM PublicPosts WHERE ID = ?", (id,))
-            conn.commit()
+            logger.log("Database.PublicPostsDatabase", "Deleting post %s", id)
+            def write(c):
+                c.execute("DELETE FROM PublicPosts WHERE ID = ? RETURNING Topic", (id,))
+                row = c.fetchone()
+                search.remove_post(c, id)
+                if row:
+                    stats.increment(c, "posts", -1)
+                return row
+            row = write_queue.submit(write)
+            if row:
+                # Removing a post shifts every later page of its listings
+                page_cache.pages.invalidate("posts", f"topic:{row['Topic']}", f"post:{id}")
 
         def get_post(id):
-            logger.log("Database.PublicPostsDatabase", f"Getting post {id}")
-            c.execute("SELECT * FROM PublicPosts WHERE ID = ?", (id,))
-            row = c.fetchone()
-            return dict(row) if row else None
+            logger.log("Database.PublicPostsDatabase", "Getting post %s", id)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM PublicPosts WHERE ID = ?", (id,))
+                row = c.fetchone()
+                return dict(row) if row else None
+
+        def get_reply_count(id):
+            with db_pool.read() as c:
+                c.execute("SELECT ReplyCount FROM PublicPosts WHERE ID = ?", (id,))
+                row = c.fetchone()
+                return row["ReplyCount"] if row else None
 
         def get_all_posts():
             logger.log("Database.PublicPostsDatabase", "Getting all posts")
-            c.execute("SELECT * FROM PublicPosts ORDER BY Timestamp DESC")
-            return [dict(row) for row in c.fetchall()]
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM PublicPosts ORDER BY Timestamp DESC")
+                return [dict(row) for row in c.fetchall()]
 
         def get_posts_by_user(author):
-            logger.log("Database.PublicPostsDatabase", f"Getting posts by {author}")
-            c.execute("SELECT * FROM PublicPosts WHERE Author = ? ORDER BY Timestamp DESC", (author,))
-            return [dict(row) for row in c.fetchall()]
+            logger.log("Database.PublicPostsDatabase", "Getting posts by %s", author)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM PublicPosts WHERE Author = ? ORDER BY Timestamp DESC", (author,))
+                return [dict(row) for row in c.fetchall()]
         
         def get_posts_by_topic(topic, page=0):
-            logger.log("Database.PublicPostsDatabase", f"Getting posts by topic {topic} -> {page}")
-            c.execute("SELECT * FROM PublicPosts WHERE Topic = ? ORDER BY Timestamp DESC LIMIT 20 OFFSET ?", (topic, page * 20))
-            return [dict(row) for row in c.fetchall()]
+            logger.log("Database.PublicPostsDatabase", "Getting posts by topic %s -> %s", topic, page)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM PublicPosts WHERE Topic = ? ORDER BY Timestamp DESC, ID DESC LIMIT 20 OFFSET ?", (topic, page * 20))
+                return [dict(row) for row in c.fetchall()]
 
         def get_post_by_page(page):
-            logger.log("Database.PublicPostsDatabase", f"Getting posts by page {page}")
-            c.execute("SELECT * FROM PublicPosts ORDER BY Timestamp DESC LIMIT 20 OFFSET ?", (page * 20,))
-            return [dict(row) for row in c.fetchall()]
+            logger.log("Database.PublicPostsDatabase", "Getting posts by page %s", page)
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM PublicPosts ORDER BY Timestamp DESC, ID DESC LIMIT 20 OFFSET ?", (page * 20,))
+                return [dict(row) for row in c.fetchall()]
+
+        def get_posts_after(timestamp, id, topic=None, limit=20):
+            """
+            Returns up to limit posts older than (timestamp, id), newest first.
+            """
+
+            logger.log("Database.PublicPostsDatabase", "Getting posts after %s %s in %s", timestamp, id, topic)
+            with db_pool.read() as c:
+                if topic is None:
+                    c.execute("SELECT * FROM PublicPosts WHERE (Timestamp, ID) < (?, ?) ORDER BY Timestamp DESC, ID DESC LIMIT ?", (timestamp, id, limit))
+                else:
+                    c.execute("SELECT * FROM PublicPosts WHERE Topic = ? AND (Timestamp, ID) < (?, ?) ORDER BY Timestamp DESC, ID DESC LIMIT ?", (topic, timestamp, id, limit))
+                return [dict(row) for row in c.fetchall()]
+
+        def get_posts_before(timestamp, id, topic=None, limit=20):
+            """
+            Returns up to limit posts newer than (timestamp, id), newest first.
+            """
+
+            logger.log("Database.PublicPostsDatabase", "Getting posts before %s %s in %s", timestamp, id, topic)
+            with db_pool.read() as c:
+                if topic is None:
+                    c.execute("SELECT * FROM PublicPosts WHERE (Timestamp, ID) > (?, ?) ORDER BY Timestamp ASC, ID ASC LIMIT ?", (timestamp, id, limit))
+                else:
+                    c.execute("SELECT * FROM PublicPosts WHERE Topic = ? AND (Timestamp, ID) > (?, ?) ORDER BY Timestamp ASC, ID ASC LIMIT ?", (topic, timestamp, id, limit))
+                return [dict(row) for row in reversed(c.fetchall())]
 
     class Set:
         def lock_replies(id, lock_status="True"):
-            c.execute("UPDATE PublicPosts SET RepliesLocked = ? WHERE ID = ?", (lock_status, id))
-            conn.commit()
+            write_queue.execute("UPDATE PublicPosts SET RepliesLocked = ? WHERE ID = ?", (lock_status, id))
 
         def archive(id):
-            c.execute("UPDATE PublicPosts SET Archived = 'True' WHERE ID = ?", (id,))
-            conn.commit()
+            write_queue.execute("UPDATE PublicPosts SET Archived = 'True' WHERE ID = ?", (id,))
 
         def soft_delete(id):
-            c.execute("UPDATE PublicPosts SET Deleted = 'True' WHERE ID = ?", (id,))
-            conn.commit()
+            def write(c):
+                c.execute("UPDATE PublicPosts SET Deleted = 'True' WHERE ID = ? RETURNING Topic, Author", (id,))
+                return c.fetchone()
+            row = write_queue.submit(write)
+            if row:
+                # Every listing showing the post links to it
+                page_cache.pages.invalidate("posts", f"topic:{row['Topic']}", f"user:{row['Author']}", f"post:{id}")
 
         def update_score(id, score):
-            c.execute("UPDATE PublicPosts SET Score = ? WHERE ID = ?", (score, id))
-            conn.commit()
+            write_queue.execute("UPDATE PublicPosts SET Score = ? WHERE ID = ?", (score, id))
 
         def update_body(id, body):
             body = xss.sanitize_markdown_input(body)
-            c.execute("UPDATE PublicPosts SET Body = ? WHERE ID = ?", (body, id))
-            conn.commit()
+            def write(c):
+                c.execute("UPDATE PublicPosts SET Body = ? WHERE ID = ?", (body, id))
+                search.update_post_body(c, id, body)
+            write_queue.submit(write)
+            page_cache.pages.invalidate(f"post:{id}")
 
     class Check:
         def exists(id):
-            c.execute("SELECT * FROM PublicPosts WHERE ID = ?", (id,))
-            return c.fetchone() is not None
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM PublicPosts WHERE ID = ?", (id,))
+                return c.fetchone() is not None
 
 class PublicPostReplies:
     class Core:
@@ -279,59 +415,208 @@ class PublicPostReplies:
             author = xss.sanitize_input_no_html(author)
             body = xss.sanitize_markdown_input(body)
 
-            logger.log("Database.PublicPostsRepliesDatabase", f"Adding reply {reply_id} by {author}")
-            c.execute("""
-                INSERT INTO PublicPostsReplies (ID, PostID, Author, Timestamp, Body)
-                VALUES (?, ?, ?, ?, ?)""", 
-                (reply_id, post_id, author, timestamp, body)
-            )
-            c.execute("SELECT Replies FROM PublicPosts WHERE ID = ?", (post_id,))
-            replies = c.fetchone()[0]
-            if replies == "":
-                replies = reply_id
-            else:
-                replies += "," + reply_id
-            c.execute("UPDATE PublicPosts SET Replies = ? WHERE ID = ?", (replies, post_id))
-            conn.commit()
+            logger.log("Database.PublicPostsRepliesDatabase", "Adding reply %s by %s", reply_id, author)
+            def write(c):
+                c.execute("""
+                    INSERT OR IGNORE INTO PublicPostsReplies (ID, PostID, Author, Timestamp, Body, CreatedAt)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                    (reply_id, post_id, author, timestamp, body, timefmt.to_epoch(timestamp))
+                )
+                if c.rowcount == 0:
+                    return False
+                c.execute("UPDATE PublicPosts SET ReplyCount = ReplyCount + 1 WHERE ID = ?", (post_id,))
+                search.index_reply(c, reply_id, post_id, author, timestamp, body)
+                stats.increment(c, "replies")
+                return True
+            if not write_queue.submit(write):
+                return
+            page_cache.pages.invalidate(f"post:{post_id}")
 
         def get_replies(post_id):
-            c.execute("SELECT * FROM PublicPosts WHERE ID = ?", (post_id,))
-            row = c.fetchone()
-            replies = row['Replies']
-            replies = replies.split(",") if replies else []
-            if not replies:
-                return []
-            if replies[0] == "":
+            with db_pool.read() as c:
+                c.execute("SELECT ID, Author, Body, Timestamp, CreatedAt FROM PublicPostsReplies WHERE PostID = ? ORDER BY Timestamp, ID", (post_id,))
+                rows = c.fetchall()
+            if not rows:
                 return []
             ret = {
                 "ReplyID": [],
                 "Author": [],
                 "Body": [],
-                "Timestamp": []
+                "Timestamp": [],
+                "CreatedAt": []
             }
-            for reply_id in replies:
-                c.execute("SELECT * FROM PublicPostsReplies WHERE ID = ?", (reply_id,))
-                row = c.fetchone()
-                if row:
-                    ret["ReplyID"].append(row["ID"])
-                    ret["Author"].append(row["Author"])
-                    ret["Body"].append(row["Body"])
-                    ret["Timestamp"].append(row["Timestamp"])
-            
+            for row in rows:
+                ret["ReplyID"].append(row["ID"])
+                ret["Author"].append(row["Author"])
+                ret["Body"].append(row["Body"])
+                ret["Timestamp"].append(row["Timestamp"])
+                ret["CreatedAt"].append(row["CreatedAt"])
             return ret
 
+        def get_replies_after(post_id, timestamp=None, reply_id=None, limit=100):
+            """
+            Returns up to limit replies to a post that come after (timestamp,
+            reply_id) in thread order, or the first ones when timestamp is None.
+            """
+
+            with db_pool.read() as c:
+                if timestamp is None:
+                    c.execute("SELECT ID, Author, Body, Timestamp, CreatedAt FROM PublicPostsReplies WHERE PostID = ? ORDER BY Timestamp, ID LIMIT ?", (post_id, limit))
+                else:
+                    c.execute("SELECT ID, Author, Body, Timestamp, CreatedAt FROM PublicPostsReplies WHERE PostID = ? AND (Timestamp, ID) > (?, ?) ORDER BY Timestamp, ID LIMIT ?", (post_id, timestamp, reply_id, limit))
+                return [dict(row) for row in c.fetchall()]
+
+        def get_reply_before(post_id, timestamp, reply_id, offset=0):
+            """
+            Returns the Timestamp and ID of the reply offset places before
+            (timestamp, reply_id) in thread order, or None.
+            """
+
+            with db_pool.read() as c:
+                c.execute("SELECT Timestamp, ID FROM PublicPostsReplies WHERE PostID = ? AND (Timestamp, ID) < (?, ?) ORDER BY Timestamp DESC, ID DESC LIMIT 1 OFFSET ?", (post_id, timestamp, reply_id, offset))
+                row = c.fetchone()
+                return (row["Timestamp"], row["ID"]) if row else None
+
+        def get_reply_position(post_id, timestamp, reply_id):
+            """
+            Returns how many replies to a post come before (timestamp, reply_id).
+            """
+
+            with db_pool.read() as c:
+                c.execute("SELECT COUNT(*) FROM PublicPostsReplies WHERE PostID = ? AND (Timestamp, ID) < (?, ?)", (post_id, timestamp, reply_id))
+                return c.fetchone()[0]
 
-        
         def get_reply(reply_id):
-            c.execute("SELECT * FROM PublicPostsReplies WHERE ID = ?", (reply_id,))
-            row = c.fetchone()
-            return dict(row) if row else None
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM PublicPostsReplies WHERE ID = ?", (reply_id,))
+                row = c.fetchone()
+                return dict(row) if row else None
 
         def delete_reply(reply_id):
-            c.execute("DELETE FROM PublicPostsReplies WHERE ID = ?", (reply_id,))
-            conn.commit()
+            def write(c):
+                c.execute("SELECT PostID FROM PublicPostsReplies WHERE ID = ?", (reply_id,))
+                row = c.fetchone()
+                if not row:
+                    return None
+                c.execute("DELETE FROM PublicPostsReplies WHERE ID = ?", (reply_id,))
+                search.remove_reply(c, reply_id)
+                stats.increment(c, "replies", -1)
+                c.execute("UPDATE PublicPosts SET ReplyCount = ReplyCount - 1 WHERE ID = ? AND ReplyCount > 0", (row["PostID"],))
+                return row["PostID"]
+            post_id = write_queue.submit(write)
+            if post_id:
+                page_cache.pages.invalidate(f"post:{post_id}")
 
     class Check:
         def exists(reply_id):
-            c.execute("SELECT * FROM PublicPostsReplies WHERE ID = ?", (reply_id,))
-            return c.fetchone() is not None
+            with db_pool.read() as c:
+                c.execute("SELECT * FROM PublicPostsReplies WHERE ID = ?", (reply_id,))
+                return c.fetchone() is not None
+
+class DirectMessages:
+    # Which messages each mailbox lists, every one is read newest first from
+    # its own index
+    MAILBOXES = {
+        "inbox": "Recipient = ?",
+        "unread": "Recipient = ? AND ReadByRecipient = 'False'",
+        "sent": "Sender = ?",
+    }
+    COLUMNS = "ID, Sender, Recipient, Timestamp, Body, ReadByRecipient, CreatedAt"
+
+    class Core:
+        def send_message(id, sender, recipient, timestamp, body):
+            body = xss.sanitize_markdown_input(body)
+            logger.log("Database.DirectMessagesDatabase", "Sending message %s from %s to %s", id, sender, recipient)
+            def write(c):
+                c.execute("""
+                    INSERT OR IGNORE INTO DirectMessages (ID, Sender, Recipient, Timestamp, Body, ReadByRecipient, Replies, CreatedAt)
+                    VALUES (?, ?, ?, ?, ?, 'False', '', ?)""",
+                    (id, sender, recipient, timestamp, body, timefmt.to_epoch(timestamp))
+                )
+                if c.rowcount:
+                    c.execute("UPDATE Users SET UnreadMail = UnreadMail + 1 WHERE Username = ?", (recipient,))
+            write_queue.submit(write)
+            unread_mail_cache.pop(recipient)
+
+        def get_message(id):
+            with db_pool.read() as c:
+                c.execute(f"SELECT {DirectMessages.COLUMNS} FROM DirectMessages WHERE ID = ?", (id,))
+                row = c.fetchone()
+                return dict(row) if row else None
+
+        def get_mail_after(username, mailbox, timestamp=None, id=None, limit=20):
+            """
+            Returns up to limit messages from a mailbox ("inbox", "unread" or
+            "sent") older than (timestamp, id), newest first. Starts at the
+            newest message when timestamp is None.
+            """
+
+            where = DirectMessages.MAILBOXES[mailbox]
+            with db_pool.read() as c:
+                if timestamp is None:
+                    c.execute(f"SELECT {DirectMessages.COLUMNS} FROM DirectMessages WHERE {where} ORDER BY Timestamp DESC, ID DESC LIMIT ?", (username, limit))
+                else:
+                    c.execute(f"SELECT {DirectMessages.COLUMNS} FROM DirectMessages WHERE {where} AND (Timestamp, ID) < (?, ?) ORDER BY Timestamp DESC, ID DESC LIMIT ?", (username, timestamp, id, limit))
+                return [dict(row) for row in c.fetchall()]
+
+        def get_mail_before(username, mailbox, timestamp, id, limit=20):
+            """
+            Returns up to limit messages from a mailbox newer than (timestamp,
+            id), newest first.
+            """
+
+            where = DirectMessages.MAILBOXES[mailbox]
+            with db_pool.read() as c:
+                c.execute(f"SELECT {DirectMessages.COLUMNS} FROM DirectMessages WHERE {where} AND (Timestamp, ID) > (?, ?) ORDER BY Timestamp ASC, ID ASC LIMIT ?", (username, timestamp, id, limit))
+                return [dict(row) for row in reversed(c.fetchall())]
+
+    class Set:
+        def mark_read(username, ids):
+            """
+            Marks the given messages to username as read with one update per
+            500 IDs and adjusts the unread counter to match.
+            """
+
+            ids = list(dict.fromkeys(ids))
+            if not ids:
+                return 0
+            def write(c):
+                marked = 0
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    placeholders = ", ".join("?" for _ in chunk)
+                    c.execute(f"UPDATE DirectMessages SET ReadByRecipient = 'True' WHERE Recipient = ? AND ReadByRecipient = 'False' AND ID IN ({placeholders})", [username] + chunk)
+                    marked += c.rowcount
+                if marked:
+                    c.execute("UPDATE Users SET UnreadMail = MAX(UnreadMail - ?, 0) WHERE Username = ?", (marked, username))
+                return marked
+            marked = write_queue.submit(write)
+            unread_mail_cache.pop(username)
+            return marked
+
+        def mark_all_read(username):
+            def write(c):
+                c.execute("UPDATE DirectMessages SET ReadByRecipient = 'True' WHERE Recipient = ? AND ReadByRecipient = 'False'", (username,))
+                marked = c.rowcount
+                c.execute("UPDATE Users SET UnreadMail = 0 WHERE Username = ?", (username,))
+                return marked
+            marked = write_queue.submit(write)
+            unread_mail_cache.pop(username)
+            return marked
+
+    class Get:
+        def unread_count(username):
+            count = unread_mail_cache.get(username)
+            if count is not None:
+                return count
+            with db_pool.read() as c:
+                c.execute("SELECT UnreadMail FROM Users WHERE Username = ?", (username,))
+                row = c.fetchone()
+            count = row["UnreadMail"] if row else 0
+            unread_mail_cache.set(username, count)
+            return count
+
+metrics.track_cache("user_meta", user_meta_cache)
+metrics.track_cache("unread_mail", unread_mail_cache)
+for namespace in (User, Topics, PublicPosts, PublicPostReplies, DirectMessages):
+    metrics.instrument(namespace)
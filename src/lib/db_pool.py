@@ -0,0 +1,131 @@
+import sqlite3
+import threading
+import os
+from contextlib import contextmanager
+
+from . import logger
+
+DB_PATH = os.environ.get("NEXO_DB_PATH", "data/nexo.db")
+
+# Applied to every connection. WAL lets readers run alongside the single
+# writer, busy_timeout makes writers from other processes wait instead of
+# failing with "database is locked".
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": "-16000",
+    "mmap_size": "268435456",
+    "busy_timeout": "5000",
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+}
+
+_local = threading.local()
+_write_lock = threading.RLock()
+_write_conn = None
+
+def _connect(read_only=False):
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+def read_connection():
+    """
+    Returns the read-only connection owned by the calling thread, opening it
+    on first use.
+    """
+
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        logger.debug("Database.Pool", "Opening read connection for thread %s", threading.get_ident())
+        conn = _connect(read_only=True)
+        _local.conn = conn
+    return conn
+
+def write_connection():
+    """
+    Returns the process wide writer connection. Callers must hold the write
+    lock, use write() unless you know what you are doing.
+    """
+
+    global _write_conn
+    if _write_conn is None:
+        logger.debug("Database.Pool", "Opening write connection")
+        _write_conn = _connect()
+    return _write_conn
+
+@contextmanager
+def read():
+    """
+    Yields a cursor on the calling thread's read connection.
+    """
+
+    cursor = read_connection().cursor()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+@contextmanager
+def write():
+    """
+    Yields a cursor inside an IMMEDIATE transaction on the writer connection.
+    The transaction is committed when the block exits and rolled back if it
+    raises. Nested write() blocks join the outer transaction.
+    """
+
+    with _write_lock:
+        conn = write_connection()
+        nested = conn.in_transaction
+        cursor = conn.cursor()
+        if not nested:
+            cursor.execute("BEGIN IMMEDIATE")
+        _local.write_depth = getattr(_local, "write_depth", 0) + 1
+        try:
+            yield cursor
+        except BaseException:
+            if not nested:
+                conn.rollback()
+            raise
+        else:
+            if not nested:
+                conn.commit()
+        finally:
+            _local.write_depth -= 1
+            cursor.close()
+
+def in_write():
+    """
+    Returns whether the calling thread is inside a write() block.
+    """
+
+    return getattr(_local, "write_depth", 0) > 0
+
+def close():
+    """
+    Closes the writer connection and the calling thread's read connection.
+    """
+
+    global _write_conn
+    with _write_lock:
+        if _write_conn is not None:
+            _write_conn.close()
+            _write_conn = None
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+def _after_fork():
+    # SQLite connections must not be used across fork. The child forgets
+    # the ones it inherited and opens its own on first use.
+    global _local, _write_lock, _write_conn
+    _local = threading.local()
+    _write_lock = threading.RLock()
+    _write_conn = None
+
+os.register_at_fork(after_in_child=_after_fork)
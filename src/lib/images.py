@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+from starlette.formparsers import MultiPartParser
+
+# Profile pictures are decoded once in a worker process and stored as fixed
+# size square thumbnails under AVATAR_DIR/<hash>/<size>.<format>. The hash
+# is taken over the uploaded bytes, so the same upload is only processed
+# and stored once and a URL never changes what it points to.
+AVATAR_DIR = os.environ.get("NEXO_AVATAR_DIR", "data/avatars")
+MAX_UPLOAD_BYTES = int(os.environ.get("NEXO_AVATAR_MAX_BYTES", str(5 * 1024 * 1024)))
+MAX_PIXELS = int(os.environ.get("NEXO_AVATAR_MAX_PIXELS", str(4096 * 4096)))
+WORKERS = int(os.environ.get("NEXO_IMAGE_WORKERS", "2"))
+CHUNK_SIZE = 64 * 1024
+# Room for the multipart boundaries and part headers around the file
+FORM_OVERHEAD = 64 * 1024
+
+SIZES = (64, 128)
+FORMATS = {
+    "webp": "image/webp",
+    "png": "image/png",
+}
+ALLOWED_SOURCE_FORMATS = {"PNG", "JPEG", "GIF", "WEBP"}
+# Part of every hash, bump it when the thumbnails change so old ones are
+# not reused
+PIPELINE_VERSION = "1"
+
+_HASH = re.compile(r"^[0-9a-f]{32}$")
+
+class ImageError(ValueError):
+    pass
+
+class ImageTooLarge(ImageError):
+    pass
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def _init_worker():
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+
+def _get_pool():
+    # Worker processes are spawned rather than forked from a process that
+    # is already running threads, and a forked server worker gets its own.
+    # A spawned process imports the parent's __main__ again, which is
+    # src/serve.py: it imports nothing of the app at the top, so the
+    # workers only load this module. src/main.py hands over to serve.py
+    # when run directly for the same reason.
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker)
+            _pool_pid = os.getpid()
+        return _pool
+
+async def _run_in_pool(func, *args):
+    return await asyncio.wrap_future(_get_pool().submit(func, *args))
+
+def image_hash(data):
+    return hashlib.sha256(PIPELINE_VERSION.encode() + data).hexdigest()[:32]
+
+def avatar_path(avatar, size, fmt):
+    """
+    Returns the path of a stored thumbnail, or None if the arguments do not
+    name one.
+    """
+
+    if not _HASH.match(avatar or "") or size not in SIZES or fmt not in FORMATS:
+        return None
+    return os.path.join(AVATAR_DIR, avatar, f"{size}.{fmt}")
+
+def avatar_url(avatar, size=128, fmt="webp"):
+    return f"/avatar/{avatar}/{size}.{fmt}"
+
+async def read_form(request, limit=MAX_UPLOAD_BYTES):
+    """
+    Parses a multipart upload form from the request body as it arrives.
+    Raises ImageTooLarge from the Content-Length, or as soon as more than
+    limit bytes plus the form overhead were received, so an oversized
+    upload is never received in full.
+    """
+
+    too_large = ImageTooLarge(f"Images can be at most {limit // 1024 // 1024}MB")
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit + FORM_OVERHEAD:
+        raise too_large
+
+    async def stream():
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > limit + FORM_OVERHEAD:
+                raise too_large
+            yield chunk
+
+    parser = MultiPartParser(request.headers, stream(), max_files=1, max_fields=8)
+    try:
+        return await parser.parse()
+    except ImageTooLarge:
+        # The parts spooled to temporary files so far belong to no form the
+        # caller could close
+        for file in parser._files_to_close_on_error:
+            file.close()
+        raise
+
+async def read_upload(upload, limit=MAX_UPLOAD_BYTES):
+    """
+    Reads an UploadFile in chunks, raising ImageTooLarge as soon as it goes
+    over limit bytes instead of reading all of it.
+    """
+
+    buffer = io.BytesIO()
+    while chunk := await upload.read(CHUNK_SIZE):
+        if buffer.tell() + len(chunk) > limit:
+            raise ImageTooLarge(f"Images can be at most {limit // 1024 // 1024}MB")
+        buffer.write(chunk)
+    return buffer.getvalue()
+
+def make_thumbnails(data):
+    """
+    Decodes an image and returns {(size, format): bytes} for every thumbnail.
+    Runs in a worker process.
+    """
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.format not in ALLOWED_SOURCE_FORMATS:
+                raise ImageError("Only PNG, JPEG, GIF and WebP images are allowed")
+            image.seek(0)
+            image = ImageOps.exif_transpose(image).convert("RGBA")
+    except ImageError:
+        raise
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ImageError(f"Could not read the image: {e}")
+
+    thumbnails = {}
+    for size in SIZES:
+        thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        for fmt in FORMATS:
+            out = io.BytesIO()
+            if fmt == "webp":
+                thumbnail.save(out, "WEBP", quality=85, method=4)
+            else:
+                thumbnail.save(out, "PNG", optimize=True)
+            thumbnails[(size, fmt)] = out.getvalue()
+    return thumbnails
+
+def store_thumbnails(avatar, thumbnails):
+    # Written to a temporary directory and renamed into place so a request
+    # never sees a half written set
+    final = os.path.join(AVATAR_DIR, avatar)
+    if os.path.isdir(final):
+        return
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=AVATAR_DIR, prefix=".tmp-")
+    try:
+        for (size, fmt), body in thumbnails.items():
+            with open(os.path.join(tmp, f"{size}.{fmt}"), "wb") as file:
+                file.write(body)
+        os.rename(tmp, final)
+    except OSError:
+        # Another request stored the same image first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(final):
+            raise
+
+async def process_image(data):
+    """
+    Decodes and stores an image unless the same bytes were stored before.
+    Returns its hash, raises ImageError if it is not a usable image.
+    """
+
+    if not data:
+        raise ImageError("The file is empty")
+    avatar = image_hash(data)
+    if os.path.isdir(os.path.join(AVATAR_DIR, avatar)):
+        return avatar
+    thumbnails = await _run_in_pool(make_thumbnails, data)
+    await asyncio.get_running_loop().run_in_executor(None, store_thumbnails, avatar, thumbnails)
+    return avatar
+
+async def process_upload(upload):
+    """
+    Reads and stores an uploaded profile picture. Returns its hash.
+    Raises ImageError if the upload is too large or not a usable image.
+    """
+
+    return await process_image(await read_upload(upload))
+
+def read_legacy(path):
+    with open(path, "rb") as file:
+        return file.read(MAX_UPLOAD_BYTES + 1)
+
+async def process_legacy(path):
+    """
+    Stores a profile picture saved before thumbnails existed. Returns its
+    hash, or None if there is no usable file at path.
+    """
+
+    loop = asyncio.get_running_loop()
+    try:
+        data = await loop.run_in_executor(None, read_legacy, path)
+        if len(data) > MAX_UPLOAD_BYTES:
+            return None
+        return await process_image(data)
+    except (OSError, ImageError):
+        return None
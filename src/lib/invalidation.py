@@ -0,0 +1,109 @@
+import mmap
+import multiprocessing
+import os
+import threading
+
+# Caches are local to a process. With several worker processes (see
+# src/serve.py) a write made in one worker has to drop the entries it
+# affects in every other worker too, not only in its own. Every
+# invalidation is appended to a ring in shared memory, and every process
+# replays the ones made by other processes on its own caches before a cache
+# lookup. The ring and its lock are created when lib is imported, before
+# the workers are forked, so they are inherited by all of them. A process
+# that fell more than RING_SIZE invalidations behind clears its caches.
+# A reloaded master creates a new ring, so during a reload the old workers
+# that are still finishing up do not see the new workers' invalidations.
+RING_SIZE = int(os.environ.get("NEXO_INVALIDATION_RING_SIZE", "4096"))
+SLOT_BYTES = 128
+# Slot layout: pid (4 bytes), payload length (2 bytes), payload
+_HEADER_BYTES = 6
+_SEQUENCE_BYTES = 8
+
+class Channel:
+    """
+    A shared ring of (cache name, key) invalidations.
+
+    Args:
+        size (int): Invalidations kept for processes that are behind.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        # Anonymous mappings are shared with forked children
+        self.memory = mmap.mmap(-1, _SEQUENCE_BYTES + size * SLOT_BYTES)
+        self.write_lock = multiprocessing.Lock()
+        self.lock = threading.Lock()
+        self.caches = {}
+        self.seen = 0
+
+    def register(self, name, invalidate, clear):
+        """
+        Replays invalidations of the cache called name from other processes
+        with invalidate(key), and with clear() when keys were missed.
+        """
+
+        self.caches[name] = (invalidate, clear)
+
+    def sequence(self):
+        return int.from_bytes(self.memory[:_SEQUENCE_BYTES], "little")
+
+    def publish(self, name, key=""):
+        """
+        Tells the other processes to drop key from the cache called name,
+        or the whole cache if key is empty.
+        """
+
+        payload = f"{name}\0{key}".encode()
+        if len(payload) > SLOT_BYTES - _HEADER_BYTES:
+            # Too long to pass on, the other processes drop everything
+            payload = f"{name}\0".encode()
+        with self.write_lock:
+            sequence = self.sequence()
+            offset = _SEQUENCE_BYTES + (sequence % self.size) * SLOT_BYTES
+            self.memory[offset:offset + _HEADER_BYTES + len(payload)] = os.getpid().to_bytes(4, "little") + len(payload).to_bytes(2, "little") + payload
+            self.memory[:_SEQUENCE_BYTES] = (sequence + 1).to_bytes(_SEQUENCE_BYTES, "little")
+
+    def poll(self):
+        """
+        Replays the invalidations published by other processes since the
+        last poll. Cheap when there are none.
+        """
+
+        if self.sequence() == self.seen:
+            return
+        with self.lock:
+            start = self.seen
+            end = self.sequence()
+            if end - start > self.size:
+                self.clear_all()
+                self.seen = end
+                return
+            pid = os.getpid()
+            messages = []
+            for sequence in range(start, end):
+                offset = _SEQUENCE_BYTES + (sequence % self.size) * SLOT_BYTES
+                header = self.memory[offset:offset + _HEADER_BYTES]
+                if int.from_bytes(header[:4], "little") == pid:
+                    continue
+                length = int.from_bytes(header[4:], "little")
+                messages.append(self.memory[offset + _HEADER_BYTES:offset + _HEADER_BYTES + length])
+            # The ring may have wrapped over the slots while they were read
+            if self.sequence() - start > self.size:
+                self.clear_all()
+            else:
+                for message in messages:
+                    name, _, key = message.decode().partition("\0")
+                    invalidate, clear = self.caches.get(name, (None, None))
+                    if invalidate is None:
+                        continue
+                    if key:
+                        invalidate(key)
+                    else:
+                        clear()
+            self.seen = end
+
+    def clear_all(self):
+        for invalidate, clear in self.caches.values():
+            clear()
+
+channel = Channel()
@@ -1,5 +1,17 @@
 from datetime import datetime
 
+import atexit
+import fcntl
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+from . import metrics
+
 class Status:
     warning_count = 0
     error_count = 0
@@ -11,52 +23,259 @@ class Color:
     BLUE = "\033[94m"
     RESET = "\033[0m"
 
-def debug(component, message):
+class Level:
+    DEBUG = 10
+    LOG = 20
+    WARN = 30
+    ERROR = 40
+
+LEVEL_NAMES = {Level.DEBUG: "DEBUG", Level.LOG: "LOG", Level.WARN: "WARN", Level.ERROR: "ERROR"}
+LEVEL_COLORS = {Level.DEBUG: Color.BLUE, Level.LOG: Color.GREEN, Level.WARN: Color.YELLOW, Level.ERROR: Color.RED}
+
+def _parse_sampling(value):
+    # "Database=0.1,SessionManager=0.01" -> {"Database": 0.1, "SessionManager": 0.01}
+    rates = {}
+    for item in value.split(","):
+        if "=" in item:
+            component, rate = item.split("=", 1)
+            rates[component.strip()] = float(rate)
+    return rates
+
+# Messages below LEVEL are dropped before they are formatted.
+LEVEL = getattr(Level, os.environ.get("NEXO_LOG_LEVEL", "LOG").upper(), Level.LOG)
+CONSOLE = os.environ.get("NEXO_LOG_CONSOLE", "1") == "1"
+LOG_DIR = os.environ.get("NEXO_LOG_DIR", "data/logs")
+LOG_FILE = "nexo.jsonl"
+MAX_BYTES = int(os.environ.get("NEXO_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+BACKUP_COUNT = int(os.environ.get("NEXO_LOG_BACKUPS", "5"))
+# Fraction of LOG and DEBUG messages kept per component prefix, warnings
+# and errors are never sampled.
+SAMPLING = _parse_sampling(os.environ.get("NEXO_LOG_SAMPLE", ""))
+
+# Seconds between checks that the log file was not rotated by another process
+REOPEN_CHECK_INTERVAL = 1
+
+class Writer:
+    """
+    Formats and writes queued log records on a background thread, to the
+    console and to a rotating JSON lines file in LOG_DIR.
+
+    Several worker processes append to the same file. Every batch of lines
+    goes out in a single write so lines from different processes do not
+    interleave, rotation happens under a lock file and only once, and every
+    process reopens the file when another one rotated it.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.pid = None
+        self.file = None
+        self.lines = []
+        self.next_reopen_check = 0
+        self.lock = threading.Lock()
+        # Process that writes its records on the calling thread, see run_inline()
+        self.inline_pid = None
+
+    def put(self, record):
+        if self.inline_pid == os.getpid():
+            with self.lock:
+                self.write(record)
+                self.flush()
+            return
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put(record)
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # Started lazily and again after a fork, threads do not survive it
+            self.queue = queue.SimpleQueue()
+            self.file = None
+            self.lines = []
+            self.thread = threading.Thread(target=self.run, name="nexo-logger", daemon=True)
+            self.pid = os.getpid()
+            self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.write(record)
+                while True:
+                    try:
+                        record = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is None:
+                        self.flush()
+                        return
+                    self.write(record)
+                self.flush()
+            except Exception as e:
+                sys.stderr.write(f"Nexo logger failed: {e}\n")
+
+    def write(self, record):
+        level, created, component, message, args = record
+        if args:
+            message = message % args
+        if CONSOLE:
+            timestamp = datetime.fromtimestamp(created).strftime("%Y-%m-%d %H:%M:%S")
+            sys.stdout.write(f"[{timestamp}] {LEVEL_COLORS[level]}{LEVEL_NAMES[level]}{Color.RESET} {component}: {message}\n")
+        if LOG_DIR:
+            line = json.dumps({
+                "time": datetime.fromtimestamp(created).isoformat(timespec="milliseconds"),
+                "level": LEVEL_NAMES[level],
+                "component": component,
+                "message": message,
+                "pid": self.pid,
+            })
+            self.lines.append(line + "\n")
+            if len(self.lines) >= 1024:
+                self.flush()
+
+    def open_file(self):
+        if self.file is not None and time.monotonic() >= self.next_reopen_check:
+            self.next_reopen_check = time.monotonic() + REOPEN_CHECK_INTERVAL
+            try:
+                rotated = os.stat(os.path.join(LOG_DIR, LOG_FILE)).st_ino != os.fstat(self.file.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = True
+            if rotated:
+                self.file.close()
+                self.file = None
+        if self.file is None:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            self.file = open(os.path.join(LOG_DIR, LOG_FILE), "a", encoding="utf-8")
+        return self.file
+
+    def rotate(self):
+        path = os.path.join(LOG_DIR, LOG_FILE)
+        with open(f"{path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have rotated it while this one waited
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and stat.st_ino == os.fstat(self.file.fileno()).st_ino and stat.st_size >= MAX_BYTES:
+                for index in range(BACKUP_COUNT - 1, 0, -1):
+                    if os.path.exists(f"{path}.{index}"):
+                        os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+                if BACKUP_COUNT > 0:
+                    os.replace(path, f"{path}.1")
+                else:
+                    os.remove(path)
+        self.file.close()
+        self.file = None
+
+    def flush(self):
+        if CONSOLE:
+            sys.stdout.flush()
+        if self.lines:
+            file = self.open_file()
+            file.write("".join(self.lines))
+            self.lines = []
+            file.flush()
+            if file.tell() >= MAX_BYTES:
+                self.rotate()
+
+    def stop(self, timeout=2):
+        """
+        Writes out every queued record and stops the writer thread.
+        """
+
+        if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+    def run_inline(self):
+        """
+        Stops the writer thread and writes every later record of this
+        process on the thread that logs it. For the pre-forking master in
+        src/serve.py, which must not run threads when it forks. Forked
+        children start their own writer thread as usual.
+        """
+
+        self.stop()
+        with self.lock:
+            self.pid = os.getpid()
+            self.inline_pid = self.pid
+
+writer = Writer()
+atexit.register(writer.stop)
+
+def _emit(level, component, message, args):
+    if level < Level.WARN and SAMPLING:
+        for prefix, rate in SAMPLING.items():
+            if component.startswith(prefix):
+                if random.random() >= rate:
+                    return
+                break
+    writer.put((level, time.time(), component, message, args))
+
+def debug(component, message, *args):
     """
     Logs a debug message with the component name and a timestamp.
 
     Args:
         component (str): The name of the component.
-        message (str): The debug message to log.
+        message (str): The debug message to log, %-style placeholders are
+            filled from args on the writer thread.
     """
 
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {Color.BLUE}DEBUG{Color.RESET} {component}: {message}")
+    if LEVEL > Level.DEBUG:
+        return
+    _emit(Level.DEBUG, component, message, args)
 
-def log(component, message):
+def log(component, message, *args):
     """
     Logs a message with the component name and a timestamp.
 
     Args:
         component (str): The name of the component.
-        message (str): The message to log.
+        message (str): The message to log, %-style placeholders are filled
+            from args on the writer thread.
     """
 
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {Color.GREEN}LOG{Color.RESET} {component}: {message}")
+    if LEVEL > Level.LOG:
+        return
+    _emit(Level.LOG, component, message, args)
 
-def log_error(component, message):
+def log_error(component, message, *args):
     """
     Logs an error message with the component name and a timestamp.
 
     Args:
         component (str): The name of the component.
-        message (str): The error message to log.
+        message (str): The error message to log, %-style placeholders are
+            filled from args on the writer thread.
     """
 
-    Status.error_count += 1 
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {Color.RED}ERROR{Color.RESET} {component}: {message}")
+    Status.error_count += 1
+    if LEVEL > Level.ERROR:
+        return
+    _emit(Level.ERROR, component, message, args)
 
-def log_warning(component, message):
+def log_warning(component, message, *args):
     """
     Logs a warning message with the component name and a timestamp.
 
     Args:
         component (str): The name of the component.
-        message (str): The warning message to log.
+        message (str): The warning message to log, %-style placeholders are
+            filled from args on the writer thread.
     """
 
     Status.warning_count += 1
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {Color.YELLOW}WARN{Color.RESET} {component}: {message}")
\ No newline at end of file
+    if LEVEL > Level.WARN:
+        return
+    _emit(Level.WARN, component, message, args)
+
+log_messages = metrics.Counter("nexo_log_messages_total", "Warnings and errors logged since startup.", ("level",))
+log_messages.set_function(lambda: Status.warning_count, "warning")
+log_messages.set_function(lambda: Status.error_count, "error")
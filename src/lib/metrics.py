@@ -0,0 +1,152 @@
+import bisect
+import functools
+import threading
+import time
+
+# Counters, gauges and histograms exported on /metrics in the Prometheus
+# text format. Metrics are created once at import time and register
+# themselves, recording a value is a dict update under a lock. Values owned
+# by other objects, e.g. cache hit counts, are read through functions when
+# /metrics is scraped instead of being copied on every change.
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names, values, extra=""):
+    pairs = [f"{name}=\"{_escape(value)}\"" for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        self.functions = {}
+        REGISTRY.append(self)
+
+    def set_function(self, func, *labels):
+        """
+        Reads the value for these labels from func() on every scrape.
+        """
+
+        self.functions[labels] = func
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, func in self.functions.items():
+            try:
+                values[labels] = func()
+            except Exception:
+                continue
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+    def render(self):
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self.samples()])
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # Counts per bucket plus one for +Inf, then the sum
+                entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {labels: list(entry) for labels, entry in self.values.items()}
+        for labels, entry in values.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), entry):
+                total += count
+                le = "le=\"" + _number(bound) + "\""
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {total}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {entry[-1]}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {total}"
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+http_requests = Counter("nexo_http_requests_total", "HTTP requests by route template and status.", ("method", "route", "status"))
+http_request_seconds = Histogram("nexo_http_request_duration_seconds", "Time until the response headers were ready.", ("method", "route"))
+db_query_seconds = Histogram("nexo_db_query_duration_seconds", "Time spent in lib/database.py functions.", ("function",), QUERY_BUCKETS)
+cache_hits = Counter("nexo_cache_hits_total", "Cache lookups that found an entry.", ("cache",))
+cache_misses = Counter("nexo_cache_misses_total", "Cache lookups that found nothing.", ("cache",))
+cache_hit_ratio = Gauge("nexo_cache_hit_ratio", "Hits over lookups since startup.", ("cache",))
+cache_entries = Gauge("nexo_cache_entries", "Entries held by a cache.", ("cache",))
+
+def track_cache(name, cache):
+    """
+    Exports the hits, misses and size of an LRUCache or PageCache.
+    """
+
+    cache_hits.set_function(lambda: cache.hits, name)
+    cache_misses.set_function(lambda: cache.misses, name)
+    cache_hit_ratio.set_function(lambda: cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else 0, name)
+    cache_entries.set_function(lambda: len(cache), name)
+
+def timed(func, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - start, name)
+    return wrapper
+
+def instrument(namespace, prefix=None):
+    """
+    Replaces every function in a database namespace and its nested
+    namespaces with one that records its run time in db_query_seconds.
+    """
+
+    prefix = prefix or namespace.__name__
+    for name, value in list(vars(namespace).items()):
+        if name.startswith("__"):
+            continue
+        if isinstance(value, type):
+            instrument(value, f"{prefix}.{name}")
+        elif callable(value):
+            setattr(namespace, name, timed(value, f"{prefix}.{name}"))
@@ -0,0 +1,160 @@
+import html
+import re
+
+from . import db_pool
+from . import logger
+
+# Schema migrations, applied in order. The version of a database is kept in
+# PRAGMA user_version so existing databases are upgraded in place on start.
+# Never edit a migration once it has shipped, add a new one instead.
+
+def _initial_schema(c):
+    c.execute("CREATE TABLE IF NOT EXISTS Users (Username TEXT, Password TEXT, Role TEXT, Banned TEXT, BanReason TEXT, AboutMe TEXT, AccountSettings TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS PublicPosts (ID TEXT, Title TEXT, Author TEXT, Timestamp TEXT, Topic TEXT, Body TEXT, Attachments TEXT, Score INTEGER, Deleted TEXT, Archived TEXT, RepliesLocked TEXT, Replies TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS PublicPostsReplies (ID TEXT, PostID TEXT, Author TEXT, Timestamp TEXT, Body TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS Topics (ID TEXT, Name TEXT, Description TEXT, AdminOnly TEXT, Locked TEXT, Archived TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS DirectMessages (ID TEXT, Sender TEXT, Recipient TEXT, Timestamp TEXT, Body TEXT, ReadByRecipient TEXT, Replies TEXT)")
+
+def _rebuild_table(c, table, schema, key):
+    # SQLite cannot add a primary key to an existing table, so copy the rows
+    # into a new table. Rows with a missing or duplicate key are dropped,
+    # the first row for each key wins.
+    columns = [row[1] for row in c.execute(f"PRAGMA table_info({table})").fetchall()]
+    column_list = ", ".join(columns)
+    c.execute(f"CREATE TABLE {table}_new ({schema})")
+    c.execute(f"INSERT OR IGNORE INTO {table}_new ({column_list}) SELECT {column_list} FROM {table} WHERE {key} IS NOT NULL ORDER BY rowid")
+    dropped = c.execute(f"SELECT (SELECT COUNT(*) FROM {table}) - (SELECT COUNT(*) FROM {table}_new)").fetchone()[0]
+    if dropped:
+        logger.log_warning("Database.Migrations", "Dropped %s rows from %s with a missing or duplicate %s", dropped, table, key)
+    c.execute(f"DROP TABLE {table}")
+    c.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+def _primary_keys_and_indexes(c):
+    _rebuild_table(c, "Users", "Username TEXT NOT NULL PRIMARY KEY, Password TEXT, Role TEXT, Banned TEXT, BanReason TEXT, AboutMe TEXT, AccountSettings TEXT", "Username")
+    _rebuild_table(c, "PublicPosts", "ID TEXT NOT NULL PRIMARY KEY, Title TEXT, Author TEXT, Timestamp TEXT, Topic TEXT, Body TEXT, Attachments TEXT, Score INTEGER, Deleted TEXT, Archived TEXT, RepliesLocked TEXT, Replies TEXT", "ID")
+    _rebuild_table(c, "PublicPostsReplies", "ID TEXT NOT NULL PRIMARY KEY, PostID TEXT, Author TEXT, Timestamp TEXT, Body TEXT", "ID")
+    _rebuild_table(c, "Topics", "ID TEXT NOT NULL PRIMARY KEY, Name TEXT, Description TEXT, AdminOnly TEXT, Locked TEXT, Archived TEXT", "ID")
+    _rebuild_table(c, "DirectMessages", "ID TEXT NOT NULL PRIMARY KEY, Sender TEXT, Recipient TEXT, Timestamp TEXT, Body TEXT, ReadByRecipient TEXT, Replies TEXT", "ID")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_PublicPosts_Timestamp ON PublicPosts (Timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_PublicPosts_Topic_Timestamp ON PublicPosts (Topic, Timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_PublicPosts_Author_Timestamp ON PublicPosts (Author, Timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_PublicPostsReplies_PostID_Timestamp ON PublicPostsReplies (PostID, Timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_DirectMessages_Recipient_Timestamp ON DirectMessages (Recipient, Timestamp)")
+
+def _normalize_replies(c):
+    # Replies used to be tracked as a comma separated list of IDs in
+    # PublicPosts.Replies. Make sure every listed reply points at its post,
+    # store the count on the post row and retire the list.
+    c.execute("ALTER TABLE PublicPosts ADD COLUMN ReplyCount INTEGER NOT NULL DEFAULT 0")
+    rows = c.execute("SELECT ID, Replies FROM PublicPosts WHERE Replies IS NOT NULL AND Replies != ''").fetchall()
+    for row in rows:
+        reply_ids = [reply_id for reply_id in row["Replies"].split(",") if reply_id]
+        c.executemany(
+            "UPDATE PublicPostsReplies SET PostID = ? WHERE ID = ? AND (PostID IS NULL OR PostID = '')",
+            [(row["ID"], reply_id) for reply_id in reply_ids]
+        )
+    c.execute("UPDATE PublicPosts SET ReplyCount = (SELECT COUNT(*) FROM PublicPostsReplies WHERE PostID = PublicPosts.ID), Replies = ''")
+    c.execute("DROP INDEX IF EXISTS idx_PublicPostsReplies_PostID_Timestamp")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_PublicPostsReplies_PostID_Timestamp_ID ON PublicPostsReplies (PostID, Timestamp, ID)")
+
+def _keyset_indexes(c):
+    # Listings are ordered by (Timestamp, ID) so they can be paged with
+    # keyset cursors, the indexes need the ID to break ties.
+    c.execute("DROP INDEX IF EXISTS idx_PublicPosts_Timestamp")
+    c.execute("DROP INDEX IF EXISTS idx_PublicPosts_Topic_Timestamp")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_PublicPosts_Timestamp_ID ON PublicPosts (Timestamp, ID)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_PublicPosts_Topic_Timestamp_ID ON PublicPosts (Topic, Timestamp, ID)")
+
+def _sessions(c):
+    c.execute("CREATE TABLE IF NOT EXISTS Sessions (ID TEXT NOT NULL PRIMARY KEY, Username TEXT NOT NULL, Role TEXT, Expires INTEGER NOT NULL)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_Sessions_Expires ON Sessions (Expires)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_Sessions_Username ON Sessions (Username)")
+
+def _plain_text_v6(body):
+    # The text extraction of search.plain_text() as it was when migration 6
+    # shipped, frozen here so later changes to it do not change the migration
+    return " ".join(html.unescape(re.sub(r"<[^>]*>", " ", body or "")).split())
+
+def _search_index(c):
+    c.execute("CREATE TABLE IF NOT EXISTS SearchDocs (DocID INTEGER PRIMARY KEY, Kind TEXT NOT NULL, RefID TEXT NOT NULL, PostID TEXT, Topic TEXT, Author TEXT, Timestamp TEXT, UNIQUE (Kind, RefID))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_SearchDocs_PostID ON SearchDocs (PostID)")
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS SearchIndex USING fts5(Title, Body, tokenize = 'porter unicode61 remove_diacritics 2')")
+    c.connection.create_function("nexo_plain_text_v6", 1, _plain_text_v6, deterministic=True)
+    c.execute("DELETE FROM SearchIndex")
+    c.execute("DELETE FROM SearchDocs")
+    c.execute("INSERT INTO SearchDocs (Kind, RefID, PostID, Topic, Author, Timestamp) SELECT 'post', ID, ID, Topic, Author, Timestamp FROM PublicPosts ORDER BY rowid")
+    # Replies are filtered by the topic of the post they belong to, replies
+    # without a post are not indexed
+    c.execute("""
+        INSERT INTO SearchDocs (Kind, RefID, PostID, Topic, Author, Timestamp)
+        SELECT 'reply', r.ID, p.ID, p.Topic, r.Author, r.Timestamp FROM PublicPostsReplies r JOIN PublicPosts p ON p.ID = r.PostID ORDER BY r.rowid""")
+    c.execute("""
+        INSERT INTO SearchIndex (rowid, Title, Body)
+        SELECT d.DocID, nexo_plain_text_v6(p.Title), nexo_plain_text_v6(p.Body) FROM SearchDocs d JOIN PublicPosts p ON p.ID = d.RefID WHERE d.Kind = 'post'""")
+    c.execute("""
+        INSERT INTO SearchIndex (rowid, Title, Body)
+        SELECT d.DocID, '', nexo_plain_text_v6(r.Body) FROM SearchDocs d JOIN PublicPostsReplies r ON r.ID = d.RefID WHERE d.Kind = 'reply'""")
+    c.execute("INSERT INTO SearchIndex (SearchIndex) VALUES ('optimize')")
+
+def _created_at(c):
+    # Timestamp holds server local time, CreatedAt the same moment as an
+    # epoch so listings do not have to parse dates
+    for table in ("PublicPosts", "PublicPostsReplies"):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN CreatedAt INTEGER")
+        c.execute(f"UPDATE {table} SET CreatedAt = CAST(strftime('%s', Timestamp, 'utc') AS INTEGER)")
+
+def _mail(c):
+    # The inbox is read newest first, either all of it or only the unread
+    # messages, the outbox by sender. Users.UnreadMail keeps the unread count
+    # so the account links do not have to count messages on every page.
+    c.execute("UPDATE DirectMessages SET ReadByRecipient = 'False' WHERE ReadByRecipient IS NULL OR ReadByRecipient != 'True'")
+    c.execute("ALTER TABLE DirectMessages ADD COLUMN CreatedAt INTEGER")
+    c.execute("UPDATE DirectMessages SET CreatedAt = CAST(strftime('%s', Timestamp, 'utc') AS INTEGER)")
+    c.execute("DROP INDEX IF EXISTS idx_DirectMessages_Recipient_Timestamp")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_DirectMessages_Recipient_Timestamp_ID ON DirectMessages (Recipient, Timestamp, ID)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_DirectMessages_Recipient_Read_Timestamp_ID ON DirectMessages (Recipient, ReadByRecipient, Timestamp, ID)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_DirectMessages_Sender_Timestamp_ID ON DirectMessages (Sender, Timestamp, ID)")
+    c.execute("ALTER TABLE Users ADD COLUMN UnreadMail INTEGER NOT NULL DEFAULT 0")
+    c.execute("UPDATE Users SET UnreadMail = (SELECT COUNT(*) FROM DirectMessages WHERE Recipient = Users.Username AND ReadByRecipient = 'False')")
+
+def _avatars(c):
+    # Hash of the processed profile picture under data/avatars, NULL while
+    # the user has none
+    c.execute("ALTER TABLE Users ADD COLUMN Avatar TEXT")
+
+def _stats(c):
+    # Row counts shown on /status, kept up to date by the write functions
+    c.execute("CREATE TABLE IF NOT EXISTS Stats (Name TEXT PRIMARY KEY, Value INTEGER NOT NULL DEFAULT 0)")
+
+MIGRATIONS = [
+    (1, "Initial schema", _initial_schema),
+    (2, "Primary keys and indexes", _primary_keys_and_indexes),
+    (3, "Normalize replies", _normalize_replies),
+    (4, "Keyset pagination indexes", _keyset_indexes),
+    (5, "Sessions table", _sessions),
+    (6, "Full text search index", _search_index),
+    (7, "Epoch creation times", _created_at),
+    (8, "Mail", _mail),
+    (9, "Avatars", _avatars),
+    (10, "Stats counters", _stats),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def migrate():
+    """
+    Applies every pending migration. Each migration runs in its own write
+    transaction together with the version bump, so a failed migration leaves
+    the database at the previous version. Safe to call from several
+    processes at once, the version is re-checked under the write lock.
+    """
+
+    for version, name, apply in MIGRATIONS:
+        with db_pool.write() as c:
+            current = c.execute("PRAGMA user_version").fetchone()[0]
+            if current >= version:
+                continue
+            logger.log("Database.Migrations", "Applying migration %s: %s", version, name)
+            apply(c)
+            c.execute(f"PRAGMA user_version = {version}")
+    logger.debug("Database.Migrations", "Database schema at version %s", LATEST_VERSION)
@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import invalidation
+from . import metrics
+
+# Rendered page content for the hot read routes. Only the part of a page
+# that is the same for every visitor is cached, per user chrome such as the
+# account links is added by generate_html on every request.
+#
+# Every entry carries tags naming the rows it was built from, e.g.
+# "post:<id>", "topic:<id>", "user:<name>", "posts" or "topics". Database
+# writes invalidate the tags they touch so only the affected pages are
+# dropped, in this process and, through lib/invalidation.py, in every other
+# worker process.
+MAX_BYTES = int(os.environ.get("NEXO_PAGE_CACHE_BYTES", str(32 * 1024 * 1024)))
+TTL = float(os.environ.get("NEXO_PAGE_CACHE_TTL", "60"))
+
+class PageCache:
+    """
+    A thread safe LRU cache of strings bounded by their total size, with
+    tag based invalidation.
+
+    Args:
+        max_bytes (int): The total size of the cached values, in characters.
+        ttl (float): Seconds an entry stays valid.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        # Bumped on every invalidation. A page rendered from rows read
+        # before an invalidation must not be stored after it.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        invalidation.channel.register("pages", self._invalidate, self._clear)
+
+    def _remove(self, key):
+        value, size, tags, expires = self.entries.pop(key)
+        self.size -= size
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def get(self, key):
+        invalidation.channel.poll()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[3] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, tags=(), generation=None):
+        """
+        Stores a rendered page.
+
+        Args:
+            key (tuple): The route and its parameters.
+            value (str): The rendered content.
+            tags (iterable): The tags to invalidate the entry by.
+            generation (int): The value of self.generation read before the
+                page was rendered. The entry is not stored if anything was
+                invalidated since.
+        """
+
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        tags = frozenset(tags)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, tags, time.monotonic() + self.ttl)
+            self.size += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            invalidation.channel.publish("pages", tag)
+        self._invalidate(*tags)
+
+    def _invalidate(self, *tags):
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        invalidation.channel.publish("pages")
+        self._clear()
+
+    def _clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.tags.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+pages = PageCache()
+metrics.track_cache("pages", pages)
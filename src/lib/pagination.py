@@ -0,0 +1,33 @@
+import base64
+
+PAGE_SIZE = 20
+
+def encode_cursor(timestamp, id, page=0):
+    """
+    Encodes a position in a (Timestamp, ID) ordered listing into an opaque
+    URL safe token.
+
+    Args:
+        timestamp (str): The timestamp of the row.
+        id (str): The ID of the row.
+        page (int): The page number the row is on, only used for display.
+    """
+
+    raw = f"{page}|{timestamp}|{id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(token):
+    """
+    Decodes a token made by encode_cursor into (timestamp, id, page).
+    Raises ValueError if the token is malformed.
+
+    Args:
+        token (str): The cursor token.
+    """
+
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        page, timestamp, id = raw.split("|", 2)
+        return timestamp, id, max(int(page), 0)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
@@ -0,0 +1,223 @@
+import asyncio
+import functools
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import logger
+
+# (requests, window in seconds). Routes not listed use the default limit.
+DEFAULT_LIMIT = (20, 20)
+ROUTE_LIMITS = {
+    ("POST", "/register"): (5, 600),
+    ("POST", "/login"): (10, 300),
+    ("POST", "/submit_post"): (5, 60),
+    ("POST", "/mail/send"): (10, 60),
+}
+
+# Clients connecting through Tor share exit IPs with many other users and
+# get this fraction of the normal limit
+TOR_LIMIT_FACTOR = 0.5
+
+# Keys idle for two full windows are dropped every EVICT_INTERVAL seconds
+# by a background thread
+EVICT_INTERVAL = 60
+BACKEND = os.environ.get("NEXO_RATE_LIMIT_BACKEND", "memory")
+SQLITE_PATH = os.environ.get("NEXO_RATE_LIMIT_DB", "data/ratelimit.db")
+
+def sliding_count(window, window_index, previous, current, now):
+    # Sliding window counter: the previous window's count weighted by how
+    # much of it still overlaps the sliding window, plus the current count.
+    elapsed = now - window_index * window
+    return previous * (1 - elapsed / window) + current
+
+class MemoryBackend:
+    """
+    Counters local to this process, one small list per key:
+    [window, window index, previous count, current count].
+    """
+
+    blocking = False
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        index = int(now // window)
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None or counter[1] < index - 1:
+                counter = [window, index, 0, 0]
+                self.counters[key] = counter
+            elif counter[1] == index - 1:
+                counter[1], counter[2], counter[3] = index, counter[3], 0
+            if sliding_count(window, index, counter[2], counter[3], now) >= limit:
+                return False
+            counter[3] += 1
+            return True
+
+    def evict(self, now):
+        # The scan runs on a snapshot without the lock, only the deletes
+        # hold it and every key is checked again in case it was hit since
+        idle = [key for key, counter in list(self.counters.items()) if now // counter[0] - counter[1] >= 2]
+        evicted = 0
+        for start in range(0, len(idle), 256):
+            with self.lock:
+                for key in idle[start:start + 256]:
+                    counter = self.counters.get(key)
+                    if counter is not None and now // counter[0] - counter[1] >= 2:
+                        del self.counters[key]
+                        evicted += 1
+        return evicted
+
+    def count(self):
+        return len(self.counters)
+
+class SQLiteBackend:
+    """
+    Counters in a separate SQLite file shared by every worker on the host.
+    The data is disposable so durability is traded for speed. Every hit
+    takes the file's write lock, so hits run on a thread of their own rather
+    than on the event loop.
+    """
+
+    blocking = True
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.connect()
+        # A forked worker opens its own connection, SQLite connections must
+        # not be shared across fork
+        os.register_at_fork(after_in_child=self.connect)
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("PRAGMA busy_timeout = 1000")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS RateLimits (Key TEXT NOT NULL PRIMARY KEY, Window INTEGER, WindowIndex INTEGER, Previous INTEGER, Current INTEGER) WITHOUT ROWID")
+        self.lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        index = int(now // window)
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT WindowIndex, Previous, Current FROM RateLimits WHERE Key = ?", (key,)).fetchone()
+                if row is None or row[0] < index - 1:
+                    previous, current = 0, 0
+                elif row[0] == index - 1:
+                    previous, current = row[2], 0
+                else:
+                    previous, current = row[1], row[2]
+                allowed = sliding_count(window, index, previous, current, now) < limit
+                if allowed:
+                    current += 1
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO RateLimits (Key, Window, WindowIndex, Previous, Current) VALUES (?, ?, ?, ?, ?)",
+                    (key, window, index, previous, current)
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return allowed
+
+    def evict(self, now):
+        with self.lock:
+            cursor = self.conn.execute("DELETE FROM RateLimits WHERE CAST(? / Window AS INTEGER) - WindowIndex >= 2", (now,))
+            return cursor.rowcount
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM RateLimits").fetchone()[0]
+
+BACKENDS = {
+    "memory": MemoryBackend,
+    "sqlite": SQLiteBackend,
+}
+
+class RateLimiter:
+    """
+    Per client, per route sliding window rate limiter.
+
+    Args:
+        default (tuple): (requests, window) for routes without their own limit.
+        routes (dict): {(method, path): (requests, window)}.
+        backend (str): "memory" or "sqlite".
+    """
+
+    def __init__(self, default=DEFAULT_LIMIT, routes=ROUTE_LIMITS, backend=BACKEND):
+        self.default = default
+        self.routes = dict(routes)
+        self.backend = BACKENDS[backend]()
+        self.rejected = 0
+        self.executor = None
+        self.executor_pid = None
+        self.executor_lock = threading.Lock()
+
+    def start_evicter(self, interval=EVICT_INTERVAL):
+        """
+        Starts a daemon thread that drops idle keys every interval seconds,
+        away from the request path. Called on app startup in every serving
+        process.
+        """
+
+        def evict_forever():
+            while True:
+                time.sleep(interval)
+                try:
+                    evicted = self.backend.evict(time.time())
+                    if evicted:
+                        logger.debug("RateLimiter", "Evicted %s idle clients", evicted)
+                except Exception as e:
+                    logger.log_error("RateLimiter", "Eviction failed: %s", e)
+
+        thread = threading.Thread(target=evict_forever, name="nexo-rate-limit-evicter", daemon=True)
+        thread.start()
+        return thread
+
+    def get_executor(self):
+        # One thread is enough, the backend serializes hits on its lock, and
+        # it keeps a slow hit from holding up the database executor
+        with self.executor_lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nexo-rate-limit")
+                self.executor_pid = os.getpid()
+            return self.executor
+
+    def check(self, client, method, path, is_tor=False):
+        """
+        Counts a request and returns (allowed, retry_after). Requests that
+        are rejected are not counted.
+        """
+
+        now = time.time()
+        route = (method, path)
+        if route in self.routes:
+            limit, window = self.routes[route]
+            key = f"{method} {path}|{client}"
+        else:
+            limit, window = self.default
+            key = client
+        if is_tor:
+            limit = max(int(limit * TOR_LIMIT_FACTOR), 1)
+        if self.backend.hit(key, limit, window, now):
+            return True, 0
+        self.rejected += 1
+        return False, int(window - now % window) + 1
+
+    async def check_async(self, client, method, path, is_tor=False):
+        """
+        Awaitable check(). Backends that block run on the limiter's own
+        thread so the event loop keeps serving while they wait.
+        """
+
+        if not self.backend.blocking:
+            return self.check(client, method, path, is_tor)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(), functools.partial(self.check, client, method, path, is_tor))
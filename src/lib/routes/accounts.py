@@ -1,13 +1,18 @@
 from fastapi import FastAPI, Request, Header, HTTPException, UploadFile, File, Form, Response, APIRouter
-from fastapi.responses import JSONResponse, PlainTextResponse, HTMLResponse, FileResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, HTMLResponse, FileResponse, RedirectResponse
 from typing import Annotated
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from starlette.formparsers import MultiPartException
 
 import hashlib
+import html
 
-from .. import database
+from .. import async_database
 from .. import utils
 from .. import sessions_manager
 from .. import responses
+from .. import static_assets
+from .. import images
 import os
 
 router = APIRouter()
@@ -28,6 +33,7 @@ async def register_page(request: Request):
 @router.post("/register")
 async def register_user(request: Request, username: str = Form(...), password: str = Form(...)):
     banned_usernames = ["admin", "administrator", "root", "system", "nexo_bot", "nexo", "owner", "moderator", "user", "guest", "anonymous"]
+    username = username.lower()
     banned_chars = [" ", "/", "\\", ":", "*", "?", "\"", "<", ">", "|", "!", "@", "#", "$", "%", "^", "&", "(", ")", "{", "}", "[", "]", ";", "'", ",", ".", "`", "~"]
     allowed_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-"
     if not all(char in allowed_chars for char in username):
@@ -42,13 +48,12 @@ async def register_user(request: Request, username: str = Form(...), password: s
         return responses.Account.Errors.username_banned(request)
     if any(char in banned_chars for char in username):
         return responses.Account.Errors.username_invalid(request)
-    if database.User.Check.exists(username):
+    if await async_database.User.Check.exists(username):
         return responses.Account.Errors.username_exists(request)
     
-    username = username.lower()
     hashed_pw = hashlib.sha256(password.encode()).hexdigest()
-    database.User.Core.create_user(username, hashed_pw, "member")
-    database.User.Set.about_me(username, "This user has not set an about me yet.")
+    await async_database.User.Core.create_user(username, hashed_pw, "member")
+    await async_database.User.Set.about_me(username, "This user has not set an about me yet.")
     
     return responses.Account.Success.user_created(request)
 
@@ -67,14 +72,14 @@ async def login_page(request: Request):
 
 @router.post("/login")
 async def login_user(request: Request, response: Response, username: str = Form(...), password: str = Form(...)):
-    user =  database.User.Core.get_user(username)
+    user =  await async_database.User.Core.get_user(username)
     if user and user['Banned'] == "True":
         reason = user['BanReason']
         return HTMLResponse(utils.generate_html(request=request, main_content="Your account is banned. You can appeal the ban by contacting the system administrator.\nReason: " + reason))
     if not user or user['Password'] != hashlib.sha256(password.encode()).hexdigest():
         return HTMLResponse(utils.generate_html(request=request, main_content="Invalid username or password. <a href='/login'>Try again</a> or <a href='/register'>register</a>."))
 
-    session_id = sessions_manager.login_user(request, username)
+    session_id = await async_database.run(sessions_manager.login_user, request, username, user['Role'])
     if not session_id:
         return HTMLResponse(utils.generate_html(request=request, main_content="Failed to create session. <a href='/login'>Try again</a> or <a href='/register'>register</a>."))
     response = HTMLResponse(utils.generate_html(request=request, main_content="Login successful! Redirecting to home... <script>setTimeout(function() { window.location.href = '/'; }, 2000);</script>"))
@@ -87,7 +92,7 @@ async def logout(request: Request, response: Response):
     user = sessions_manager.get_current_user(request)
     if not user:
         return HTMLResponse(utils.generate_html(request=request, main_content="You are not logged in. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
-    sessions_manager.logout_user(request)
+    await async_database.run(sessions_manager.logout_user, request)
     return HTMLResponse(utils.generate_html(request=request, main_content="Logout successful! Redirecting to home... <script>document.cookie = 'session_id=; expires=Thu, 01 Jan 1970 00:00:00 UTC; path=/;'; setTimeout(function() { window.location.href = '/'; }, 2000);</script>"))
 
 
@@ -123,7 +128,7 @@ async def set_password(request: Request, password: str = Form(...)):
         return HTMLResponse(utils.generate_html(request=request, main_content="You are not logged in. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
     
     hashed_pw = hashlib.sha256(password.encode()).hexdigest()
-    database.User.Set.password(user, hashed_pw)
+    await async_database.User.Set.password(user, hashed_pw)
     return HTMLResponse(utils.generate_html(request=request, main_content="Password changed successfully!"))
 @router.post("/account/setaboutme")
 async def set_about_me(request: Request, aboutme: str = Form(...)):
@@ -131,25 +136,34 @@ async def set_about_me(request: Request, aboutme: str = Form(...)):
     if not user:
         return HTMLResponse(utils.generate_html(request=request, main_content="You are not logged in. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
 
-    database.User.Set.about_me(user, aboutme)
+    await async_database.User.Set.about_me(user, aboutme)
     return HTMLResponse(utils.generate_html(request=request, main_content="About me changed successfully!"))
 
 @router.post("/account/setprofilepic")
-async def set_profile_pic(request: Request, profilepic: UploadFile = File(...)):
+async def set_profile_pic(request: Request):
     user = sessions_manager.get_current_user(request)
     if not user:
         return HTMLResponse(utils.generate_html(request=request, main_content="You are not logged in. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
     
-    if not profilepic.filename.endswith(('.png', '.jpg', '.jpeg', '.gif')):
-        return HTMLResponse(utils.generate_html(request=request, main_content="Invalid file type. Only PNG files are allowed."))
-    
-    file_path = f"data/users/{user}/profile_pic.png"
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    if not os.path.exists(f"data/users/{user}/"):
-        os.makedirs(f"data/users/{user}/")
-    with open(file_path, "wb") as f:
-        f.write(await profilepic.read())
+    # The form is parsed here rather than by FastAPI so an oversized upload
+    # is rejected while it arrives instead of after all of it was received
+    form = None
+    try:
+        form = await images.read_form(request)
+        profilepic = form.get("profilepic")
+        if not isinstance(profilepic, StarletteUploadFile):
+            raise images.ImageError("No image was uploaded")
+        avatar = await images.process_upload(profilepic)
+    except images.ImageTooLarge as e:
+        return HTMLResponse(utils.generate_html(request=request, main_content=f"{e}. <a href='/account'>Go back</a>"), status_code=413)
+    except images.ImageError as e:
+        return HTMLResponse(utils.generate_html(request=request, main_content=f"{html.escape(str(e))}. <a href='/account'>Go back</a>"), status_code=400)
+    except MultiPartException as e:
+        return HTMLResponse(utils.generate_html(request=request, main_content=f"{html.escape(e.message)}. <a href='/account'>Go back</a>"), status_code=400)
+    finally:
+        if form is not None:
+            await form.close()
+    await async_database.User.Set.avatar(user, avatar)
     return HTMLResponse(utils.generate_html(request=request, main_content="Profile picture changed successfully!"))
 
 @router.post("/account/delete")
@@ -159,34 +173,68 @@ async def delete_account(request: Request):
         return HTMLResponse(utils.generate_html(request=request, main_content="You are not logged in. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
     
     # database.User.delete_user(user)
-    sessions_manager.logout_user(request)
+    await async_database.run(sessions_manager.logout_user, request)
     return HTMLResponse(utils.generate_html(request=request, main_content="Account deleted successfully!"))
 
 @router.get("/account/{username}")
 async def account_page(request: Request, username: str):
-    if not database.User.Check.exists(username):
+    if not await async_database.User.Check.exists(username):
         return HTMLResponse(utils.generate_html(request=request, main_content="User does not exist. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
 
-    about_me = database.User.Get.about_me(username)
-    role = utils.get_username_tag(username)
+    about_me = await async_database.User.Get.about_me(username)
+    role = await async_database.run(utils.get_username_tag, username)
     page_content = f"""
 <h2>Account page for {username} {role}</h2>
-<img src="/account/{username}/profile_pic" alt="Profile picture" style="width: 100px; height: 100px;"><br>
+{await profile_picture(username)}<br>
 <b>About me:</b>
 {about_me}<br>
     """
     return HTMLResponse(utils.generate_html(request=request, title=f"Nexo Textboard | Account page for {username}", main_content=page_content))
 
 
+async def get_avatar(username):
+    # Pictures uploaded before thumbnails existed are processed the first
+    # time they are asked for
+    avatar = await async_database.User.Get.avatar(username)
+    if avatar:
+        return avatar
+    legacy_path = f"data/users/{username}/profile_pic.png"
+    if not os.path.exists(legacy_path):
+        return None
+    avatar = await images.process_legacy(legacy_path)
+    if avatar:
+        await async_database.User.Set.avatar(username, avatar)
+    return avatar
+
+async def profile_picture(username):
+    avatar = await get_avatar(username)
+    if not avatar:
+        return f"<img src=\"/account/{username}/profile_pic\" alt=\"Profile picture\" width=\"100\" height=\"100\">"
+    return f"""<picture>
+<source srcset="{images.avatar_url(avatar, 128, 'webp')}" type="image/webp">
+<img src="{images.avatar_url(avatar, 128, 'png')}" alt="Profile picture" width="100" height="100">
+</picture>"""
+
 @router.get("/account/{username}/profile_pic")
-async def get_profile_pic(request: Request, username: str):
-    if not database.User.Check.exists(username):
+async def get_profile_pic(request: Request, username: str, size: int = 128):
+    if not await async_database.User.Check.exists(username):
         return HTMLResponse(utils.generate_html(request=request, main_content="User does not exist. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
     
-    file_path = f"data/users/{username}/profile_pic.png"
-    if not os.path.exists(file_path):
-        return FileResponse("src/static/base.png")
-    
-    return FileResponse(file_path)
+    avatar = await get_avatar(username)
+    if not avatar:
+        return static_assets.file_response(request, "src/static/base.png")
+    if size not in images.SIZES:
+        size = max(images.SIZES)
+    fmt = "webp" if "image/webp" in request.headers.get("accept", "") else "png"
+    # The redirect changes with the avatar, the target never does
+    return RedirectResponse(url=images.avatar_url(avatar, size, fmt), status_code=302, headers={"Cache-Control": static_assets.CACHE_PRIVATE, "Vary": "Accept"})
+
+@router.get("/avatar/{avatar}/{name}")
+async def get_avatar_file(request: Request, avatar: str, name: str):
+    size, _, fmt = name.partition(".")
+    path = images.avatar_path(avatar, int(size) if size.isdigit() else None, fmt)
+    if not path or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Avatar not found")
+    return static_assets.file_response(request, path, static_assets.CACHE_IMMUTABLE, media_type=images.FORMATS[fmt])
 
 # TODO: theme
\ No newline at end of file
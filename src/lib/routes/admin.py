@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Request, Form, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse
-from .. import database, utils, sessions_manager
+from .. import async_database, utils, sessions_manager, templates, page_cache
 import hashlib
 import datetime
 
@@ -8,15 +8,15 @@ router = APIRouter()
 
 ADMIN_ROLES = ["owner", "admin", "moderator"]
 
-def is_admin(user: str) -> bool:
-    role = database.User.Get.role(user)
+async def is_admin(user: str) -> bool:
+    role = await async_database.User.Get.role(user)
     return role in ADMIN_ROLES
 
 
 @router.get("/admin", response_class=HTMLResponse)
 async def admin_panel(request: Request):
     user = sessions_manager.get_current_user(request)
-    auth = auth_check(request)
+    auth = await auth_check(request)
     if auth:
         return auth
 
@@ -60,33 +60,37 @@ async def admin_panel(request: Request):
         Content: <br><textarea name="content" rows="5" cols="40" required></textarea><br>
         <input type="submit" value="Post">
     </form>
+
+    <form method="post" action="/admin/reloadtemplates">
+        <h3>Reload Templates</h3>
+        <input type="submit" value="Reload">
+    </form>
     """
     return HTMLResponse(utils.generate_html(request=request, title="Admin Panel", main_content=form))
 
 
-def auth_check(request: Request):
+async def auth_check(request: Request):
     user = sessions_manager.get_current_user(request)
-    if not user or not is_admin(user):
+    if not user or not await is_admin(user):
         return HTMLResponse(utils.generate_html(request=request, main_content="Unauthorized"))
     return None
 
 @router.post("/admin/deletepost")
 async def delete_post(request: Request, post_id: str = Form(...)):
-    auth = auth_check(request)
+    auth = await auth_check(request)
     if auth:
         return auth
 
-    database.PublicPosts.Set.soft_delete(post_id)
+    await async_database.PublicPosts.Set.soft_delete(post_id)
     return RedirectResponse(url="/admin", status_code=303)
 
 @router.get("/admin/deletepost/{post_id}")
 async def delete_post_get(request: Request, post_id: str):
-    auth = auth_check(request)
+    auth = await auth_check(request)
     if auth:
         return auth
 
-    database.PublicPosts.delete_post(post_id)
-    meta_storage.PublicPosts.delete_post(post_id)
+    await async_database.PublicPosts.Core.delete_post(post_id)
     return RedirectResponse(url="/admin", status_code=303)
 
 
@@ -94,21 +98,22 @@ async def delete_post_get(request: Request, post_id: str):
 async def ban_user(request: Request, ban_username: str = Form(...),
                    reason: str = Form(...)):
     
-    auth = auth_check(request)
+    auth = await auth_check(request)
     if auth:
         return auth
     
-    database.User.Set.ban_status(ban_username, "true", reason)
+    await async_database.User.Set.ban_status(ban_username, "true", reason)
 
     return RedirectResponse(url="/admin", status_code=303)
 
 @router.get("/admin/banuser/{ban_username}")
 async def ban_user_get(request: Request, ban_username: str):
-    auth = auth_check(request)
+    auth = await auth_check(request)
     if auth:
         return auth
 
-    database.User.set_role(ban_username, "banned")
+    await async_database.User.Set.user_role(ban_username, "banned")
+    await async_database.run(sessions_manager.update_role, ban_username, "banned")
     return RedirectResponse(url="/admin", status_code=303)
 
 @router.post("/admin/createtopic")
@@ -119,22 +124,31 @@ async def create_topic(request: Request, id: str = Form(...),
                     locked: bool = Form(False),
                     archived: bool = Form(False)):
     
-    auth = auth_check(request)
+    auth = await auth_check(request)
     if auth:
         return auth
 
-    database.Topics.Core.create_topic(id, name, description, admin_only, locked, archived)
+    await async_database.Topics.Core.create_topic(id, name, description, admin_only, locked, archived)
     return RedirectResponse(url="/admin", status_code=303)
 
 
 @router.post("/admin/systempost")
 async def system_post(request: Request, title: str = Form(...), topic: str = Form(...), username: str = Form(...), content: str = Form(...)):
-    auth = auth_check(request)
+    auth = await auth_check(request)
     if auth:
         return auth
 
     id = hashlib.sha256((title + datetime.datetime.now().isoformat()).encode()).hexdigest()[:10]
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    database.PublicPosts.add_post(id, title, username, timestamp, topic)
-    meta_storage.PublicPosts.add_post(id, title, username, timestamp, topic, content)
+    await async_database.PublicPosts.Core.add_post(id, title, username, timestamp, topic, content)
+    return RedirectResponse(url="/admin", status_code=303)
+
+@router.post("/admin/reloadtemplates")
+async def reload_templates(request: Request):
+    auth = await auth_check(request)
+    if auth:
+        return auth
+
+    templates.clear()
+    page_cache.pages.clear()
     return RedirectResponse(url="/admin", status_code=303)
@@ -0,0 +1,169 @@
+from fastapi import Request, Form, APIRouter, HTTPException
+from fastapi.responses import HTMLResponse, RedirectResponse
+
+from typing import List
+import datetime
+import hashlib
+import html
+from .. import async_database
+from .. import utils
+from .. import sessions_manager
+from .. import pagination
+from .. import search
+from .. import timefmt
+from .posts import page_links
+
+router = APIRouter()
+
+PREVIEW_LENGTH = 80
+MAILBOX_TITLES = {
+    "inbox": "Inbox",
+    "unread": "Unread",
+    "sent": "Sent",
+}
+MAILBOX_URLS = {
+    "inbox": "/mail",
+    "unread": "/mail/unread",
+    "sent": "/mail/sent",
+}
+
+def not_logged_in(request: Request):
+    return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Mail", main_content="You must be logged in to use mail. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
+
+def mail_links():
+    return " ".join(f"[<a href=\"{url}\">{MAILBOX_TITLES[mailbox]}</a>]" for mailbox, url in MAILBOX_URLS.items()) + " [<a href=\"/mail/new\">New message</a>]<br>"
+
+async def get_mail_page(user, mailbox, after, before):
+    """
+    Fetches one page of a mailbox by keyset cursor. Returns the messages, the
+    page number and whether there are newer and older pages. Raises
+    ValueError on a bad cursor.
+    """
+
+    size = pagination.PAGE_SIZE
+    if after:
+        timestamp, message_id, page = pagination.decode_cursor(after)
+        messages = await async_database.DirectMessages.Core.get_mail_after(user, mailbox, timestamp, message_id, size + 1)
+        return messages[:size], page, True, len(messages) > size
+    if before:
+        timestamp, message_id, page = pagination.decode_cursor(before)
+        messages = await async_database.DirectMessages.Core.get_mail_before(user, mailbox, timestamp, message_id, size + 1)
+        if len(messages) > size:
+            return messages[-size:], page, True, True
+    messages = await async_database.DirectMessages.Core.get_mail_after(user, mailbox, None, None, size + 1)
+    return messages[:size], 0, False, len(messages) > size
+
+async def mailbox_page(request: Request, mailbox, after, before):
+    user = sessions_manager.get_current_user(request)
+    if not user:
+        return not_logged_in(request)
+    title = f"Nexo Textboard | Mail | {MAILBOX_TITLES[mailbox]}"
+    base_url = MAILBOX_URLS[mailbox]
+    try:
+        messages, page, has_prev, has_next = await get_mail_page(user, mailbox, after, before)
+    except ValueError:
+        return HTMLResponse(utils.generate_html(request=request, title=title, main_content=f"Invalid page cursor. <a href=\"{base_url}\">Go to the first page</a>"), status_code=400)
+
+    main_content = f"<a href=\"/\">Home</a> > <a href=\"/mail\">Mail</a> > <a href=\"{base_url}\">{MAILBOX_TITLES[mailbox]}</a><br>"
+    main_content += mail_links()
+    if mailbox != "sent":
+        main_content += "<form action=\"/mail/read\" method=\"post\">"
+    relative_times = timefmt.relative_labels([message['CreatedAt'] for message in messages])
+    for message, relative_time in zip(messages, relative_times):
+        preview = html.escape(search.plain_text(message['Body'])[:PREVIEW_LENGTH])
+        if mailbox == "sent":
+            main_content += f"{relative_time} To <i>{message['Recipient']}</i>\n <a href=\"/mail/{message['ID']}\">{preview}</a>\n\n"
+        else:
+            unread = message['ReadByRecipient'] != "True"
+            checkbox = f"<input type=\"checkbox\" name=\"ids\" value=\"{message['ID']}\"> " if unread else ""
+            new = " <b>NEW</b>" if unread else ""
+            main_content += f"{checkbox}{relative_time} From <i>{message['Sender']}</i>{new}\n <a href=\"/mail/{message['ID']}\">{preview}</a>\n\n"
+    if not messages:
+        main_content += "No messages<br>"
+    main_content += page_links(base_url, messages, page, has_prev, has_next)
+    if mailbox != "sent":
+        main_content += "<br><input type=\"submit\" value=\"Mark selected as read\"> "
+        main_content += "<input type=\"submit\" name=\"all\" value=\"Mark all as read\">"
+        main_content += "</form>"
+    return HTMLResponse(utils.generate_html(request=request, title=title, main_content=main_content))
+
+@router.get("/mail")
+async def inbox(request: Request, after: str = None, before: str = None):
+    return await mailbox_page(request, "inbox", after, before)
+
+@router.get("/mail/unread")
+async def unread(request: Request, after: str = None, before: str = None):
+    return await mailbox_page(request, "unread", after, before)
+
+@router.get("/mail/sent")
+async def sent(request: Request, after: str = None, before: str = None):
+    return await mailbox_page(request, "sent", after, before)
+
+@router.get("/mail/new")
+async def new_message(request: Request, to: str = ""):
+    user = sessions_manager.get_current_user(request)
+    if not user:
+        return not_logged_in(request)
+    main_content = "<a href=\"/\">Home</a> > <a href=\"/mail\">Mail</a> > New message<br>"
+    main_content += mail_links()
+    main_content += f"""
+<h2>New message</h2>
+<form action="/mail/send" method="post">
+To: <input type="text" name="to" value="{html.escape(to)}" required><br>
+Message:<br>
+<textarea name="content" rows="10" cols="50" required></textarea><br>
+<input type="submit" value="Send">
+</form>
+    """
+    return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Mail | New message", main_content=main_content))
+
+@router.post("/mail/send")
+async def send_message(request: Request, to: str = Form(...), content: str = Form(...)):
+    user = sessions_manager.get_current_user(request)
+    if not user:
+        return not_logged_in(request)
+    to = to.strip().lower()
+    if not content.strip():
+        return HTMLResponse(utils.generate_html(request=request, main_content="Message cannot be empty. <a href='/mail/new'>Go back</a>"))
+    if not await async_database.User.Check.exists(to):
+        return HTMLResponse(utils.generate_html(request=request, main_content=f"User {html.escape(to)} does not exist. <a href='/mail/new'>Go back</a>"), status_code=404)
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    message_id = hashlib.sha256((user + to + content + datetime.datetime.now().isoformat()).encode()).hexdigest()[:10]
+    await async_database.DirectMessages.Core.send_message(message_id, user, to, timestamp, content)
+    return RedirectResponse(url="/mail/sent", status_code=303)
+
+@router.post("/mail/read")
+async def mark_read(request: Request, ids: List[str] = Form([]), all: str = Form(None)):
+    user = sessions_manager.get_current_user(request)
+    if not user:
+        return not_logged_in(request)
+    if all:
+        await async_database.DirectMessages.Set.mark_all_read(user)
+    else:
+        await async_database.DirectMessages.Set.mark_read(user, ids)
+    return RedirectResponse(url="/mail", status_code=303)
+
+@router.get("/mail/{id}")
+async def view_message(request: Request, id: str):
+    user = sessions_manager.get_current_user(request)
+    if not user:
+        return not_logged_in(request)
+    message = await async_database.DirectMessages.Core.get_message(id)
+    if not message or user not in (message['Sender'], message['Recipient']):
+        raise HTTPException(status_code=404, detail="Message not found")
+    if message['Recipient'] == user and message['ReadByRecipient'] != "True":
+        await async_database.DirectMessages.Set.mark_read(user, [id])
+        # The count in the page header was loaded before the message was read
+        request.state.unread_mail = await async_database.DirectMessages.Get.unread_count(user)
+
+    main_content = "<a href=\"/\">Home</a> > <a href=\"/mail\">Mail</a><br>"
+    main_content += mail_links()
+    main_content += f"<b>FROM: </b><i><a href=\"/account/{message['Sender']}\">{message['Sender']}</a></i> "
+    main_content += f"<b>TO: </b><i><a href=\"/account/{message['Recipient']}\">{message['Recipient']}</a></i> "
+    main_content += f"<b>{message['Timestamp']}</b> ({timefmt.relative_label(message['CreatedAt'], timefmt.now())})<br>"
+    main_content += "<hr>"
+    main_content += f"{message['Body']}<br>"
+    main_content += "<hr>"
+    other = message['Sender'] if message['Recipient'] == user else message['Recipient']
+    main_content += f"[<a href=\"/mail/new?to={other}\">Reply</a>]"
+    return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Mail", main_content=main_content))
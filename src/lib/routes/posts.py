@@ -1,25 +1,38 @@
 from fastapi import FastAPI, Request, Header, HTTPException, UploadFile, File, Form, Response, APIRouter
-from fastapi.responses import JSONResponse, PlainTextResponse, HTMLResponse, FileResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, HTMLResponse, FileResponse, StreamingResponse, RedirectResponse
 
 from typing import Annotated
 import hashlib
 import datetime
-from dateutil.relativedelta import relativedelta
+import os
+from .. import async_database
 from .. import database
 from .. import utils
 from .. import sessions_manager
+from .. import pagination
+from .. import page_cache
+from .. import timefmt
 
 router = APIRouter()
 
 ADMIN_TOPICS = ["/admin/", "/announcements/", "/news/", "/updates/", "/system/"]
 
+# Replies shown per page of a thread, 0 shows them all on one page
+REPLIES_PAGE_SIZE = int(os.environ.get("NEXO_REPLIES_PAGE_SIZE", "50"))
+# A page holding more replies than this is streamed to the client in
+# batches instead of being rendered into one string and cached. Streaming
+# only happens when NEXO_REPLIES_PAGE_SIZE is 0 or above the threshold, with
+# the default page size every page is small enough to render and cache.
+STREAM_REPLY_THRESHOLD = int(os.environ.get("NEXO_STREAM_REPLY_THRESHOLD", "200"))
+STREAM_BATCH_SIZE = int(os.environ.get("NEXO_STREAM_BATCH_SIZE", "100"))
+
 @router.get("/new_post")
 async def new_post_page(request: Request):
     user = sessions_manager.get_current_user(request)
     if not user:
         return HTMLResponse(utils.generate_html(request=request, main_content="You must be logged in to create a post. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
     
-    topics_list = database.Topics.Core.get_all_topics()
+    topics_list = await async_database.Topics.Core.get_all_topics()
     topics_dropdown = "<select name=\"topic\">"
     for topic in topics_list:
         topics_dropdown += f"<option value=\"{topic['ID']}\">{topic['ID']}</option>"
@@ -54,7 +67,7 @@ async def submit_post(
     id = hashlib.sha256((title + author + topic + content).encode()).hexdigest()
     id = id[:10]
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    database.PublicPosts.Core.add_post(
+    await async_database.PublicPosts.Core.add_post(
         id=id,
         title=title,
         author=author,
@@ -71,96 +84,270 @@ async def submit_post(
 
 
 
+async def get_posts_page(topic, page, after, before):
+    """
+    Fetches one page of posts, either by offset (?page=) or by keyset cursor
+    (?after= / ?before=). Returns the posts, the page number and whether
+    there are newer and older pages. Raises ValueError on a bad cursor.
+    """
+
+    size = pagination.PAGE_SIZE
+    if after:
+        timestamp, post_id, page = pagination.decode_cursor(after)
+        posts = await async_database.PublicPosts.Core.get_posts_after(timestamp, post_id, topic, size + 1)
+        return posts[:size], page, True, len(posts) > size
+    if before:
+        timestamp, post_id, page = pagination.decode_cursor(before)
+        posts = await async_database.PublicPosts.Core.get_posts_before(timestamp, post_id, topic, size + 1)
+        if len(posts) > size:
+            return posts[-size:], page, True, True
+        # Reached the newest posts, show a full first page instead
+        page = 0
+    if topic is None:
+        posts = await async_database.PublicPosts.Core.get_post_by_page(page)
+    else:
+        posts = await async_database.PublicPosts.Core.get_posts_by_topic(topic, page)
+    return posts, page, page > 0, len(posts) == size
+
+def listing_tags(tag, posts):
+    # A listing changes when a post on it or the role of one of its authors
+    # changes, or when a post is added to or removed from it
+    return [tag] + [f"post:{post['ID']}" for post in posts] + [f"user:{post['Author']}" for post in posts]
+
+def page_links(base_url, posts, page, has_prev, has_next):
+    if has_prev and posts:
+        token = pagination.encode_cursor(posts[0]['Timestamp'], posts[0]['ID'], page - 1)
+        links = f"<a href=\"{base_url}?before={token}\"><-</a>"
+    elif page > 0:
+        links = f"<a href=\"{base_url}?page={page - 1}\"><-</a>"
+    else:
+        links = "<-"
+    links += f" Page {page} "
+    if has_next:
+        token = pagination.encode_cursor(posts[-1]['Timestamp'], posts[-1]['ID'], page + 1)
+        links += f"<a href=\"{base_url}?after={token}\">-></a>"
+    else:
+        links += "->"
+    return links
+
 @router.get("/posts")
-async def posts(request: Request, page: int = 0):
+async def posts(request: Request, page: int = 0, after: str = None, before: str = None):
     if page < 0:
         return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Public posts", main_content="Why are you doing a negative page lmao?\nYou know thats not how databases work right?"))
-    posts = database.PublicPosts.Core.get_post_by_page(page)
+    cache_key = ("posts", page, after, before)
+    main_content = page_cache.pages.get(cache_key)
+    if main_content is not None:
+        return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Public posts", main_content=main_content, footer_content="200 OK"))
+    generation = page_cache.pages.generation
+    try:
+        posts, page, has_prev, has_next = await get_posts_page(None, page, after, before)
+    except ValueError:
+        return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Public posts", main_content="Invalid page cursor. <a href=\"/posts\">Go to the first page</a>"), status_code=400)
+    username_tags = await async_database.run(utils.get_username_tags, [post['Author'] for post in posts])
     main_content = "<a href=\"/\">Home</a> > <a href=\"/posts\">Public posts</a><br>"
-    for post in posts:
-        relative_time = ""
-        post_time = datetime.datetime.strptime(post['Timestamp'], "%Y-%m-%d %H:%M:%S")
-        now = datetime.datetime.now()
-        diff = relativedelta(now, post_time)
-        if diff.years > 0:
-            relative_time = f"{diff.years}y ago"
-        elif diff.months > 0:
-            relative_time = f"{diff.months}m ago"
-        elif diff.days > 0:
-            relative_time = f"{diff.days}d ago"
-        elif diff.hours > 0:
-            relative_time = f"{diff.hours}h ago"
-        elif diff.minutes > 0:
-            relative_time = f"{diff.minutes}m ago"
-        elif diff.seconds > 0:
-            relative_time = f"{diff.seconds}s ago"
-        else:
-            relative_time = "Just now"
-        replies_count = len(post['Replies'].split(","))
-        main_content += f"{relative_time} Posted in <b>{post['Topic']}</b> by <i>{post['Author']}</i> {utils.get_username_tag(post['Author'])} ({replies_count} replies)\n <a href=\"/post/{post['ID']}\">{post['Title']}</a>\n\n"
+    relative_times = timefmt.relative_labels([post['CreatedAt'] for post in posts])
+    for post, relative_time in zip(posts, relative_times):
+        replies_count = post['ReplyCount']
+        username_tag = username_tags[post['Author']]
+        main_content += f"{relative_time} Posted in <b>{post['Topic']}</b> by <i>{post['Author']}</i> {username_tag} ({replies_count} replies)\n <a href=\"/post/{post['ID']}\">{post['Title']}</a>\n\n"
     if not posts:
         main_content = "No posts found<br>"
-    if page == 0:
-        main_content += "<- Page 0 <a href=\"/posts?page=" + str(page + 1) + "\">-></a>"
-    else:
-        main_content += "<a href=\"/posts?page=" + str(page - 1) + "\"><-</a> Page " + str(page) + " <a href=\"/posts?page=" + str(page + 1) + "\">-></a>"
+    main_content += page_links("/posts", posts, page, has_prev, has_next)
+    page_cache.pages.set(cache_key, main_content, listing_tags("posts", posts), generation)
     footer_content = "200 OK"
     return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Public posts", main_content=main_content, footer_content=footer_content))
 
-@router.get("/post/{id}")
-async def get_post(request: Request, id: str):
-    logged_in_user = sessions_manager.get_current_user(request)
-    is_admin = database.User.Check.is_admin(logged_in_user) if logged_in_user else False
-    post = database.PublicPosts.Core.get_post(id)
-    if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
-    
-    main_content = f"<h2>{post['Title']}</h2>"
-    main_content += f"<b>AUTHOR: </b><i><a href=\"/account/{post['Author']}\">{post['Author']}</a></i> <b>{post['Timestamp']}</b><br>"
-    main_content += f"<b>TOPIC:</b> <a href=\"/topic{post['Topic']}\">{post['Topic']}</a><br>"
-    main_content += f"{post['Body']}<br>"
-    main_content += "<hr>"
-    main_content += "<b>----REPLIES----</b><br><br>"
-    if post['Replies'] == "":
-        main_content += "No replies yet<br>"
-    post['Replies'] = post['Replies'].split(",")
-    for reply in post['Replies']:
-        if reply == "":
-            continue
-        reply_data = database.PublicPostReplies.Core.get_reply(reply)
-        if not reply_data:
-            continue
-        main_content += f"<section id=\"reply_{reply_data['ID']}\">"
-        main_content += f"<b>REPLY:</b> <i><a href=\"/account/{reply_data['Author']}\">{reply_data['Author']}</a></i> <b>{reply_data['Timestamp']}</b> <i>{reply_data['ID']}</i><br>"
-        main_content += f"{reply_data['Body']}<br>"
-        main_content += "</section>"
-        
-    user = sessions_manager.get_current_user(request)
-    main_content += "<section id=\"reply_section\">"
+def render_post_header(post, current):
+    content = f"<h2>{post['Title']}</h2>"
+    content += f"<b>AUTHOR: </b><i><a href=\"/account/{post['Author']}\">{post['Author']}</a></i> <b>{post['Timestamp']}</b> ({timefmt.relative_label(post['CreatedAt'], current)})<br>"
+    content += f"<b>TOPIC:</b> <a href=\"/topic{post['Topic']}\">{post['Topic']}</a><br>"
+    content += f"{post['Body']}<br>"
+    content += "<hr>"
+    content += "<b>----REPLIES----</b><br><br>"
+    return content
+
+def render_reply(reply_id, author, body, timestamp, relative_time):
+    return (
+        f"<section id=\"reply_{reply_id}\">"
+        f"<b>REPLY:</b> <i><a href=\"/account/{author}\">{author}</a></i> <b>{timestamp}</b> ({relative_time}) <i>{reply_id}</i><br>"
+        f"{body}<br>"
+        "</section>"
+    )
+
+def render_post_actions(id, post, user, is_admin):
+    content = "<section id=\"reply_section\">"
     if user:
-        main_content += "<h2>Reply to this post</h2>"
-        main_content += f"<b>Logged in as: {user}</b><br>"
-        main_content += f"<form action=\"/reply/{id}\" method=\"post\">"
-        main_content += f"<textarea name=\"content\" id=\"reply_box\" rows=\"10\" cols=\"50\" required></textarea><br>"
-        main_content += f"<input type=\"submit\" value=\"Reply\">"
-        main_content += "</form>"
+        content += "<h2>Reply to this post</h2>"
+        content += f"<b>Logged in as: {user}</b><br>"
+        content += f"<form action=\"/reply/{id}\" method=\"post\">"
+        content += f"<textarea name=\"content\" id=\"reply_box\" rows=\"10\" cols=\"50\" required></textarea><br>"
+        content += f"<input type=\"submit\" value=\"Reply\">"
+        content += "</form>"
     else:
-        main_content += "<h2>Reply to this post</h2>"
-        main_content += "You must be logged in to reply to a post. <a href='/login'>Login</a> or <a href='/register'>register</a>."
-    main_content += "</section>"
+        content += "<h2>Reply to this post</h2>"
+        content += "You must be logged in to reply to a post. <a href='/login'>Login</a> or <a href='/register'>register</a>."
+    content += "</section>"
     if is_admin:
-        main_content += "<hr>"
-        main_content += "<h2>Admin actions</h2>"
-        main_content += f"[<a onclick=\"document.getElementById('admin_actions').style.display = 'block';\">Show admin actions</a>]<br>"
-        main_content += "<div id=\"admin_actions\" style=\"display: none;\">"
-        main_content += f"[<a href=\"/admin/deletepost/{id}\">Delete post</a>] "
-        main_content += f"[<a href=\"/admin/banuser/{post['Author']}\">Ban user</a>]<br>"
-        main_content += f"</div>"
-        main_content += "<script>"
-        main_content += "function replyQuote(id) {"
-        main_content += "document.getElementById('reply_box').value = document.getElementById('reply_' + id).innerText;"
+        content += "<hr>"
+        content += "<h2>Admin actions</h2>"
+        content += f"[<a onclick=\"document.getElementById('admin_actions').style.display = 'block';\">Show admin actions</a>]<br>"
+        content += "<div id=\"admin_actions\" style=\"display: none;\">"
+        content += f"[<a href=\"/admin/deletepost/{id}\">Delete post</a>] "
+        content += f"[<a href=\"/admin/banuser/{post['Author']}\">Ban user</a>]<br>"
+        content += f"</div>"
+        content += "<script>"
+        content += "function replyQuote(id) {"
+        content += "document.getElementById('reply_box').value = document.getElementById('reply_' + id).innerText;"
+    return content
+
+def reply_page_links(id, first, last, page, has_prev, has_next):
+    if has_prev:
+        token = pagination.encode_cursor(first['Timestamp'], first['ID'], page - 1)
+        links = f"<a href=\"/post/{id}?before={token}\"><-</a>"
+    else:
+        links = "<-"
+    links += f" Replies page {page} "
+    if has_next:
+        token = pagination.encode_cursor(last['Timestamp'], last['ID'], page + 1)
+        links += f"<a href=\"/post/{id}?after={token}\">-></a>"
+    else:
+        links += "->"
+    return links + "<br>"
+
+async def get_reply_page_start(id, after, before):
+    """
+    Works out where a page of replies starts. Returns the (Timestamp, ID)
+    of the reply the page follows, None for the first page, and the page
+    number. Raises ValueError on a bad cursor.
+    """
+
+    if after:
+        timestamp, reply_id, page = pagination.decode_cursor(after)
+        return (timestamp, reply_id), page
+    if before:
+        # The cursor is the first reply of the next page, the page starts
+        # after the reply one full page before it
+        timestamp, reply_id, page = pagination.decode_cursor(before)
+        start = await async_database.PublicPostReplies.Core.get_reply_before(id, timestamp, reply_id, REPLIES_PAGE_SIZE)
+        if start is None:
+            return None, 0
+        return start, max(page, 1)
+    return None, 0
+
+async def stream_post(head, tail, post, actions, start, page, limit):
+    # Replies are fetched in keyset batches on the database executor rather
+    # than from one open cursor, read connections belong to the executor
+    # thread that opened them
+    current = timefmt.now()
+    yield head
+    yield render_post_header(post, current)
+    timestamp, reply_id = start if start else (None, None)
+    first = last = None
+    sent = 0
+    while limit < 0 or sent < limit:
+        batch_size = STREAM_BATCH_SIZE if limit < 0 else min(STREAM_BATCH_SIZE, limit - sent)
+        replies = await async_database.PublicPostReplies.Core.get_replies_after(post['ID'], timestamp, reply_id, batch_size)
+        if not replies:
+            break
+        first = first or replies[0]
+        last = replies[-1]
+        sent += len(replies)
+        relative_times = timefmt.relative_labels([reply['CreatedAt'] for reply in replies], current)
+        yield "".join(
+            render_reply(reply['ID'], reply['Author'], reply['Body'], reply['Timestamp'], relative_time)
+            for reply, relative_time in zip(replies, relative_times)
+        )
+        if len(replies) < batch_size:
+            break
+        timestamp, reply_id = last['Timestamp'], last['ID']
+    if not sent:
+        yield "No replies yet<br>"
+    if limit > 0 and sent:
+        has_next = bool(await async_database.PublicPostReplies.Core.get_replies_after(post['ID'], last['Timestamp'], last['ID'], 1))
+        yield reply_page_links(post['ID'], first, last, page, start is not None, has_next)
+    yield actions
+    yield tail
+
+@router.get("/post/{id}")
+async def get_post(request: Request, id: str, after: str = None, before: str = None):
+    session = sessions_manager.get_session(request)
+    user = session["username"] if session else None
+    is_admin = session["role"] in database.ADMIN_ROLES if session else False
+    post = None
+    # The post and its replies are the same for everyone, the reply form
+    # and admin actions below depend on the session
+    cache_key = ("post", id, after, before)
+    main_content = page_cache.pages.get(cache_key)
+    if main_content is None:
+        generation = page_cache.pages.generation
+        post = await async_database.PublicPosts.Core.get_post(id)
+        if not post:
+            raise HTTPException(status_code=404, detail="Post not found")
+        try:
+            start, page = await get_reply_page_start(id, after, before)
+        except ValueError:
+            return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | View post", main_content=f"Invalid reply cursor. <a href=\"/post/{id}\">Go to the first page</a>"), status_code=400)
+
+        # A page size of 0 shows every reply on one page. Only pages that can
+        # hold more than STREAM_REPLY_THRESHOLD replies are streamed, a
+        # smaller page is rendered and cached like any other
+        limit = REPLIES_PAGE_SIZE or -1
+        if post['ReplyCount'] > STREAM_REPLY_THRESHOLD and (limit < 0 or limit > STREAM_REPLY_THRESHOLD):
+            head, tail = utils.generate_html_parts(request=request, title="Nexo Textboard | View post")
+            actions = render_post_actions(id, post, user, is_admin)
+            return StreamingResponse(stream_post(head, tail, post, actions, start, page, limit), media_type="text/html")
+
+        current = timefmt.now()
+        main_content = render_post_header(post, current)
+        timestamp, reply_id = start if start else (None, None)
+        replies = await async_database.PublicPostReplies.Core.get_replies_after(id, timestamp, reply_id, limit + 1 if limit > 0 else -1)
+        has_next = limit > 0 and len(replies) > limit
+        if has_next:
+            replies = replies[:limit]
+        if not replies:
+            main_content += "No replies yet<br>"
+        else:
+            relative_times = timefmt.relative_labels([reply['CreatedAt'] for reply in replies], current)
+            main_content += "".join(
+                render_reply(reply['ID'], reply['Author'], reply['Body'], reply['Timestamp'], relative_time)
+                for reply, relative_time in zip(replies, relative_times)
+            )
+            if limit > 0:
+                main_content += reply_page_links(id, replies[0], replies[-1], page, start is not None, has_next)
+        page_cache.pages.set(cache_key, main_content, [f"post:{id}"], generation)
+
+    if is_admin and post is None:
+        post = await async_database.PublicPosts.Core.get_post(id)
+    main_content += render_post_actions(id, post, user, is_admin)
     return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | View post", main_content=main_content))
 
+@router.get("/post/{id}/reply/{reply_id}")
+async def goto_reply(request: Request, id: str, reply_id: str):
+    """
+    Redirects to the page of the thread a reply is on, so #reply_<id> links
+    keep working however many replies come before it.
+    """
+
+    reply = await async_database.PublicPostReplies.Core.get_reply(reply_id)
+    if not reply or reply['PostID'] != id:
+        raise HTTPException(status_code=404, detail="Reply not found")
+    if not REPLIES_PAGE_SIZE:
+        return RedirectResponse(url=f"/post/{id}#reply_{reply_id}", status_code=303)
+    position = await async_database.PublicPostReplies.Core.get_reply_position(id, reply['Timestamp'], reply_id)
+    page = position // REPLIES_PAGE_SIZE
+    if page == 0:
+        return RedirectResponse(url=f"/post/{id}#reply_{reply_id}", status_code=303)
+    timestamp, start_id = await async_database.PublicPostReplies.Core.get_reply_before(id, reply['Timestamp'], reply_id, position % REPLIES_PAGE_SIZE)
+    token = pagination.encode_cursor(timestamp, start_id, page)
+    return RedirectResponse(url=f"/post/{id}?after={token}#reply_{reply_id}", status_code=303)
+
+@router.get("/post/{id}/reply_count")
+async def reply_count(id: str):
+    count = await async_database.PublicPosts.Core.get_reply_count(id)
+    if count is None:
+        return JSONResponse({"error": "Post not found"}, status_code=404)
+    return JSONResponse({"id": id, "reply_count": count})
+
 @router.post("/reply/{id}")
 async def reply_post(request: Request, id: str, content: str = Form(...)):
     username = sessions_manager.get_current_user(request)
@@ -169,19 +356,23 @@ async def reply_post(request: Request, id: str, content: str = Form(...)):
         return HTMLResponse(utils.generate_html(request=request, main_content="You must be logged in to reply to a post. <a href='/login'>Login</a> or <a href='/register'>register</a>."))
     if not content:
         return HTMLResponse(utils.generate_html(request=request, main_content="Content cannot be empty. <a href='/posts'>Go back</a>"))    
-    if not database.PublicPosts.Core.get_post(id):
+    if not await async_database.PublicPosts.Core.get_post(id):
         raise HTTPException(status_code=404, detail="Post not found")
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     reply_id = hashlib.sha256((content + username + id).encode()).hexdigest()
     reply_id = reply_id[:10]
-    database.PublicPostReplies.Core.add_reply(reply_id=reply_id, post_id=id, author=username, body=content, timestamp=timestamp)
+    await async_database.PublicPostReplies.Core.add_reply(reply_id=reply_id, post_id=id, author=username, body=content, timestamp=timestamp)
 
-    return HTMLResponse(utils.generate_html(request=request, title="Reply submitted", main_content="Reply submitted successfully! Redirecting to post... <script>setTimeout(function() { window.location.href = '/post/" + id + "'; }, 1000);</script>"))
+    return HTMLResponse(utils.generate_html(request=request, title="Reply submitted", main_content=f"Reply submitted successfully! Redirecting to post... <script>setTimeout(function() {{ window.location.href = '/post/{id}/reply/{reply_id}'; }}, 1000);</script>"))
 
 
 @router.get("/topics")
 async def topic(request: Request):
-    topics_list = database.Topics.Core.get_all_topics()
+    main_content = page_cache.pages.get(("topics",))
+    if main_content is not None:
+        return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Topics", main_content=main_content))
+    generation = page_cache.pages.generation
+    topics_list = await async_database.Topics.Core.get_all_topics()
     main_content = "<a href=\"/\">Home</a> > <a href=\"/posts\">Public posts</a> > <a href=\"/topic\">Topics</a><br>"
     main_content += "<h2>Topics</h2>"
     main_content += "<ul>"
@@ -193,44 +384,39 @@ async def topic(request: Request):
         else:
             main_content += f"<li><a href=\"/topic{name}\">{name}</a> - {topic['Description']}</li>"
     main_content += "</ul>"
+    page_cache.pages.set(("topics",), main_content, ["topics"], generation)
     return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Topics", main_content=main_content))
 
 @router.get("/topic/{topic_name}")
-async def topic_posts(request: Request, topic_name: str, page: int = 0):
+async def topic_posts(request: Request, topic_name: str, page: int = 0, after: str = None, before: str = None):
+    base_url = "/topic/" + topic_name
     topic_name = "/"+topic_name+"/"
-    posts = database.PublicPosts.Core.get_posts_by_topic(topic_name, page)
-    topic_info = database.Topics.Core.get_topic(topic_name)
+    if page < 0:
+        page = 0
+    cache_key = ("topic", topic_name, page, after, before)
+    main_content = page_cache.pages.get(cache_key)
+    if main_content is not None:
+        return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Topic", main_content=main_content))
+    generation = page_cache.pages.generation
+    try:
+        posts, page, has_prev, has_next = await get_posts_page(topic_name, page, after, before)
+    except ValueError:
+        return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Topic", main_content=f"Invalid page cursor. <a href=\"{base_url}\">Go to the first page</a>"), status_code=400)
+    topic_info = await async_database.Topics.Core.get_topic(topic_name)
     description = topic_info['Description'] if topic_info else "No description available"
     main_content = f"<b>{topic_name}</b><br>"
     main_content += f"{description}<br><br>"
     main_content += "All posts ordered by timestamp<br>"
 
-    for post in posts:
-        relative_time = ""
-        post_time = datetime.datetime.strptime(post['Timestamp'], "%Y-%m-%d %H:%M:%S")
-        now = datetime.datetime.now()
-        diff = relativedelta(now, post_time)
-        if diff.years > 0:
-            relative_time = f"{diff.years}y ago"
-        elif diff.months > 0:
-            relative_time = f"{diff.months}m ago"
-        elif diff.days > 0:
-            relative_time = f"{diff.days}d ago"
-        elif diff.hours > 0:
-            relative_time = f"{diff.hours}h ago"
-        elif diff.minutes > 0:
-            relative_time = f"{diff.minutes}m ago"
-        elif diff.seconds > 0:
-            relative_time = f"{diff.seconds}s ago"
-        else:
-            relative_time = "Just now"
-        main_content += f"{relative_time} Posted in <b>{post['Topic']}</b> by <i>{post['Author']}</i> {utils.get_username_tag(post['Author'])}\n <a href=\"/post/{post['ID']}\">{post['Title']}</a>\n\n"
-    if page == 0:
-        main_content += "<- Page 0 <a href=\"/topic/" + topic_name + "?page=" + str(page + 1) + "\">-></a>"
-    else:
-        main_content += "<a href=\"/topic/" + topic_name + "?page=" + str(page - 1) + "\"><-</a> Page " + str(page) + " <a href=\"/topic/" + topic_name + "?page=" + str(page + 1) + "\">-></a>"
+    username_tags = await async_database.run(utils.get_username_tags, [post['Author'] for post in posts])
+    relative_times = timefmt.relative_labels([post['CreatedAt'] for post in posts])
+    for post, relative_time in zip(posts, relative_times):
+        username_tag = username_tags[post['Author']]
+        main_content += f"{relative_time} Posted in <b>{post['Topic']}</b> by <i>{post['Author']}</i> {username_tag}\n <a href=\"/post/{post['ID']}\">{post['Title']}</a>\n\n"
+    main_content += page_links(base_url, posts, page, has_prev, has_next)
 
 
     if not posts:
         main_content = "No posts found<br>"
+    page_cache.pages.set(cache_key, main_content, listing_tags(f"topic:{topic_name}", posts), generation)
     return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Topic", main_content=main_content))
\ No newline at end of file
@@ -0,0 +1,55 @@
+from fastapi import Request, APIRouter
+from fastapi.responses import HTMLResponse
+
+import html
+import urllib.parse
+from .. import async_database
+from .. import search as search_index
+from .. import utils
+from .. import timefmt
+
+router = APIRouter()
+
+@router.get("/search")
+async def search(request: Request, q: str = "", topic: str = "", author: str = "", page: int = 0):
+    if page < 0:
+        page = 0
+    q = q.strip()
+    topic = topic.strip().strip("/")
+    author = author.strip().lower()
+
+    main_content = "<a href=\"/\">Home</a> > <a href=\"/search\">Search</a><br>"
+    main_content += "<h2>Search</h2>"
+    main_content += "<form action=\"/search\" method=\"get\">"
+    main_content += f"<input type=\"text\" name=\"q\" value=\"{html.escape(q)}\" placeholder=\"Search posts and replies\" required> "
+    main_content += f"Topic: <input type=\"text\" name=\"topic\" value=\"{html.escape(topic)}\" size=\"10\"> "
+    main_content += f"Author: <input type=\"text\" name=\"author\" value=\"{html.escape(author)}\" size=\"10\"> "
+    main_content += "<input type=\"submit\" value=\"Search\">"
+    main_content += "</form>"
+    if not q:
+        return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Search", main_content=main_content))
+
+    results, has_next = await async_database.run(
+        search_index.search, q,
+        topic=f"/{topic}/" if topic else None,
+        author=author or None,
+        page=page
+    )
+
+    if not results:
+        main_content += "No results found<br>"
+    relative_times = timefmt.relative_labels([result["CreatedAt"] for result in results])
+    for result, relative_time in zip(results, relative_times):
+        title = result["TitleSnippet"] if result["Kind"] == "post" else f"Reply to {html.escape(html.unescape(result['Title'] or ''))}"
+        link = f"/post/{result['PostID']}"
+        if result["Kind"] == "reply":
+            link += f"/reply/{result['RefID']}"
+        main_content += f"{relative_time} in <b>{result['Topic']}</b> by <i>{result['Author']}</i>\n <a href=\"{link}\">{title}</a>\n"
+        main_content += f"{result['BodySnippet']}\n\n"
+
+    params = {"q": q, "topic": topic, "author": author}
+    links = f"<a href=\"/search?{urllib.parse.urlencode({**params, 'page': page - 1})}\"><-</a>" if page > 0 else "<-"
+    links += f" Page {page} "
+    links += f"<a href=\"/search?{urllib.parse.urlencode({**params, 'page': page + 1})}\">-></a>" if has_next else "->"
+    main_content += links
+    return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Search", main_content=main_content))
@@ -1,34 +1,68 @@
 from fastapi import FastAPI, Request, Header, HTTPException, UploadFile, File, Form, Response, APIRouter
 from fastapi.responses import JSONResponse, PlainTextResponse, HTMLResponse, FileResponse
 
+from .. import async_database
 from .. import utils
+from .. import metrics
 from .. import sessions_manager
+from .. import templates
+from .. import static_assets
+import os
 
 router = APIRouter()
 
+DOCS_DIR = os.path.realpath("docs")
+
+# Build the stylesheet and its compressed variants before the first request
+static_assets.stylesheet()
+
 @router.get("/")
 async def root(request: Request):
-    file = open("src/static/index.html", "r")
-    content = file.read()
-
-    file.close()
+    content = templates.load("src/static/index.html")
     return HTMLResponse(utils.generate_html(request=request, title="Nexo System", main_content=content))
 
 @router.get("/style")
 async def style(request: Request):
-    color = open("src/static/css/custom/color/catppuccin-mocha.css", "r").read()
-    style = open("src/static/css/main.css", "r").read()
-    content = style + "\n" + color
-    return PlainTextResponse(content, media_type="text/css")
+    return static_assets.asset_response(request, static_assets.stylesheet())
+
+@router.get("/style/{fingerprint}.css")
+async def style_fingerprinted(request: Request, fingerprint: str):
+    asset = static_assets.stylesheet()
+    if fingerprint != asset.hash:
+        return static_assets.asset_response(request, asset)
+    return static_assets.asset_response(request, asset, static_assets.CACHE_IMMUTABLE)
 
 @router.get("/docs/{path:path}")
-async def style(request: Request, path: str):
-    file = open("docs/" + path, "rb")
-    content = file.read()
-    file.close()
-    return HTMLResponse(utils.generate_html(request=request, title="Nexo Documentation", main_content=content.decode("utf-8")))
+async def docs(request: Request, path: str):
+    file_path = os.path.realpath(os.path.join(DOCS_DIR, path))
+    if not file_path.startswith(DOCS_DIR + os.sep) or not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="Document not found")
+    content = templates.load(file_path)
+    return static_assets.html_response(request, utils.generate_html(request=request, title="Nexo Documentation", main_content=content))
 
 @router.get("/status")
 async def status(request: Request):
-    main_content = "ok"
-    return HTMLResponse(utils.generate_html(request=request, main_content=main_content))
+    system = await async_database.run(utils.get_stats)
+    uptime = system["uptime_seconds"]
+    requests = system["requests"]
+    main_content = f"""
+System UP
+<b>UPTIME:</b> {uptime // 86400} days, {uptime // 3600 % 24} hours, {uptime // 60 % 60} minutes
+<b>VERSION:</b> {system['version']}
+<b>TOTAL POSTS:</b> {system['counts']['posts']}
+<b>TOTAL REPLIES:</b> {system['counts']['replies']}
+<b>TOTAL USERS:</b> {system['counts']['users']}
+<b>TOTAL TOPICS:</b> {system['counts']['topics']}
+<b>REQUESTS:</b> {requests['per_second']}/s, {requests['total']} total, {requests['errors']} errors
+<b>LATENCY:</b> p50 {requests['latency_ms']['p50']}ms, p95 {requests['latency_ms']['p95']}ms, p99 {requests['latency_ms']['p99']}ms
+"""
+    return HTMLResponse(utils.generate_html(request=request, title="Nexo Textboard | Status", main_content=main_content), headers={"Cache-Control": "no-store"})
+
+@router.get("/metrics")
+async def metrics_page(request: Request):
+    body = await async_database.run(metrics.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8", headers={"Cache-Control": "no-store"})
+
+@router.get("/status.json")
+async def status_json(request: Request):
+    return JSONResponse(await async_database.run(utils.get_stats), headers={"Cache-Control": "no-store"})
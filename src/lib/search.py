@@ -0,0 +1,177 @@
+import html
+import re
+
+from . import db_pool
+from . import logger
+
+# Full text search over posts and replies. SearchIndex is an FTS5 table
+# holding the plain text of every post title/body and reply body, its rowid
+# is the DocID of the matching SearchDocs row which records what the
+# document is and the metadata used for filtering. Both are written inside
+# the same transaction as the post or reply they index.
+
+PAGE_SIZE = 20
+# Title matches count for more than body matches
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+SNIPPET_TOKENS = 24
+MAX_TERMS = 16
+
+_TAGS = re.compile(r"<[^>]*>")
+_WORDS = re.compile(r"\S+")
+# Snippet markers, escaped separately from the text around them
+_MARK_START = "\x02"
+_MARK_END = "\x03"
+
+def plain_text(body):
+    """
+    Strips the HTML stored in post and reply bodies down to the text that
+    gets indexed.
+
+    Args:
+        body (str): The sanitized HTML body.
+    """
+
+    return " ".join(html.unescape(_TAGS.sub(" ", body or "")).split())
+
+def build_query(query):
+    """
+    Turns user input into an FTS5 query. Every term is quoted so FTS5
+    operators and column filters in the input are matched as plain text,
+    terms are ANDed together. A trailing * on a term is kept as a prefix
+    match. Returns None when there is nothing to search for.
+
+    Args:
+        query (str): The search box input.
+    """
+
+    terms = []
+    for word in _WORDS.findall(query)[:MAX_TERMS]:
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    return " ".join(terms) or None
+
+def index_post(c, id, title, author, timestamp, topic, body):
+    c.execute(
+        "INSERT INTO SearchDocs (Kind, RefID, PostID, Topic, Author, Timestamp) VALUES ('post', ?, ?, ?, ?, ?)",
+        (id, id, topic, author, timestamp)
+    )
+    c.execute("INSERT INTO SearchIndex (rowid, Title, Body) VALUES (?, ?, ?)", (c.lastrowid, plain_text(title), plain_text(body)))
+
+def index_reply(c, reply_id, post_id, author, timestamp, body):
+    # Replies are filtered by the topic of the post they belong to
+    c.execute(
+        "INSERT INTO SearchDocs (Kind, RefID, PostID, Topic, Author, Timestamp) SELECT 'reply', ?, ID, Topic, ?, ? FROM PublicPosts WHERE ID = ?",
+        (reply_id, author, timestamp, post_id)
+    )
+    if c.rowcount == 0:
+        return
+    c.execute("INSERT INTO SearchIndex (rowid, Title, Body) VALUES (?, '', ?)", (c.lastrowid, plain_text(body)))
+
+def update_post_body(c, id, body):
+    c.execute(
+        "UPDATE SearchIndex SET Body = ? WHERE rowid = (SELECT DocID FROM SearchDocs WHERE Kind = 'post' AND RefID = ?)",
+        (plain_text(body), id)
+    )
+
+def remove_post(c, id):
+    # Drops the post and every reply to it
+    c.execute("DELETE FROM SearchIndex WHERE rowid IN (SELECT DocID FROM SearchDocs WHERE PostID = ?)", (id,))
+    c.execute("DELETE FROM SearchDocs WHERE PostID = ?", (id,))
+
+def remove_reply(c, reply_id):
+    c.execute("DELETE FROM SearchIndex WHERE rowid IN (SELECT DocID FROM SearchDocs WHERE Kind = 'reply' AND RefID = ?)", (reply_id,))
+    c.execute("DELETE FROM SearchDocs WHERE Kind = 'reply' AND RefID = ?", (reply_id,))
+
+def rebuild(c, batch_size=5000):
+    """
+    Clears the index and indexes every post and reply again. Runs on the
+    given write cursor so it is part of the caller's transaction.
+
+    Args:
+        c (sqlite3.Cursor): A cursor inside a write transaction.
+        batch_size (int): Rows read and inserted per batch.
+    """
+
+    c.execute("DELETE FROM SearchIndex")
+    c.execute("DELETE FROM SearchDocs")
+    conn = c.connection
+    total = 0
+
+    source = conn.execute("SELECT ID, Title, Author, Timestamp, Topic, Body FROM PublicPosts ORDER BY rowid")
+    while rows := source.fetchmany(batch_size):
+        for row in rows:
+            index_post(c, row["ID"], row["Title"], row["Author"], row["Timestamp"], row["Topic"], row["Body"])
+        total += len(rows)
+
+    source = conn.execute("SELECT ID, PostID, Author, Timestamp, Body FROM PublicPostsReplies ORDER BY rowid")
+    while rows := source.fetchmany(batch_size):
+        for row in rows:
+            index_reply(c, row["ID"], row["PostID"], row["Author"], row["Timestamp"], row["Body"])
+        total += len(rows)
+
+    c.execute("INSERT INTO SearchIndex (SearchIndex) VALUES ('optimize')")
+    logger.log("Search", "Indexed %s posts and replies", total)
+    return total
+
+def rebuild_index():
+    """
+    Rebuilds the search index in its own write transaction.
+    """
+
+    with db_pool.write() as c:
+        return rebuild(c)
+
+def _snippet(text):
+    return html.escape(text).replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
+
+def search(query, topic=None, author=None, page=0, limit=PAGE_SIZE):
+    """
+    Searches posts and replies, best match first. Soft deleted posts and
+    their replies are left out. Returns up to limit results and whether
+    there are more.
+
+    Args:
+        query (str): The search box input.
+        topic (str): Only return results from this topic.
+        author (str): Only return results by this user.
+        page (int): The page of results.
+        limit (int): Results per page.
+    """
+
+    match = build_query(query)
+    if match is None:
+        return [], False
+
+    sql = f"""
+        SELECT d.Kind, d.RefID, d.PostID, d.Topic, d.Author, d.Timestamp, COALESCE(r.CreatedAt, p.CreatedAt) AS CreatedAt, p.Title,
+            snippet(SearchIndex, 0, '{_MARK_START}', '{_MARK_END}', '...', {SNIPPET_TOKENS}) AS TitleSnippet,
+            snippet(SearchIndex, 1, '{_MARK_START}', '{_MARK_END}', '...', {SNIPPET_TOKENS}) AS BodySnippet
+        FROM SearchIndex
+        JOIN SearchDocs d ON d.DocID = SearchIndex.rowid
+        JOIN PublicPosts p ON p.ID = d.PostID
+        LEFT JOIN PublicPostsReplies r ON d.Kind = 'reply' AND r.ID = d.RefID
+        WHERE SearchIndex MATCH ? AND p.Deleted IS NOT 'True'"""
+    params = [match]
+    if topic:
+        sql += " AND d.Topic = ?"
+        params.append(topic)
+    if author:
+        sql += " AND d.Author = ?"
+        params.append(author)
+    sql += f" ORDER BY bm25(SearchIndex, {TITLE_WEIGHT}, {BODY_WEIGHT}) LIMIT ? OFFSET ?"
+    params += [limit + 1, page * limit]
+
+    logger.debug("Search", "Searching for %s in %s by %s page %s", match, topic, author, page)
+    with db_pool.read() as c:
+        rows = c.execute(sql, params).fetchall()
+
+    results = []
+    for row in rows[:limit]:
+        result = dict(row)
+        result["TitleSnippet"] = _snippet(result["TitleSnippet"] or "")
+        result["BodySnippet"] = _snippet(result["BodySnippet"] or "")
+        results.append(result)
+    return results, len(rows) > limit
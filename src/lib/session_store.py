@@ -0,0 +1,158 @@
+import os
+import secrets
+import threading
+import time
+
+from . import db_pool
+from . import logger
+from . import write_queue
+
+# Sessions expire after SESSION_TTL seconds without a request. The expiry
+# is pushed forward on use, at most once every TOUCH_INTERVAL seconds so
+# the SQLite backend does not write on every request.
+SESSION_TTL = int(os.environ.get("NEXO_SESSION_TTL", str(7 * 24 * 3600)))
+TOUCH_INTERVAL = int(os.environ.get("NEXO_SESSION_TOUCH_INTERVAL", "60"))
+SWEEP_INTERVAL = int(os.environ.get("NEXO_SESSION_SWEEP_INTERVAL", "300"))
+BACKEND = os.environ.get("NEXO_SESSION_BACKEND", "memory")
+
+def new_session_id():
+    return secrets.token_hex(16)
+
+class MemorySessionStore:
+    """
+    Keeps sessions in a dict local to this process. Fast, but sessions are
+    lost on restart and are not shared between workers.
+    """
+
+    # Lookups never block, they can run on the event loop
+    blocking = False
+    # Changes are only seen by this process
+    shared = False
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        now = time.time()
+        if session["expires"] <= now:
+            self.delete(session_id)
+            return None
+        if session["expires"] - now < self.ttl - TOUCH_INTERVAL:
+            session["expires"] = now + self.ttl
+        return session
+
+    def create(self, username, role):
+        session_id = new_session_id()
+        with self.lock:
+            self.sessions[session_id] = {"username": username, "role": role, "expires": time.time() + self.ttl}
+        return session_id
+
+    def delete(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        return session["username"] if session else None
+
+    def update_role(self, username, role):
+        with self.lock:
+            for session in self.sessions.values():
+                if session["username"] == username:
+                    session["role"] = role
+
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            expired = [session_id for session_id, session in self.sessions.items() if session["expires"] <= now]
+            for session_id in expired:
+                del self.sessions[session_id]
+        return len(expired)
+
+    def count(self):
+        return len(self.sessions)
+
+class SQLiteSessionStore:
+    """
+    Keeps sessions in the Sessions table of the main database so every
+    worker process sees the same sessions and they survive restarts.
+    Writes go through the write queue like every other write.
+    """
+
+    # Lookups read the database and belong on the database executor
+    blocking = True
+    # Every process using the database sees changes
+    shared = True
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+
+    def get(self, session_id):
+        with db_pool.read() as c:
+            c.execute("SELECT Username, Role, Expires FROM Sessions WHERE ID = ?", (session_id,))
+            row = c.fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row["Expires"] <= now:
+            self.delete(session_id)
+            return None
+        if row["Expires"] - now < self.ttl - TOUCH_INTERVAL:
+            write_queue.execute("UPDATE Sessions SET Expires = ? WHERE ID = ?", (int(now + self.ttl), session_id))
+        return {"username": row["Username"], "role": row["Role"], "expires": row["Expires"]}
+
+    def create(self, username, role):
+        session_id = new_session_id()
+        write_queue.execute("INSERT INTO Sessions (ID, Username, Role, Expires) VALUES (?, ?, ?, ?)", (session_id, username, role, int(time.time() + self.ttl)))
+        return session_id
+
+    def delete(self, session_id):
+        def delete_session(c):
+            c.execute("SELECT Username FROM Sessions WHERE ID = ?", (session_id,))
+            row = c.fetchone()
+            c.execute("DELETE FROM Sessions WHERE ID = ?", (session_id,))
+            return row["Username"] if row else None
+        return write_queue.submit(delete_session)
+
+    def update_role(self, username, role):
+        write_queue.execute("UPDATE Sessions SET Role = ? WHERE Username = ?", (role, username))
+
+    def sweep(self):
+        return write_queue.execute("DELETE FROM Sessions WHERE Expires <= ?", (int(time.time()),))
+
+    def count(self):
+        with db_pool.read() as c:
+            return c.execute("SELECT COUNT(*) FROM Sessions").fetchone()[0]
+
+BACKENDS = {
+    "memory": MemorySessionStore,
+    "sqlite": SQLiteSessionStore,
+}
+
+def create_store(backend=BACKEND):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown session backend {backend}, expected one of {', '.join(BACKENDS)}")
+    logger.debug("SessionStore", "Using %s session store", backend)
+    return BACKENDS[backend]()
+
+def start_sweeper(store, interval=SWEEP_INTERVAL):
+    """
+    Starts a daemon thread that removes expired sessions every interval
+    seconds.
+    """
+
+    def sweep_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                removed = store.sweep()
+                if removed:
+                    logger.log("SessionStore", "Removed %s expired sessions", removed)
+            except Exception as e:
+                logger.log_error("SessionStore", "Session sweep failed: %s", e)
+
+    thread = threading.Thread(target=sweep_forever, name="nexo-session-sweeper", daemon=True)
+    thread.start()
+    return thread
@@ -1,42 +1,78 @@
-import secrets
-
 import lib.logger as logger
+import lib.session_store as session_store
+import lib.metrics as metrics
+import lib.async_database as async_database
+
+store = session_store.create_store()
+metrics.Gauge("nexo_sessions", "Sessions held by the session store.").set_function(store.count)
+
+_UNSET = object()
+
+def start_sweeper():
+    """
+    Starts removing expired sessions in the background. Called on app
+    startup in every serving process, not on import, so scripts importing
+    this module run no threads.
+    """
+
+    return session_store.start_sweeper(store)
+
+def get_session(request):
+    """
+    Returns the request's session, looked up once per request. The
+    middleware loads it with load_session() first, so this only reads the
+    store itself outside a request handler.
+    """
+
+    session = getattr(request.state, "session", _UNSET)
+    if session is _UNSET:
+        session_id = request.cookies.get("session_id")
+        session = store.get(session_id) if session_id else None
+        request.state.session = session
+    return session
 
-sessions = {}
+async def load_session(request):
+    """
+    Looks up the request's session off the event loop when the store reads
+    the database.
+    """
+
+    if store.blocking and request.cookies.get("session_id"):
+        return await async_database.run(get_session, request)
+    return get_session(request)
 
 def get_current_user(request):
-    session_id = request.cookies.get("session_id")
-    
-    return sessions.get(session_id)
+    session = get_session(request)
+    return session["username"] if session else None
 
-def login_user(request, username):
-    session_id = request.cookies.get("session_id")
-    if session_id:
-        sessions[session_id] = username
-    else:
-        session_id = secrets.token_hex(16)
-        sessions[session_id] = username
-    logger.log("SessionManager", f"User {username} logged in.")
+def login_user(request, username, role=None):
+    # Always issue a fresh ID so a session ID planted before login is useless
+    old_session_id = request.cookies.get("session_id")
+    if old_session_id:
+        store.delete(old_session_id)
+    session_id = store.create(username, role)
+    request.state.session = None
+    logger.log("SessionManager", "User %s logged in.", username)
     return session_id
 
 def logout_user(request):
     session_id = request.cookies.get("session_id")
-    if session_id in sessions:
-        username = sessions[session_id]
-        del sessions[session_id]
+    username = store.delete(session_id) if session_id else None
+    request.state.session = None
+    if username:
+        logger.log("SessionManager", "User %s logged out.", username)
     else:
         logger.log("SessionManager", "Logout request with no session ID.")
-    logger.log("SessionManager", f"User {username} logged out.")
 
     return session_id
 
 def is_logged_in(request):
-    session_id = request.cookies.get("session_id")
-    logger.log("SessionManager", f"Check if user is logged in: {request}")
-    return session_id in sessions
+    logger.debug("SessionManager", "Check if user is logged in")
+    return get_session(request) is not None
 
 def get_user_role(request):
-    session_id = request.cookies.get("session_id")
-    if session_id in sessions:
-        return sessions[session_id]
-    return None
\ No newline at end of file
+    session = get_session(request)
+    return session["role"] if session else None
+
+def update_role(username, role):
+    store.update_role(username, role)
@@ -0,0 +1,136 @@
+from fastapi import Request
+from fastapi.responses import Response, FileResponse
+from email.utils import formatdate, parsedate_to_datetime
+
+import gzip
+import hashlib
+import os
+
+from . import templates
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STYLESHEETS = ["src/static/css/main.css", "src/static/css/custom/color/catppuccin-mocha.css"]
+
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "public, max-age=0, must-revalidate"
+CACHE_PRIVATE = "private, no-cache"
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 512
+
+class Asset:
+    """
+    An in-memory static file with its validators and precompressed variants
+    built once when the asset is created.
+    """
+
+    def __init__(self, body, media_type, mtime):
+        self.body = body
+        self.media_type = media_type
+        self.hash = hashlib.sha256(body).hexdigest()[:16]
+        self.etag = f'"{self.hash}"'
+        self.mtime = int(mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.variants = {}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(body, quality=11)
+            self.variants["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+
+def is_not_modified(request: Request, etag, mtime):
+    """
+    Checks the conditional request headers against a validator pair.
+    If-None-Match takes precedence over If-Modified-Since.
+    """
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def choose_encoding(request: Request, asset):
+    accept = request.headers.get("accept-encoding", "")
+    for encoding in ("br", "gzip"):
+        if encoding in asset.variants and encoding in accept:
+            return encoding
+    return None
+
+def asset_response(request: Request, asset, cache_control=CACHE_REVALIDATE):
+    """
+    Serves an Asset, answering conditional requests with a 304 and picking
+    the best precompressed variant the client accepts.
+    """
+
+    headers = {
+        "ETag": asset.etag,
+        "Last-Modified": asset.last_modified,
+        "Cache-Control": cache_control,
+        "Vary": "Accept-Encoding",
+    }
+    if is_not_modified(request, asset.etag, asset.mtime):
+        return Response(status_code=304, headers=headers)
+    encoding = choose_encoding(request, asset)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)
+    return Response(asset.body, media_type=asset.media_type, headers=headers)
+
+def file_response(request: Request, path, cache_control=CACHE_REVALIDATE, media_type=None):
+    """
+    Serves a file from disk with stat based validators, answering
+    conditional requests with a 304 without opening the file.
+    """
+
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(int(stat.st_mtime), usegmt=True),
+        "Cache-Control": cache_control,
+    }
+    if is_not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+
+def html_response(request: Request, html, cache_control=CACHE_PRIVATE):
+    """
+    Serves rendered HTML with a content hash ETag so unchanged pages are
+    answered with a 304 and no body.
+    """
+
+    body = html.encode("utf-8")
+    etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="text/html", headers=headers)
+
+def _build_stylesheet(*contents):
+    mtime = max(os.stat(path).st_mtime for path in STYLESHEETS)
+    return Asset("\n".join(contents).encode("utf-8"), "text/css", mtime)
+
+def stylesheet():
+    """
+    Returns the combined stylesheet asset, rebuilt when a CSS file changes.
+    """
+
+    return templates.derive("stylesheet", STYLESHEETS, _build_stylesheet)
+
+def stylesheet_url():
+    """
+    Returns the fingerprinted URL of the current stylesheet.
+    """
+
+    return f"/style/{stylesheet().hash}.css"
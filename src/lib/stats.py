@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+from . import db_pool
+
+# Row counts for /status live in the Stats table. The write functions in
+# lib/database.py adjust them in the same transaction as the rows they count
+# and reconcile() recounts them on startup, so reading them is a single
+# small query instead of loading every table.
+COUNTERS = {
+    "posts": "PublicPosts",
+    "replies": "PublicPostsReplies",
+    "users": "Users",
+    "topics": "Topics",
+}
+
+RATE_WINDOW = int(os.environ.get("NEXO_STATS_RATE_WINDOW", "60"))
+LATENCY_SAMPLES = int(os.environ.get("NEXO_STATS_LATENCY_SAMPLES", "1024"))
+
+def increment(c, name, amount=1):
+    """
+    Adjusts a counter inside the caller's write transaction.
+
+    Args:
+        c (sqlite3.Cursor): A cursor on the writer connection.
+        name (str): One of COUNTERS.
+        amount (int): Added to the counter, negative to subtract.
+    """
+
+    c.execute("UPDATE Stats SET Value = Value + ? WHERE Name = ?", (amount, name))
+
+def reconcile():
+    """
+    Recounts every counter from its table.
+    """
+
+    with db_pool.write() as c:
+        for name, table in COUNTERS.items():
+            c.execute(f"INSERT OR REPLACE INTO Stats (Name, Value) SELECT ?, COUNT(*) FROM {table}", (name,))
+
+def counts():
+    with db_pool.read() as c:
+        c.execute("SELECT Name, Value FROM Stats")
+        rows = {row["Name"]: row["Value"] for row in c.fetchall()}
+    return {name: rows.get(name, 0) for name in COUNTERS}
+
+class RequestStats:
+    """
+    Request counts per second over the last window seconds and the latency
+    of the last samples requests, both in fixed size rings.
+    """
+
+    def __init__(self, window=RATE_WINDOW, samples=LATENCY_SAMPLES):
+        self.window = window
+        self.lock = threading.Lock()
+        self.seconds = [0] * window
+        self.counts = [0] * window
+        self.latencies = [0.0] * samples
+        self.latency_count = 0
+        self.total = 0
+        self.errors = 0
+
+    def record(self, seconds, status_code):
+        second = int(time.time())
+        with self.lock:
+            slot = second % self.window
+            if self.seconds[slot] != second:
+                self.seconds[slot] = second
+                self.counts[slot] = 0
+            self.counts[slot] += 1
+            self.latencies[self.latency_count % len(self.latencies)] = seconds
+            self.latency_count += 1
+            self.total += 1
+            if status_code >= 500:
+                self.errors += 1
+
+    def rate(self):
+        # Requests per second over the window, the current second is left
+        # out as it is still filling up
+        second = int(time.time())
+        with self.lock:
+            count = sum(count for at, count in zip(self.seconds, self.counts) if second - self.window < at < second)
+        return count / (self.window - 1)
+
+    def percentiles(self, *quantiles):
+        with self.lock:
+            samples = sorted(self.latencies[:min(self.latency_count, len(self.latencies))])
+        if not samples:
+            return {f"p{round(q * 100)}": 0 for q in quantiles}
+        return {f"p{round(q * 100)}": samples[min(len(samples) - 1, int(q * len(samples)))] * 1000 for q in quantiles}
+
+    def snapshot(self):
+        return {
+            "total": self.total,
+            "errors": self.errors,
+            "per_second": round(self.rate(), 3),
+            "latency_ms": {name: round(value, 3) for name, value in self.percentiles(0.5, 0.95, 0.99).items()},
+        }
+
+requests = RequestStats()
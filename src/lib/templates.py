@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+
+from . import logger
+
+# How often a cached file is checked for changes on disk. Between checks
+# the cached copy is served without touching the filesystem.
+CHECK_INTERVAL = float(os.environ.get("NEXO_TEMPLATE_CHECK_INTERVAL", "1.0"))
+
+_lock = threading.Lock()
+_files = {}
+_derived = {}
+
+def load(path, mode="r"):
+    """
+    Returns the contents of a file, reading it from disk only the first time
+    and again after its mtime changes.
+
+    Args:
+        path (str): The path of the file.
+        mode (str): "r" for text, "rb" for bytes.
+    """
+
+    now = time.monotonic()
+    entry = _files.get((path, mode))
+    if entry and now - entry[2] < CHECK_INTERVAL:
+        return entry[0]
+
+    mtime = os.stat(path).st_mtime_ns
+    if entry and entry[1] == mtime:
+        entry[2] = now
+        return entry[0]
+
+    with open(path, mode) as file:
+        content = file.read()
+    logger.debug("Templates", "Loaded %s", path)
+    with _lock:
+        _files[(path, mode)] = [content, mtime, now]
+    return content
+
+def derive(name, paths, build):
+    """
+    Returns build(*contents) for the given files, caching the result until
+    one of the files changes.
+
+    Args:
+        name (str): A unique name for the cached value.
+        paths (list): The files the value is built from.
+        build (callable): Called with the file contents to build the value.
+    """
+
+    contents = tuple(load(path) for path in paths)
+    entry = _derived.get(name)
+    if entry and len(entry[0]) == len(contents) and all(a is b for a, b in zip(entry[0], contents)):
+        return entry[1]
+    value = build(*contents)
+    with _lock:
+        _derived[name] = (contents, value)
+    return value
+
+def clear():
+    """
+    Drops every cached file and derived value so they are rebuilt from disk
+    on next use.
+    """
+
+    with _lock:
+        _files.clear()
+        _derived.clear()
+    logger.log("Templates", "Template cache cleared")
@@ -0,0 +1,96 @@
+import calendar
+import datetime
+import os
+import time
+
+from . import cache
+from . import metrics
+
+# Relative "3h ago" labels for listings. Posts and replies store their
+# creation time as an epoch in CreatedAt so a label is plain integer maths
+# against one "now" per page. Only labels of a month or more need calendar
+# arithmetic, those are cached per timestamp together with the window in
+# which they stay valid.
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+# No calendar month is shorter than this
+SHORTEST_MONTH = 28 * DAY
+
+month_cache = cache.LRUCache(maxsize=int(os.environ.get("NEXO_TIME_LABEL_CACHE_SIZE", "16384")))
+metrics.track_cache("time_labels", month_cache)
+
+def now():
+    return int(time.time())
+
+def to_epoch(timestamp):
+    """
+    Converts a Timestamp column value to an epoch, falling back to the
+    current time if it cannot be parsed.
+
+    Args:
+        timestamp (str): A local time in TIMESTAMP_FORMAT.
+    """
+
+    try:
+        return int(datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        return now()
+
+def _add_months(dt, months):
+    # Clamps to the last day of the month like dateutil's relativedelta
+    month = dt.month - 1 + months
+    year = dt.year + month // 12
+    month = month % 12 + 1
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return dt.replace(year=year, month=month, day=day)
+
+def _months_between(then, current):
+    entry = month_cache.get(then)
+    if entry is not None and entry[1] <= current < entry[2]:
+        return entry[0]
+    start = datetime.datetime.fromtimestamp(then)
+    end = datetime.datetime.fromtimestamp(current)
+    months = (end.year - start.year) * 12 + end.month - start.month
+    if _add_months(start, months) > end:
+        months -= 1
+    valid_from = _add_months(start, months).timestamp()
+    valid_until = _add_months(start, months + 1).timestamp()
+    month_cache.set(then, (months, valid_from, valid_until))
+    return months
+
+def relative_label(then, current):
+    if then is None:
+        return ""
+    delta = current - then
+    if delta >= SHORTEST_MONTH:
+        months = _months_between(then, current)
+        if months >= 12:
+            return f"{months // 12}y ago"
+        if months > 0:
+            return f"{months}m ago"
+    if delta >= DAY:
+        return f"{delta // DAY}d ago"
+    if delta >= HOUR:
+        return f"{delta // HOUR}h ago"
+    if delta >= MINUTE:
+        return f"{delta // MINUTE}m ago"
+    if delta > 0:
+        return f"{delta}s ago"
+    return "Just now"
+
+def relative_labels(epochs, current=None):
+    """
+    Returns a relative label for every epoch, all measured against the same
+    moment.
+
+    Args:
+        epochs (list): CreatedAt values, None gives an empty label.
+        current (int): The epoch to measure against, defaults to now.
+    """
+
+    if current is None:
+        current = now()
+    return [relative_label(then, current) for then in epochs]
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import threading
+import time
+
+from . import logger
+
+# One SHA-256 hex digest of an exit node IP per line, as written by
+# tools/torlist.py. The file is re-read when its mtime changes, checked at
+# most once every RELOAD_INTERVAL seconds.
+TOR_LIST_PATH = os.environ.get("NEXO_TOR_LIST", "data/torlist.txt")
+RELOAD_INTERVAL = float(os.environ.get("NEXO_TOR_RELOAD_INTERVAL", "60"))
+
+def hash_ip(ip):
+    """
+    Hashes an IP address the same way everywhere in Nexo.
+
+    Args:
+        ip (str): The IP address.
+    """
+
+    return hashlib.sha256(ip.encode()).hexdigest()
+
+class TorList:
+    def __init__(self, path=TOR_LIST_PATH):
+        self.path = path
+        self.hashes = frozenset()
+        self.mtime = None
+        self.next_check = 0
+        self.lock = threading.Lock()
+
+    def reload(self, force=False):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            if self.mtime is not None:
+                logger.log_warning("Tor", "%s is gone, keeping the last loaded list", self.path)
+            return
+        if mtime == self.mtime and not force:
+            return
+        with open(self.path, "r") as file:
+            hashes = frozenset(line.strip() for line in file if line.strip())
+        # Swap in the new set in one assignment so lookups never see a
+        # partially loaded list
+        self.hashes = hashes
+        self.mtime = mtime
+        logger.log("Tor", "Loaded %s Tor exit hashes", len(hashes))
+
+    def __contains__(self, ip_hash):
+        now = time.monotonic()
+        if now >= self.next_check and self.lock.acquire(blocking=False):
+            try:
+                self.next_check = now + RELOAD_INTERVAL
+                self.reload()
+            finally:
+                self.lock.release()
+        return ip_hash in self.hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+tor_list = TorList()
+tor_list.reload()
@@ -3,40 +3,43 @@ from datetime import datetime
 from lib import sessions_manager
 from lib import database
 from lib import globals
+from lib import templates
+from lib import static_assets
+from lib import tor
+from lib import stats
+from lib import write_queue
 
 import hashlib
 
-tor_list = open("data/torlist.txt", "r").read().split("\n")
 
-def generate_html(request: Request, title="Nexo Textboard", main_content="Server did not return any content", footer_content=""):
-    account_links = get_account_links(request)
-    banner = open("src/static/banner.html", "r").read()
-    if hashlib.sha256((request.client.host).encode()).hexdigest() in tor_list:
-        title += " | Connected on TOR"
-    return f"""
+BANNER_PATH = "src/static/banner.html"
+
+# The page shell, split on the slots that change per request. The banner is
+# static so it is baked into the fragments.
+PAGE_SHELL = """
 <!DOCTYPE html>
 <html>
 	<head>
 		<meta charset="utf-8">
 		<meta http-equiv="X-UA-Compatible" content="IE=edge">
-		<title>{title}</title>
+		<title>\0</title>
 		<meta name="description" content="">
 		<meta name="viewport" content="width=device-width, initial-scale=1">
-		<link rel="stylesheet" href="/style">
+		<link rel="stylesheet" href="\0">
 	</head>
 	<body>
 		<div class="main">
-			<b>{title}</b>
+			<b>\0</b>
 			<br>
-            {account_links}
+            \0
 			<br>
 			[<a href="/">Home</a>] [<a href="/status">Status</a>] [<a href="/posts">Public posts</a><span>] [</span><a href="/topics">Topics</a><span>]
             <br>
             {banner}
 			<hr>
-            <pre>{main_content}</pre>
+            <pre>\0</pre>
 			<hr>
-            <pre>{footer_content}
+            <pre>\0
 Copyright &copy; 2025 0x4248 and Contributors
 Under the GNU General Public License v3.0
 <a href="/privacy">Privacy Policy</a> / <a href="/terms">Terms of Service</a> 
@@ -46,41 +49,97 @@ Under the GNU General Public License v3.0
 </html>
 """
 
+def get_page_shell():
+    return templates.derive("page_shell", [BANNER_PATH], lambda banner: tuple(PAGE_SHELL.replace("{banner}", banner).split("\0")))
+
+def generate_html_parts(request: Request, title="Nexo Textboard", footer_content=""):
+    """
+    Returns the page before and after the main content, for responses that
+    send the main content in pieces.
+    """
+
+    account_links = get_account_links(request)
+    if is_tor(request):
+        title += " | Connected on TOR"
+    shell = get_page_shell()
+    head = "".join((
+        shell[0], title,
+        shell[1], static_assets.stylesheet_url(),
+        shell[2], title,
+        shell[3], account_links,
+        shell[4]
+    ))
+    return head, "".join((shell[5], footer_content, shell[6]))
+
+def generate_html(request: Request, title="Nexo Textboard", main_content="Server did not return any content", footer_content=""):
+    head, tail = generate_html_parts(request, title, footer_content)
+    return "".join((head, main_content, tail))
+
+def client_hash(request: Request):
+    """
+    Returns the SHA-256 of the client IP, computed once per request.
+    """
+
+    client_hash = getattr(request.state, "client_hash", None)
+    if client_hash is None:
+        client_hash = tor.hash_ip(request.client.host)
+        request.state.client_hash = client_hash
+    return client_hash
+
+def is_tor(request: Request):
+    """
+    Returns whether the client is a known Tor exit, looked up once per
+    request.
+    """
+
+    is_tor = getattr(request.state, "is_tor", None)
+    if is_tor is None:
+        is_tor = client_hash(request) in tor.tor_list
+        request.state.is_tor = is_tor
+    return is_tor
+
 def get_account_links(request: Request):
     user = sessions_manager.get_current_user(request)
 
     if user:
-        return f"[<a href='/account/{user}'>{user}</a>] [<a href='/account'>Account settings</a>] [<a href='/logout'>Logout</a>] [<a href='/new_post'>New post</a>]"
+        # Loaded off the event loop by the middleware in main.py
+        unread = getattr(request.state, "unread_mail", 0)
+        mail = f"<b>Mail ({unread})</b>" if unread else "Mail"
+        return f"[<a href='/account/{user}'>{user}</a>] [<a href='/mail'>{mail}</a>] [<a href='/account'>Account settings</a>] [<a href='/logout'>Logout</a>] [<a href='/new_post'>New post</a>]"
     else:
         return "[<a href='/login'>Login</a>] [<a href='/register'>Register</a>] You are not logged in."
 
+ROLE_TAGS = {
+    "owner": "<span class=\"owner_role\">OWNER</span>",
+    "admin": "<span class=\"admin_role\">ADMIN</span>",
+    "moderator": "<span class=\"moderator_role\">MOD</span>",
+    "user": "<span class=\"member_role\">MEMBER</span>",
+}
+
 def get_username_tag(user):
-    if database.User.Get.role(user) == "owner":
-        return f"<span class=\"owner_role\">OWNER</span>"
-    if database.User.Get.role(user) == "admin":
-        return f"<span class=\"admin_role\">ADMIN</span>"
-    if database.User.Get.role(user) == "moderator":
-        return f"<span class=\"moderator_role\">MOD</span>"
-    if database.User.Get.role(user) == "user":
-        return f"<span class=\"member_role\">MEMBER</span>"
+    return ROLE_TAGS.get(database.User.Get.role(user), "")
+
+def get_username_tags(users):
+    """
+    Returns {username: tag} for every user in a listing using one batched
+    role lookup.
+    """
+
+    metas = database.User.Get.meta_many(users)
+    return {user: ROLE_TAGS.get(metas[user]["Role"], "") if user in metas else "" for user in users}
 
 def get_stats():
-    posts = database.PublicPosts.Core.get_all_posts()
-    users = database.User.Core.get_all_users()
-    topics = database.Topics.Core.get_all_topics()
-    posts_count = len(posts)
-    users_count = len(users)
-    topics_count = len(topics)
-    uptime = datetime.now() - datetime.fromtimestamp(globals.START_TIME)
-
-    main_content = f"""
-    System UP
-    <b>UPTIME:</b> {uptime.days} days, {uptime.seconds // 3600} hours, {(uptime.seconds // 60) % 60} minutes
-    <b>VERSION:</b> {globals.VERSION_FULL}
-    <b>TOTAL POSTS:</b> {posts_count}
-    <b>TOTAL USERS:</b> {users_count}
-    <b>TOTAL TOPICS:</b> {topics_count}
-    """    
-
-    
-    return None
\ No newline at end of file
+    """
+    Returns what /status shows: uptime, version, row counts and request
+    statistics. Reads only counters, never whole tables.
+    """
+
+    uptime = datetime.now() - globals.START_TIME
+    return {
+        "status": "up",
+        "version": globals.VERSION_FULL,
+        "uptime_seconds": int(uptime.total_seconds()),
+        "counts": stats.counts(),
+        "requests": stats.requests.snapshot(),
+        "writes": write_queue.writes.stats(),
+    }
\ No newline at end of file
@@ -0,0 +1,189 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from . import db_pool
+from . import logger
+from . import metrics
+
+# Writes from lib/database.py go through one writer thread that groups them
+# into transactions. A write that finds the queue otherwise empty is
+# committed right away, so a lone write does not wait for company. When
+# more writes are queued behind it, the batch is committed once it holds
+# BATCH_SIZE writes or BATCH_WINDOW seconds after its first write arrived,
+# whichever comes first. Writes arriving while a batch commits queue up and
+# form the next batch.
+# Every write runs in its own savepoint so a failing write is rolled back
+# on its own and does not take the rest of its batch with it. Callers block
+# until the batch holding their write has committed.
+BATCH_SIZE = int(os.environ.get("NEXO_WRITE_BATCH_SIZE", "64"))
+BATCH_WINDOW = float(os.environ.get("NEXO_WRITE_BATCH_WINDOW", "0.002"))
+# Upper bounds of the batch size histogram buckets
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+class WriteQueue:
+    def __init__(self, batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+        self.jobs = None
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+        self.batch_sizes = [0] * (len(BATCH_BUCKETS) + 1)
+        self.commit_seconds = 0.0
+        self.commit_seconds_max = 0.0
+
+    def start(self):
+        # Threads do not survive fork, a worker process starts its own
+        # writer on first use
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.jobs = queue.SimpleQueue()
+            self.thread = threading.Thread(target=self.run, name="nexo-db-writer", daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def submit(self, func):
+        """
+        Runs func(cursor) in the next write batch and returns its result once
+        the batch has committed. Exceptions raised by func are re-raised here.
+
+        Args:
+            func (callable): Called with a cursor on the writer connection.
+        """
+
+        # Writes made while already inside a write transaction, e.g. from a
+        # migration or from another write, join it instead of queueing
+        # behind it
+        if db_pool.in_write():
+            with db_pool.write() as c:
+                return func(c)
+        if self.pid != os.getpid():
+            self.start()
+        future = Future()
+        self.jobs.put((func, future))
+        return future.result()
+
+    def execute(self, sql, params=()):
+        """
+        Runs one statement in the next write batch and returns its rowcount.
+        """
+
+        return self.submit(lambda c: c.execute(sql, params).rowcount)
+
+    def stop(self):
+        """
+        Commits the queued writes and stops the writer thread. A later write
+        starts a new one.
+        """
+
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.jobs.put(None)
+            self.thread.join()
+            self.pid = None
+
+    def collect(self):
+        job = self.jobs.get()
+        if job is None:
+            return None
+        batch = [job]
+        if self.jobs.empty():
+            return batch
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self.jobs.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job is None:
+                # Stopping, commit this batch first
+                self.jobs.put(None)
+                break
+            batch.append(job)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            if batch is None:
+                return
+            results = []
+            start = time.perf_counter()
+            try:
+                with db_pool.write() as c:
+                    for func, future in batch:
+                        c.execute("SAVEPOINT nexo_write")
+                        try:
+                            result = func(c)
+                        except Exception as e:
+                            c.execute("ROLLBACK TO nexo_write")
+                            c.execute("RELEASE nexo_write")
+                            results.append((future, None, e))
+                        else:
+                            c.execute("RELEASE nexo_write")
+                            results.append((future, result, None))
+            except Exception as e:
+                logger.log_error("Database.WriteQueue", "Batch of %s writes failed to commit: %s", len(batch), e)
+                results = [(future, None, e) for func, future in batch]
+            self.record(len(batch), time.perf_counter() - start, sum(1 for result in results if result[2] is not None))
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def record(self, size, seconds, failed):
+        self.batches += 1
+        self.writes += size
+        self.failed += failed
+        bucket = next((i for i, bound in enumerate(BATCH_BUCKETS) if size <= bound), len(BATCH_BUCKETS))
+        self.batch_sizes[bucket] += 1
+        batch_size.observe(size)
+        self.commit_seconds += seconds
+        self.commit_seconds_max = max(self.commit_seconds_max, seconds)
+        logger.debug("Database.WriteQueue", "Committed %s writes in %.2fms", size, seconds * 1000)
+
+    def stats(self):
+        """
+        Returns counters for the batches committed by this process.
+        """
+
+        return {
+            "batches": self.batches,
+            "writes": self.writes,
+            "failed": self.failed,
+            "average_batch_size": self.writes / self.batches if self.batches else 0,
+            "batch_sizes": dict(zip([str(bound) for bound in BATCH_BUCKETS] + ["+Inf"], self.batch_sizes)),
+            "average_commit_ms": self.commit_seconds / self.batches * 1000 if self.batches else 0,
+            "max_commit_ms": self.commit_seconds_max * 1000,
+        }
+
+batch_size = metrics.Histogram("nexo_db_write_batch_size", "Writes committed per batch, for tuning NEXO_WRITE_BATCH_WINDOW.", buckets=BATCH_BUCKETS)
+
+writes = WriteQueue()
+
+def submit(func):
+    return writes.submit(func)
+
+def execute(sql, params=()):
+    return writes.execute(sql, params)
+
+def stop():
+    writes.stop()
+
+metrics.Counter("nexo_db_write_batches_total", "Write transactions committed by the writer thread.").set_function(lambda: writes.batches)
+metrics.Counter("nexo_db_writes_total", "Writes committed through the write queue.").set_function(lambda: writes.writes)
+metrics.Counter("nexo_db_write_failures_total", "Writes that raised and were rolled back.").set_function(lambda: writes.failed)
+metrics.Counter("nexo_db_write_commit_seconds_total", "Time spent running and committing write batches.").set_function(lambda: writes.commit_seconds)
+metrics.Gauge("nexo_db_write_commit_seconds_max", "Longest write batch since startup.").set_function(lambda: writes.commit_seconds_max)
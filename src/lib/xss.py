@@ -1,59 +1,109 @@
-from html.parser import HTMLParser
+import hashlib
+import html
+import os
+import re
+import threading
+
 import markdown
 
-from . import logger
+from . import cache
+from . import metrics
 
-class SafeHTMLParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.result = []
-        self.allowed_tags = {}
+ALLOWED_TAGS = frozenset({'b', 'i', 'u', 'a', 'br'})
+# Tags kept in rendered markdown. Images are not allowed, like in raw input.
+MARKDOWN_TAGS = ALLOWED_TAGS | frozenset({
+    'p', 'em', 'strong', 'code', 'pre', 'blockquote', 'ul', 'ol', 'li', 'hr',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+})
+NO_TAGS = frozenset()
+SAFE_URL_SCHEMES = ("http:", "https:", "mailto:")
 
-    def handle_starttag(self, tag, attrs):
-        if tag in self.allowed_tags:
-            if tag == "a":
-                href = dict(attrs).get("href", "")
-                self.result.append(f'<a href="{href}">')
-            else:
-                self.result.append(f'<{tag}>')
+# One pass tokenizer. Anything that is not a well formed tag is text, and a
+# "<" that does not start a tag is escaped. Attribute values may not contain
+# "<", which keeps every scan bounded by the next "<" so pathological input
+# stays linear.
+_TOKEN = re.compile(r"""
+    (?P<comment><!--.*?(?:-->|\Z))
+  | (?P<declaration><[!?][^<>]*>?)
+  | <(?P<end>/?)(?P<tag>[a-zA-Z][a-zA-Z0-9]*)(?P<attrs>(?:[^<>"']|"[^"<]*"|'[^'<]*')*)>
+  | (?P<lt><)
+""", re.S | re.X)
+_HREF = re.compile(r"""(?:^|\s)href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.I)
+_SCHEME = re.compile(r"^([a-zA-Z][a-zA-Z0-9+.-]*):")
+_CONTROL = re.compile(r"[\x00-\x20\x7f]+")
 
-    def handle_endtag(self, tag):
-        if tag in self.allowed_tags:
-            self.result.append(f'</{tag}>')
+# Rendered markdown keyed by a hash of the raw input
+markdown_cache = cache.LRUCache(maxsize=int(os.environ.get("NEXO_MARKDOWN_CACHE_SIZE", "2048")))
+metrics.track_cache("markdown", markdown_cache)
+_markdown = threading.local()
 
-    def handle_startendtag(self, tag, attrs):
-        if tag in self.allowed_tags:
-            self.result.append(f'<{tag} />')
+def safe_href(href):
+    href = html.unescape(href).strip()
+    # Browsers ignore control characters and whitespace inside the scheme,
+    # so "java\tscript:" has to be caught as well
+    compact = _CONTROL.sub("", href)
+    if _SCHEME.match(compact) and not compact.lower().startswith(SAFE_URL_SCHEMES):
+        return ""
+    return html.escape(href, quote=True)
 
-    def handle_data(self, data):
-        self.result.append(data)
+def _tag_replacer(allowed_tags):
+    def replace(match):
+        if match.group("lt"):
+            return "&lt;"
+        tag = match.group("tag")
+        if tag is None:
+            return ""
+        tag = tag.lower()
+        if tag not in allowed_tags:
+            return ""
+        if match.group("end"):
+            return f"</{tag}>"
+        attrs = match.group("attrs")
+        if attrs.rstrip().endswith("/"):
+            return f"<{tag} />"
+        if tag == "a":
+            href = _HREF.search(attrs)
+            href = next((value for value in href.groups() if value is not None), "") if href else ""
+            return f'<a href="{safe_href(href)}">'
+        return f"<{tag}>"
+    return replace
 
-    def get_sanitized(self):
-        return ''.join(self.result)
+_replace_allowed = _tag_replacer(ALLOWED_TAGS)
+_replace_markdown = _tag_replacer(MARKDOWN_TAGS)
+_replace_none = _tag_replacer(NO_TAGS)
 
+def sanitize(input_string: str, replace) -> str:
+    if "<" not in input_string:
+        return input_string
+    return _TOKEN.sub(replace, input_string)
 
 def sanitize_input(input_string: str) -> str:
-    logger.debug("XSSPreventionComponent", f"Sanitizing input: {input_string}")
-    parser = SafeHTMLParser()
-    parser.allowed_tags = {'b', 'i', 'u', 'a', 'br'}
-    parser.feed(input_string)
-    print("Sanitized input:", parser.get_sanitized())
-    return parser.get_sanitized()
+    return sanitize(input_string, _replace_allowed)
+
+def render_markdown(text: str) -> str:
+    md = getattr(_markdown, "md", None)
+    if md is None:
+        md = markdown.Markdown()
+        _markdown.md = md
+    return md.reset().convert(text)
+
+def sanitize_html(rendered: str) -> str:
+    """
+    Sanitizes HTML rendered from markdown. Markdown link and image syntax
+    produce tags and URLs the input was never checked for, e.g.
+    [x](javascript:...), so the output goes through the tokenizer and the
+    href check as well.
+    """
+
+    return sanitize(rendered, _replace_markdown)
 
 def sanitize_markdown_input(input_string: str) -> str:
-    logger.debug("XSSPreventionComponent", f"Sanitizing markdown input: {input_string}")
-    parser = SafeHTMLParser()
-    parser.allowed_tags = {'b', 'i', 'u', 'a', 'br'}
-    parser.feed(input_string)
-    markdown_text = parser.get_sanitized()
-    markdown_text = markdown.markdown(markdown_text)
-    print("Sanitized markdown input:", parser.get_sanitized())
-    return markdown_text
+    key = hashlib.sha256(input_string.encode()).digest()
+    rendered = markdown_cache.get(key)
+    if rendered is None:
+        rendered = sanitize_html(render_markdown(sanitize(input_string, _replace_allowed)))
+        markdown_cache.set(key, rendered)
+    return rendered
 
 def sanitize_input_no_html(input_string: str) -> str:
-    logger.debug("XSSPreventionComponent", f"Sanitizing input without HTML: {input_string}")
-    parser = SafeHTMLParser()
-    parser.allowed_tags = {}
-    parser.feed(input_string)
-    logger.debug("XSSPreventionComponent", f"Sanitized input without HTML: {parser.get_sanitized()}")
-    return parser.get_sanitized()
\ No newline at end of file
+    return sanitize(input_string, _replace_none)
@@ -19,84 +19,119 @@ from typing import Annotated
 from asyncio import run
 from PIL import Image
 import uvicorn
+import contextlib
 import hashlib
 import time
 import os
-
-INIT = False
-if not os.path.exists("data"):
-    os.makedirs("data")
-    print("INIT")
-    INIT = True
+import sys
 
 from lib import database
+from lib import async_database
+from lib import db_pool
 from lib import utils
 from lib import logger as nexo_logger
 
 import logging
-app = FastAPI(title="Nexo", docs_url=None, redoc_url=None, openapi_url=None)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Background threads start in the process that serves requests, not on
+    # import, so scripts and the pre-forking master in serve.py run none
+    sessions_manager.start_sweeper()
+    limiter.start_evicter()
+    yield
+
+app = FastAPI(title="Nexo", docs_url=None, redoc_url=None, openapi_url=None, lifespan=lifespan)
 
 # Dissable Uvicorn's default logging
 logging.basicConfig(level=logging.CRITICAL)
 logger = logging.getLogger('uvicorn')
 logger.setLevel(logging.CRITICAL)
 
-rate_limit_data = {}
+from lib import rate_limiter
+from lib import sessions_manager
+from lib import stats
+from lib import metrics
+
 RATE_LIMIT = 20
 TIME_WINDOW = 20
+limiter = rate_limiter.RateLimiter(default=(RATE_LIMIT, TIME_WINDOW))
+metrics.Counter("nexo_rate_limit_rejections_total", "Requests rejected by the rate limiter.").set_function(lambda: limiter.rejected)
 
 from lib.routes import static
 from lib.routes import posts
 from lib.routes import accounts
 from lib.routes import admin
+from lib.routes import search
+from lib.routes import mail
 
 app.include_router(static.router)
 app.include_router(posts.router)
 app.include_router(accounts.router)
 app.include_router(admin.router)
+app.include_router(search.router)
+app.include_router(mail.router)
 
 @app.middleware("http")
 async def log_request_info(request: Request, call_next):
-    client_ip = hashlib.sha256((request.client.host).encode()).hexdigest()
-    current_time = time.time()
-    request_log = rate_limit_data.get(client_ip, {"count": 0, "start_time": current_time})
-
-    if current_time - request_log["start_time"] > TIME_WINDOW:
-        request_log = {"count": 0, "start_time": current_time}
-
-    request_log["count"] += 1
-
-    if request_log["count"] > RATE_LIMIT:
-        retry_after = int(TIME_WINDOW - (current_time - request_log["start_time"]))
-
-        nexo_logger.log_warning("main.dosprevention", f"Rate limit exceeded for {client_ip}. Count: {request_log['count']}")
+    client_ip = utils.client_hash(request)
+    # Every later session lookup in this request reads the memoized result
+    await sessions_manager.load_session(request)
+    user = sessions_manager.get_current_user(request)
+    # Read by get_account_links() when the page is rendered
+    request.state.unread_mail = await async_database.DirectMessages.Get.unread_count(user) if user else 0
+    allowed, retry_after = await limiter.check_async(client_ip, request.method, request.url.path, utils.is_tor(request))
+
+    if not allowed:
+        nexo_logger.log_warning("main.dosprevention", "Rate limit exceeded for %s on %s %s", client_ip, request.method, request.url.path)
         return HTMLResponse(
             utils.generate_html(request=request, main_content=f"<b>SYSTEM:</b> Rate limit exceeded for ip {client_ip}. Please try again later.", footer_content="Error code: 429"),
             status_code=429,
             headers={"Retry-After": str(retry_after)}
         )
 
-    rate_limit_data[client_ip] = request_log
-
+    start = time.perf_counter()
     response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    stats.requests.record(elapsed, response.status_code)
+    # Labelled by route template so /post/{id} is one series, not one per post
+    route = request.scope.get("route")
+    route = route.path if route else "unmatched"
+    metrics.http_requests.inc(request.method, route, response.status_code)
+    metrics.http_request_seconds.observe(elapsed, request.method, route)
 
     if response.status_code == 200:
-        nexo_logger.log("main", f"Request: {request.method} {request.url} - {response.status_code}")
+        nexo_logger.log("main", "Request: %s %s - %s", request.method, request.url, response.status_code)
     elif response.status_code == 500:
-        nexo_logger.log_error("main", f"INTERNAL SERVER ERROR: {request.method} {request.url} - {response.status_code}")
+        nexo_logger.log_error("main", "INTERNAL SERVER ERROR: %s %s - %s", request.method, request.url, response.status_code)
         return HTMLResponse(
             utils.generate_html(request=request, main_content="Nexo had a internal error. Please try again later or report this error to the developers.", footer_content="Error code: 500"),
             status_code=500
         )
     else:
-        nexo_logger.log_warning("main", f"Request: {request.method} {request.url} - {response.status_code}")
+        nexo_logger.log_warning("main", "Request: %s %s - %s", request.method, request.url, response.status_code)
     return response
-if __name__ == "__main__":
-    if INIT:
-        database.generate_databases()
+def initialize():
+    """
+    Migrates the database and creates the default users and topics on the
+    first run. Runs once per start, before any request is served. Importing
+    this module sets nothing up on disk, tools can import the app without it.
+    """
+
+    first_run = not os.path.exists(db_pool.DB_PATH)
+    if first_run:
+        os.makedirs(os.path.dirname(db_pool.DB_PATH) or ".", exist_ok=True)
+        print("INIT")
+    database.generate_databases()
+    if first_run:
         database.User.Core.create_user("nexo_bot", "null", "admin")
         database.User.Core.create_user("nexo", "null", "admin")
         database.Topics.Core.create_topic("/general/", "General", "General discussion", 'False', 'False', 'False')
         database.Topics.Core.create_topic("/admin/", "Admin", "Admin discussion", 'True', 'False', 'False')
-        
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="error")
\ No newline at end of file
+
+if __name__ == "__main__":
+    # Served by serve.py with one worker. The image workers (lib/images.py)
+    # import the __main__ module again, this one would load the whole app
+    # in each of them.
+    serve = os.path.join(os.path.dirname(os.path.abspath(__file__)), "serve.py")
+    os.execv(sys.executable, [sys.executable, serve, "--workers", "1"])
\ No newline at end of file
@@ -1,6 +1,12 @@
 from lib.database import User
+from lib import sessions_manager
 
 user = input("Enter the username of the admin: ")
 role = input("Enter the role of the admin (admin/user): ")
 User.Set.user_role(user, role)
-print(f"User {user} has been set to {role} role.")
\ No newline at end of file
+if sessions_manager.store.shared:
+    sessions_manager.update_role(user, role)
+print(f"User {user} has been set to {role} role.")
+if not sessions_manager.store.shared:
+    # The memory store lives in the server process, this script cannot reach it
+    print(f"Sessions are kept in the server's memory, {user} keeps the old role until they log in again or the server restarts.")
\ No newline at end of file
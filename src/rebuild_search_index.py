@@ -0,0 +1,6 @@
+from lib import database
+from lib import search
+
+database.generate_databases()
+total = search.rebuild_index()
+print(f"Search index rebuilt with {total} posts and replies.")
@@ -0,0 +1,29 @@
+from lib import database
+from lib import db_pool
+from lib import xss
+
+# Rows stored before rendered markdown was sanitized may hold links such as
+# javascript: URLs. Runs the current sanitizer over every stored body.
+COLUMNS = (
+    ("Users", "Username", "AboutMe"),
+    ("PublicPosts", "ID", "Body"),
+    ("PublicPostsReplies", "ID", "Body"),
+    ("DirectMessages", "ID", "Body"),
+)
+
+database.generate_databases()
+total = 0
+for table, key, column in COLUMNS:
+    with db_pool.read() as c:
+        rows = c.execute(f"SELECT {key}, {column} FROM {table} WHERE {column} LIKE '%<%'").fetchall()
+    changed = []
+    for row in rows:
+        sanitized = xss.sanitize_html(row[column])
+        if sanitized != row[column]:
+            changed.append((sanitized, row[key]))
+    if changed:
+        with db_pool.write() as c:
+            c.executemany(f"UPDATE {table} SET {column} = ? WHERE {key} = ?", changed)
+    total += len(changed)
+    print(f"{table}.{column}: sanitized {len(changed)} of {len(rows)} rows.")
+print(f"Sanitized {total} rows. Cached pages expire within a minute or on restart.")
@@ -0,0 +1,274 @@
+# SPDX-License-Identifier: GPL-3.0
+# Nexo
+# A textboard with the kitchen sink included
+#
+# serve.py
+#
+# COPYRIGHT NOTICE
+# Copyright (C) 2025 0x4248 and contributors
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the license is not changed.
+#
+# This software is free and open source. Licensed under the GNU general
+# public license version 3.0 as published by the Free Software Foundation.
+
+# Production entry point: python src/serve.py [--workers N] [--port 8000]
+#
+# The master process migrates the database and loads templates and the Tor
+# list once, then forks N uvicorn workers that accept on one shared socket.
+# On SIGHUP the master checks that the code on disk imports, re-executes
+# itself on the same socket and pid, and replaces the old workers one at a
+# time, stopping each only after its replacement is serving. SIGTERM or
+# SIGINT stops every worker gracefully.
+
+import argparse
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run Nexo with several worker processes")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("NEXO_WORKERS", os.cpu_count() or 1)))
+    parser.add_argument("--host", default=os.environ.get("NEXO_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("NEXO_PORT", "8000")))
+    parser.add_argument("--db", default=os.environ.get("NEXO_DB_PATH"), help="Path of the SQLite database")
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.environ.get("NEXO_GRACEFUL_TIMEOUT", "30")), help="Seconds a stopping worker gets to finish its requests")
+    parser.add_argument("--pid-file", default=os.environ.get("NEXO_PID_FILE", "data/serve.pid"))
+    parser.add_argument("--check", action="store_true", help="Only check that the app imports, used before a reload")
+    return parser.parse_args()
+
+def configure(args):
+    # Must run before lib is imported, its modules read these at import time
+    if args.db:
+        os.environ["NEXO_DB_PATH"] = args.db
+    if args.workers > 1:
+        # Per process sessions and rate limits do not work across workers
+        os.environ.setdefault("NEXO_SESSION_BACKEND", "sqlite")
+        os.environ.setdefault("NEXO_RATE_LIMIT_BACKEND", "sqlite")
+
+def listen(args):
+    inherited = os.environ.pop("NEXO_LISTEN_FD", None)
+    if inherited:
+        sock = socket.socket(fileno=int(inherited))
+    else:
+        sock = socket.socket(socket.AF_INET6 if ":" in args.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((args.host, args.port))
+        sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def preload():
+    # Everything loaded here is shared copy-on-write by the workers
+    import main
+    from lib import db_pool
+    from lib import logger
+    from lib import templates
+    from lib import utils
+    from lib import write_queue
+
+    main.initialize()
+    utils.get_page_shell()
+    templates.load("src/static/index.html")
+    # Workers open their own connections
+    db_pool.close()
+    # Threads do not survive fork, and one holding a lock when the master
+    # forks leaves it held in the worker forever. Every worker starts its
+    # own, and the master runs none from here on.
+    write_queue.stop()
+    logger.writer.run_inline()
+    return main.app
+
+def run_worker(app, sock, ready_fd, graceful_timeout):
+    import uvicorn
+
+    class Server(uvicorn.Server):
+        async def startup(self, sockets=None):
+            await super().startup(sockets)
+            if not self.should_exit:
+                os.write(ready_fd, b"1")
+            os.close(ready_fd)
+
+    for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, signal.SIG_DFL)
+    config = uvicorn.Config(app, log_level="error", timeout_graceful_shutdown=graceful_timeout)
+    Server(config).run(sockets=[sock])
+
+class Master:
+    def __init__(self, args, app, sock, logger):
+        self.args = args
+        self.app = app
+        self.sock = sock
+        self.logger = logger
+        self.workers = set()
+        # Old workers that were asked to stop, with the time to kill them
+        self.stopping = {}
+        self.reload = False
+        self.shutdown = False
+        self.respawns = []
+
+    def spawn(self):
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            code = 1
+            try:
+                run_worker(self.app, self.sock, ready_write, self.args.graceful_timeout)
+                code = 0
+            finally:
+                # os._exit skips atexit, write out the queued log records
+                self.logger.writer.stop()
+                os._exit(code)
+        os.close(ready_write)
+        self.workers.add(pid)
+        return pid, ready_read
+
+    def wait_ready(self, pid, ready_read, timeout=60):
+        try:
+            readable, _, _ = select.select([ready_read], [], [], timeout)
+            ready = bool(readable) and os.read(ready_read, 1) == b"1"
+        finally:
+            os.close(ready_read)
+        if not ready:
+            self.logger.log_error("Serve", "Worker %s did not start", pid)
+        return ready
+
+    def retire(self, pid):
+        self.workers.discard(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        # uvicorn waits graceful_timeout for open requests, then exits
+        self.stopping[pid] = time.monotonic() + self.args.graceful_timeout + 5
+
+    def start(self, old_workers):
+        """
+        Starts the configured number of workers. Each new worker replaces one
+        of old_workers, which is stopped once the new one is serving.
+        """
+
+        old_workers = list(old_workers)
+        for _ in range(self.args.workers):
+            pid, ready_read = self.spawn()
+            if not self.wait_ready(pid, ready_read):
+                self.workers.discard(pid)
+                os.kill(pid, signal.SIGKILL)
+                # Keep the old workers serving rather than running short
+                self.workers.update(old_workers)
+                return
+            if old_workers:
+                self.retire(old_workers.pop())
+        for pid in old_workers:
+            self.retire(pid)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.stopping.pop(pid, None)
+            if pid not in self.workers:
+                continue
+            self.workers.discard(pid)
+            if self.shutdown:
+                continue
+            self.logger.log_warning("Serve", "Worker %s exited with status %s, starting a new one", pid, status)
+            # Back off when workers keep dying, e.g. on a broken deploy
+            now = time.monotonic()
+            self.respawns = [at for at in self.respawns if now - at < 10] + [now]
+            if len(self.respawns) > self.args.workers * 2:
+                time.sleep(1)
+            self.wait_ready(*self.spawn())
+
+    def kill_stuck(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.stopping.items()):
+            if now >= deadline:
+                self.logger.log_warning("Serve", "Worker %s did not stop in time, killing it", pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.stopping.pop(pid)
+
+    def reexec(self):
+        # Refuse to reload into code that does not even import, the old
+        # workers keep serving
+        check = subprocess.run([sys.executable, sys.argv[0], "--check"] + sys.argv[1:])
+        if check.returncode != 0:
+            self.logger.log_error("Serve", "Reload aborted, the app failed to import")
+            return
+        self.logger.log("Serve", "Reloading %s workers", len(self.workers))
+        os.environ["NEXO_LISTEN_FD"] = str(self.sock.fileno())
+        os.environ["NEXO_OLD_WORKERS"] = ",".join(str(pid) for pid in self.workers)
+        # An ignored SIGHUP stays ignored across exec until the new master
+        # installs its handler
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.logger.writer.stop()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def run(self, old_workers):
+        def on_reload(sig, frame):
+            self.reload = True
+
+        def on_shutdown(sig, frame):
+            self.shutdown = True
+
+        signal.signal(signal.SIGHUP, on_reload)
+        signal.signal(signal.SIGTERM, on_shutdown)
+        signal.signal(signal.SIGINT, on_shutdown)
+
+        self.start(old_workers)
+        self.logger.log("Serve", "Serving on %s:%s with %s workers", self.args.host, self.args.port, len(self.workers))
+        while not self.shutdown:
+            if self.reload:
+                self.reload = False
+                self.reexec()
+            self.reap()
+            self.kill_stuck()
+            time.sleep(0.2)
+        self.stop()
+
+    def stop(self):
+        for pid in list(self.workers):
+            self.retire(pid)
+        while self.stopping:
+            self.reap()
+            self.kill_stuck()
+            time.sleep(0.1)
+        self.logger.log("Serve", "Stopped")
+
+def main():
+    args = parse_args()
+    configure(args)
+    if args.check:
+        import main as nexo
+        return
+
+    old_workers = [int(pid) for pid in os.environ.pop("NEXO_OLD_WORKERS", "").split(",") if pid]
+    sock = listen(args)
+    app = preload()
+    from lib import logger
+
+    if args.pid_file:
+        os.makedirs(os.path.dirname(args.pid_file) or ".", exist_ok=True)
+        with open(args.pid_file, "w") as file:
+            file.write(str(os.getpid()))
+    master = Master(args, app, sock, logger)
+    try:
+        master.run(old_workers)
+    finally:
+        if args.pid_file and os.path.exists(args.pid_file):
+            os.remove(args.pid_file)
+
+if __name__ == "__main__":
+    main()
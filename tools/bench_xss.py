@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+
+# Run from the repository root: python tools/bench_xss.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from lib import xss
+
+PARAGRAPH = "Some **markdown** text with <b>bold</b>, <i>italic</i> and a <a href=\"https://example.com\">link</a>.<br/>\n"
+
+INPUTS = {
+	"plain text": "Just a line of text with no markup at all. " * 2000,
+	"large post": PARAGRAPH * 1000,
+	"disallowed tags": "<script>alert(1)</script><img src=x onerror=alert(1)><div><p>text</p></div>" * 1000,
+	"many <a": "<a " * 20000,
+	"unclosed quotes": "<a href=\"" + "x" * 50000,
+	"deep nesting": "<b>" * 10000 + "text" + "</b>" * 10000,
+	"many <": "<" * 50000,
+	"comment soup": "<!--" * 10000,
+}
+
+def bench(name, func, text, repeat):
+	start = time.perf_counter()
+	for _ in range(repeat):
+		func(text)
+	elapsed = time.perf_counter() - start
+	mb = len(text.encode()) * repeat / 1024 / 1024
+	print(f"{name:<40} {len(text):>8} chars {elapsed / repeat * 1000:>9.3f} ms/call {mb / elapsed:>9.2f} MB/s")
+	return elapsed
+
+def main():
+	repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+	print("sanitize_input")
+	for name, text in INPUTS.items():
+		bench(name, xss.sanitize_input, text, repeat)
+
+	print("\nsanitize_input_no_html")
+	for name, text in INPUTS.items():
+		bench(name, xss.sanitize_input_no_html, text, repeat)
+
+	print("\nsanitize_markdown_input")
+	text = INPUTS["large post"]
+	xss.markdown_cache.clear()
+	bench("large post (uncached)", lambda t: (xss.markdown_cache.clear(), xss.sanitize_markdown_input(t)), text, repeat)
+	xss.sanitize_markdown_input(text)
+	bench("large post (cached)", xss.sanitize_markdown_input, text, repeat)
+
+if __name__ == "__main__":
+	main()
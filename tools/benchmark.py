@@ -0,0 +1,329 @@
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Run from the repository root: python tools/benchmark.py [--output run.json]
+#
+# Seeds a synthetic database in a scratch directory, drives the main routes
+# in-process through an ASGI client at a fixed concurrency and runs micro
+# benchmarks of xss and the database functions. Results are printed and can
+# be saved as JSON and compared with an earlier run with --compare.
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = "benchmark"
+
+# Relative weight of every route in the load mix
+SCENARIOS = {
+	"GET /posts": 30,
+	"GET /post/{id}": 30,
+	"GET /topic/{name}": 15,
+	"POST /reply/{id}": 10,
+	"POST /submit_post": 5,
+	"POST /login": 10,
+}
+
+WORDS = "nexo textboard thread reply post topic server python sqlite cache index query page user markdown link image search latency".split()
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Load test and micro benchmarks for Nexo")
+	parser.add_argument("--workdir", help="Directory for the database and logs, a temporary one by default")
+	parser.add_argument("--users", type=int, default=200)
+	parser.add_argument("--topics", type=int, default=10)
+	parser.add_argument("--posts", type=int, default=2000)
+	parser.add_argument("--replies-mean", type=float, default=8, help="Mean replies per post, drawn from an exponential distribution")
+	parser.add_argument("--replies-max", type=int, default=2000, help="Replies of the longest thread, which is always seeded")
+	parser.add_argument("--requests", type=int, default=2000)
+	parser.add_argument("--concurrency", type=int, default=16)
+	parser.add_argument("--alloc-requests", type=int, default=200, help="Requests traced with tracemalloc, 0 to skip")
+	parser.add_argument("--micro-repeat", type=int, default=200)
+	parser.add_argument("--no-micro", action="store_true", help="Skip the micro benchmarks")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--output", help="Write the results to this JSON file")
+	parser.add_argument("--compare", help="Print the change against an earlier JSON result")
+	return parser.parse_args()
+
+def configure(workdir):
+	# Must run before lib is imported, its modules read these at import time
+	os.environ.setdefault("NEXO_DB_PATH", os.path.join(workdir, "nexo.db"))
+	os.environ.setdefault("NEXO_LOG_DIR", os.path.join(workdir, "logs"))
+	os.environ.setdefault("NEXO_AVATAR_DIR", os.path.join(workdir, "avatars"))
+	os.environ.setdefault("NEXO_RATE_LIMIT_DB", os.path.join(workdir, "ratelimit.db"))
+	os.environ.setdefault("NEXO_TOR_LIST", os.path.join(workdir, "torlist.txt"))
+	os.environ.setdefault("NEXO_LOG_LEVEL", "ERROR")
+	os.environ.setdefault("NEXO_LOG_CONSOLE", "0")
+
+def percentiles(samples):
+	if not samples:
+		return {"count": 0}
+	samples = sorted(samples)
+	def at(q):
+		return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+	return {
+		"count": len(samples),
+		"mean_ms": round(statistics.fmean(samples) * 1000, 3),
+		"p50_ms": at(0.5),
+		"p95_ms": at(0.95),
+		"p99_ms": at(0.99),
+		"max_ms": round(samples[-1] * 1000, 3),
+	}
+
+def text(rng, words):
+	return " ".join(rng.choice(WORDS) for _ in range(words))
+
+def seed(args, rng):
+	"""
+	Fills the database with users, topics, posts and replies using bulk
+	inserts, then recounts the stats and rebuilds the search index.
+	"""
+
+	from lib import database, db_pool, search, stats, timefmt, xss
+
+	database.generate_databases()
+	password = hashlib.sha256(PASSWORD.encode()).hexdigest()
+	users = [f"user{i}" for i in range(args.users)]
+	topics = ["/general/"] + [f"/topic{i}/" for i in range(args.topics - 1)]
+	# A handful of distinct bodies, sanitized once like add_post would
+	bodies = [xss.sanitize_markdown_input(f"{text(rng, 40)}\n\n**{text(rng, 3)}** [link](https://example.com/{i})") for i in range(32)]
+	now = timefmt.now()
+
+	posts = []
+	replies = []
+	for i in range(args.posts):
+		created = now - rng.randint(0, 90 * 86400)
+		post_id = hashlib.sha256(f"post{i}".encode()).hexdigest()[:10]
+		count = args.replies_max if i == 0 else min(args.replies_max, int(rng.expovariate(1 / args.replies_mean)) if args.replies_mean else 0)
+		timestamp = datetime.datetime.fromtimestamp(created).strftime(timefmt.TIMESTAMP_FORMAT)
+		posts.append((post_id, text(rng, 6), rng.choice(users), timestamp, rng.choice(topics), rng.choice(bodies), created, count))
+		for j in range(count):
+			reply_created = created + j * 60 + rng.randint(0, 59)
+			reply_timestamp = datetime.datetime.fromtimestamp(reply_created).strftime(timefmt.TIMESTAMP_FORMAT)
+			replies.append((hashlib.sha256(f"reply{i}.{j}".encode()).hexdigest()[:10], post_id, rng.choice(users), reply_timestamp, rng.choice(bodies), reply_created))
+
+	with db_pool.write() as c:
+		c.executemany("INSERT OR IGNORE INTO Users (Username, Password, Role, AboutMe) VALUES (?, ?, ?, ?)", [(user, password, "member", text(rng, 10)) for user in users])
+		c.executemany("INSERT OR IGNORE INTO Topics (ID, Name, Description, AdminOnly, Locked, Archived) VALUES (?, ?, ?, 'False', 'False', 'False')", [(topic, topic.strip("/"), text(rng, 5)) for topic in topics])
+		c.executemany("""
+			INSERT OR IGNORE INTO PublicPosts (ID, Title, Author, Timestamp, Topic, Body, Attachments, Score, Deleted, Archived, RepliesLocked, Replies, CreatedAt, ReplyCount)
+			VALUES (?, ?, ?, ?, ?, ?, '', 0, 'False', 'False', 'False', '', ?, ?)""", posts)
+		c.executemany("INSERT OR IGNORE INTO PublicPostsReplies (ID, PostID, Author, Timestamp, Body, CreatedAt) VALUES (?, ?, ?, ?, ?, ?)", replies)
+	stats.reconcile()
+	search.rebuild_index()
+	return users, topics, [post[0] for post in sorted(posts, key=lambda post: post[6], reverse=True)]
+
+class Load:
+	def __init__(self, app, users, topics, post_ids, rng):
+		self.app = app
+		self.users = users
+		self.topics = topics
+		self.post_ids = post_ids
+		self.rng = rng
+		self.names = list(SCENARIOS)
+		self.weights = list(SCENARIOS.values())
+		self.counter = 0
+
+	def hot_post(self):
+		# Skewed towards the newest posts, like real traffic
+		return self.post_ids[int(len(self.post_ids) * self.rng.random() ** 3)]
+
+	async def login(self, client, user):
+		response = await client.post("/login", data={"username": user, "password": PASSWORD})
+		session_id = response.cookies.get("session_id")
+		if session_id:
+			client.cookies.set("session_id", session_id)
+		return response
+
+	async def request(self, client, user, name):
+		self.counter += 1
+		if name == "GET /posts":
+			page = 0 if self.rng.random() < 0.8 else self.rng.randint(1, 5)
+			return await client.get(f"/posts?page={page}")
+		if name == "GET /post/{id}":
+			return await client.get(f"/post/{self.hot_post()}")
+		if name == "GET /topic/{name}":
+			return await client.get(f"/topic/{self.rng.choice(self.topics).strip('/')}")
+		if name == "POST /reply/{id}":
+			return await client.post(f"/reply/{self.hot_post()}", data={"content": f"{text(self.rng, 12)} {self.counter}"})
+		if name == "POST /submit_post":
+			return await client.post("/submit_post", data={"title": text(self.rng, 5), "author": user, "topic": self.rng.choice(self.topics), "content": f"{text(self.rng, 30)} {self.counter}"})
+		return await self.login(client, user)
+
+	async def run(self, total, concurrency):
+		import httpx
+
+		latencies = {name: [] for name in self.names}
+		errors = {name: 0 for name in self.names}
+		remaining = [total]
+
+		async def worker(index):
+			user = self.users[index % len(self.users)]
+			transport = httpx.ASGITransport(app=self.app)
+			async with httpx.AsyncClient(transport=transport, base_url="http://nexo.test") as client:
+				await self.login(client, user)
+				while remaining[0] > 0:
+					remaining[0] -= 1
+					name = self.rng.choices(self.names, self.weights)[0]
+					start = time.perf_counter()
+					response = await self.request(client, user, name)
+					latencies[name].append(time.perf_counter() - start)
+					if response.status_code >= 400:
+						errors[name] += 1
+
+		start = time.perf_counter()
+		await asyncio.gather(*(worker(i) for i in range(concurrency)))
+		elapsed = time.perf_counter() - start
+		routes = {}
+		for name in self.names:
+			routes[name] = percentiles(latencies[name])
+			routes[name]["errors"] = errors[name]
+		overall = percentiles([sample for samples in latencies.values() for sample in samples])
+		overall["errors"] = sum(errors.values())
+		overall["seconds"] = round(elapsed, 3)
+		overall["requests_per_second"] = round(total / elapsed, 1)
+		return {"overall": overall, "routes": routes}
+
+async def trace_allocations(load, total, concurrency):
+	tracemalloc.start()
+	before = tracemalloc.take_snapshot()
+	tracemalloc.reset_peak()
+	await load.run(total, concurrency)
+	current, peak = tracemalloc.get_traced_memory()
+	after = tracemalloc.take_snapshot()
+	tracemalloc.stop()
+	growth = [stat for stat in after.compare_to(before, "lineno") if stat.size_diff > 0]
+	return {
+		"requests": total,
+		"peak_bytes": peak,
+		"retained_bytes": sum(stat.size_diff for stat in growth),
+		"new_blocks_per_request": round(sum(stat.count_diff for stat in growth) / total, 1),
+		"top": [{"where": str(stat.traceback[0]), "bytes": stat.size_diff, "blocks": stat.count_diff} for stat in growth[:10]],
+	}
+
+def time_call(func, repeat):
+	func()
+	start = time.perf_counter()
+	for _ in range(repeat):
+		func()
+	return round((time.perf_counter() - start) / repeat * 1e6, 2)
+
+def micro(args, users, post_ids):
+	import bench_xss
+	from lib import database, search, stats, utils, xss
+
+	results = {"xss": {}, "database": {}}
+	repeat = max(1, args.micro_repeat // 20)
+	for func in (xss.sanitize_input, xss.sanitize_input_no_html):
+		for name, sample in bench_xss.INPUTS.items():
+			label = f"{func.__name__} {name}"
+			results["xss"][label] = round(bench_xss.bench(label, func, sample, repeat) / repeat * 1e6, 2)
+	post = database.PublicPosts.Core.get_post(post_ids[0])
+	long_thread = max(post_ids[:50], key=lambda post_id: database.PublicPosts.Core.get_reply_count(post_id))
+	calls = {
+		"PublicPosts.Core.get_post": lambda: database.PublicPosts.Core.get_post(post_ids[0]),
+		"PublicPosts.Core.get_post_by_page": lambda: database.PublicPosts.Core.get_post_by_page(0),
+		"PublicPosts.Core.get_posts_after": lambda: database.PublicPosts.Core.get_posts_after(post["Timestamp"], post["ID"], None, 21),
+		"PublicPosts.Core.get_posts_by_topic": lambda: database.PublicPosts.Core.get_posts_by_topic(post["Topic"], 0),
+		"PublicPostReplies.Core.get_replies_after": lambda: database.PublicPostReplies.Core.get_replies_after(long_thread, limit=100),
+		"User.Get.meta_many": lambda: database.User.Get.meta_many(users[:20]),
+		"User.Core.get_user": lambda: database.User.Core.get_user(users[0]),
+		"utils.get_username_tags": lambda: utils.get_username_tags(users[:20]),
+		"search.search": lambda: search.search("nexo thread"),
+		"stats.counts": stats.counts,
+	}
+	for name, func in calls.items():
+		results["database"][name] = time_call(func, args.micro_repeat)
+		print(f"{name:<45} {results['database'][name]:>10.2f} us/call")
+	return results
+
+def print_load(title, load):
+	print(f"\n{title}")
+	print(f"{'route':<22} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+	for name, route in list(load["routes"].items()) + [("overall", load["overall"])]:
+		if route["count"]:
+			print(f"{name:<22} {route['count']:>6} {route['errors']:>6} {route['p50_ms']:>8} {route['p95_ms']:>8} {route['p99_ms']:>8}")
+	print(f"{load['overall']['requests_per_second']} requests/s over {load['overall']['seconds']}s")
+
+def compare(results, path):
+	with open(path) as file:
+		old = json.load(file)
+	print(f"\nCompared with {path}")
+	for name, route in list(results["load"]["routes"].items()) + [("overall", results["load"]["overall"])]:
+		before = old["load"]["routes"].get(name) if name != "overall" else old["load"]["overall"]
+		if not before or not before.get("count") or not route.get("count"):
+			continue
+		changes = " ".join(f"{key[:-3]} {(route[key] - before[key]) / before[key] * 100 if before[key] else 0:+.1f}%" for key in ("p50_ms", "p95_ms", "p99_ms"))
+		print(f"{name:<22} {changes}")
+	old_rps = old["load"]["overall"]["requests_per_second"]
+	print(f"throughput {(results['load']['overall']['requests_per_second'] - old_rps) / old_rps * 100:+.1f}%")
+	for group in ("xss", "database"):
+		for name, value in results.get("micro", {}).get(group, {}).items():
+			before = old.get("micro", {}).get(group, {}).get(name)
+			if before:
+				print(f"{name:<45} {(value - before) / before * 100:+.1f}%")
+
+def main():
+	args = parse_args()
+	workdir = args.workdir or tempfile.mkdtemp(prefix="nexo-bench-")
+	os.makedirs(workdir, exist_ok=True)
+	configure(workdir)
+	# Templates and static files are read relative to the repository root,
+	# everything written goes to the workdir. Importing main sets nothing up
+	# on disk, only main.initialize() would.
+	os.chdir(ROOT)
+	rng = random.Random(args.seed)
+
+	try:
+		start = time.perf_counter()
+		users, topics, post_ids = seed(args, rng)
+		seed_seconds = time.perf_counter() - start
+		print(f"Seeded {len(users)} users, {len(topics)} topics and {len(post_ids)} posts in {seed_seconds:.1f}s ({os.environ['NEXO_DB_PATH']})")
+
+		import main as nexo
+		from lib import globals
+		nexo.limiter.default = (10 ** 9, 1)
+		nexo.limiter.routes = {}
+
+		load = Load(nexo.app, users, topics, post_ids, rng)
+		results = {
+			"version": globals.VERSION_FULL,
+			"started": datetime.datetime.now().isoformat(timespec="seconds"),
+			"config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "workdir")},
+			"seed_seconds": round(seed_seconds, 3),
+		}
+		results["load"] = asyncio.run(load.run(args.requests, args.concurrency))
+		print_load(f"{args.requests} requests at concurrency {args.concurrency}", results["load"])
+
+		if args.alloc_requests:
+			results["allocations"] = asyncio.run(trace_allocations(load, args.alloc_requests, args.concurrency))
+			allocations = results["allocations"]
+			print(f"\ntracemalloc over {allocations['requests']} requests: peak {allocations['peak_bytes'] / 1024:.0f}KB, retained {allocations['retained_bytes'] / 1024:.0f}KB, {allocations['new_blocks_per_request']} new blocks/request")
+			for site in allocations["top"][:5]:
+				print(f"  {site['bytes'] / 1024:>8.1f}KB {site['where']}")
+
+		if not args.no_micro:
+			print()
+			results["micro"] = micro(args, users, post_ids)
+
+		if args.output:
+			with open(args.output, "w") as file:
+				json.dump(results, file, indent=2)
+			print(f"\nSaved {args.output}")
+		if args.compare:
+			compare(results, args.compare)
+	finally:
+		if not args.workdir:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+	main()
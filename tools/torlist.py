@@ -1,5 +1,6 @@
 import requests
 import hashlib
+import os
 
 def get_tor_list():
 	url = 'http://localhost:8080/list.txt'
@@ -9,8 +10,9 @@ def get_tor_list():
 	else:
 		raise Exception(f"Failed to fetch tor list: {response.status_code}")
 
+# Must match lib/tor.py hash_ip
 def hashipe(line):
-	return hashlib.sha1(line.encode()).hexdigest()
+	return hashlib.sha256(line.strip().encode()).hexdigest()
 
 ip_list = get_tor_list()	
 print(f"Fetched {len(ip_list)} lines from the Tor list.")
@@ -21,8 +23,11 @@ for line in ip_list:
 	hash = hashipe(line)
 	hashes.append(hash)
 
-with open('data/torlist.txt', 'w') as f:
+# Write to a temporary file and rename it so a running server never reloads
+# a half written list
+with open('data/torlist.txt.tmp', 'w') as f:
 	for hash in hashes:
 		f.write(hash + '\n')
+os.replace('data/torlist.txt.tmp', 'data/torlist.txt')
 
 print(f"Fetched {len(hashes)} hashes from the Tor list.")
\ No newline at end of file
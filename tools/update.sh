@@ -1,5 +1,8 @@
-
 git pull
-kill -9 $(ps -ef | grep 'python src/main.py' | grep -v grep | awk '{print $2}')
-nohup python src/main.py > log.txt &
-echo "Update completed and server restarted."
\ No newline at end of file
+if [ -f data/serve.pid ] && kill -HUP $(cat data/serve.pid) 2>/dev/null; then
+	echo "Update completed and workers are being replaced."
+else
+	kill -9 $(ps -ef | grep 'python src/main.py' | grep -v grep | awk '{print $2}') 2>/dev/null
+	nohup python src/serve.py > log.txt &
+	echo "Update completed and server restarted."
+fi